@@ -0,0 +1,147 @@
+"""
+Benchmarks the compression codecs frames can be compressed with, trading
+bandwidth for CPU time.
+
+For every installed codec and payload size, this shows how many bytes go on
+the wire compared to the uncompressed payload, and how long compressing and
+decompressing one frame takes. The payloads are JSON game states, which are
+large and repetitive like most state updates.
+
+Then the same for small JSON messages with the same keys, comparing zlib with
+the ``"zlib-dict"`` codec and a dictionary built from earlier messages.
+
+Run from the repository root with ``python -m benchmarks.bench_compression``
+"""
+
+from __future__ import annotations
+
+import json
+import random
+import time
+
+from hisock.utils import (
+    _CODECS,
+    _DICTIONARY_CODEC,
+    _KNOWN_CODECS,
+    _build_dictionary,
+    _dictionary_codec,
+)
+
+PAYLOAD_SIZES = (256, 4096, 65536, 1 << 20)
+SMALL_MESSAGES = 1000
+
+
+def make_payload(size: int) -> bytes:
+    """Returns a JSON game state of about ``size`` bytes"""
+
+    random.seed(size)
+    players = [
+        {
+            "name": f"player{number}",
+            "x": random.randint(0, 1000),
+            "y": random.randint(0, 1000),
+            "health": random.choice((100, 75, 50)),
+            "state": random.choice(("idle", "walking", "attacking")),
+        }
+        # Every player takes less than 100 bytes
+        for number in range(size // 60 + 1)
+    ]
+    payload = json.dumps({"tick": 1234, "players": players}).encode()
+    return payload[:size]
+
+
+def make_small_messages() -> list[bytes]:
+    """Returns small JSON messages, like the ones sent every tick"""
+
+    random.seed(0)
+    return [
+        b"$CMD$move$MSG$"
+        + json.dumps(
+            {
+                "player": f"player{random.randint(0, 50)}",
+                "x": random.randint(0, 1000),
+                "y": random.randint(0, 1000),
+                "state": random.choice(("idle", "walking", "attacking")),
+            }
+        ).encode()
+        for _ in range(SMALL_MESSAGES * 2)
+    ]
+
+
+def bench_codec(name: str, payload: bytes) -> tuple[float, float, float]:
+    """
+    Compresses and decompresses the payload as one frame, many times.
+
+    :return: The compressed size as a fraction of the payload, and the
+        microseconds it takes to compress and to decompress it
+    :rtype: tuple[float, float, float]
+    """
+
+    codec = _CODECS[name]
+    repeats = max(10, (1 << 22) // len(payload))
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        compressed = codec.compress(payload)
+    compress_time = (time.perf_counter() - start) / repeats
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        codec.decompress(compressed)
+    decompress_time = (time.perf_counter() - start) / repeats
+
+    return len(compressed) / len(payload), compress_time * 1e6, decompress_time * 1e6
+
+
+def run():
+    # The dictionary codec is only benchmarked with the small messages
+    missing = [
+        name
+        for name in _KNOWN_CODECS
+        if name not in _CODECS and name != _DICTIONARY_CODEC
+    ]
+    if missing:
+        print(f"Not installed: {', '.join(missing)}\n")
+
+    print(
+        f"{'codec':>6} {'bytes':>8} {'wire %':>7} {'compress µs':>12} {'decompress µs':>14}"
+    )
+    for name in _KNOWN_CODECS:
+        if name not in _CODECS:
+            continue
+
+        for size in PAYLOAD_SIZES:
+            ratio, compress_us, decompress_us = bench_codec(name, make_payload(size))
+            print(
+                f"{name:>6} {size:>8} {ratio * 100:>6.1f}% "
+                f"{compress_us:>12.1f} {decompress_us:>14.1f}"
+            )
+
+    # The dictionary is built from the first half, and used for the second one
+    messages = make_small_messages()
+    dictionary_codec = _dictionary_codec(_build_dictionary(messages[:SMALL_MESSAGES]))
+    messages = messages[SMALL_MESSAGES:]
+    payload_size = sum(map(len, messages)) / len(messages)
+
+    print(
+        f"\n{'codec':>9} {'bytes':>6} {'wire bytes':>11} {'compress µs':>12} {'decompress µs':>14}"
+    )
+    for name, codec in (("zlib", _CODECS["zlib"]), ("zlib-dict", dictionary_codec)):
+        start = time.perf_counter()
+        compressed = [codec.compress(message) for message in messages]
+        compress_time = (time.perf_counter() - start) / len(messages)
+
+        start = time.perf_counter()
+        for message in compressed:
+            codec.decompress(message)
+        decompress_time = (time.perf_counter() - start) / len(messages)
+
+        wire_size = sum(map(len, compressed)) / len(messages)
+        print(
+            f"{name:>9} {payload_size:>6.0f} {wire_size:>11.0f} "
+            f"{compress_time * 1e6:>12.1f} {decompress_time * 1e6:>14.1f}"
+        )
+
+
+if __name__ == "__main__":
+    run()
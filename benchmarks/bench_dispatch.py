@@ -0,0 +1,62 @@
+"""
+Benchmarks dispatching command messages to the functions registered with
+:meth:`hisock.server.HiSockServer.on`.
+
+For each number of registered commands, this shows how long the server takes
+to handle one message for the last registered command, which should stay flat
+as the number of commands grows.
+
+Run from the repository root with ``python -m benchmarks.bench_dispatch``
+"""
+
+from __future__ import annotations
+
+import time
+
+from hisock.server import HiSockServer
+from hisock.utils import ClientRecord, make_header
+
+HANDLER_COUNTS = (1, 10, 100, 1000)
+MESSAGES = 100_000
+
+
+def bench_handlers(handler_count: int) -> float:
+    """
+    Handles :data:`MESSAGES` messages with ``handler_count`` registered commands.
+
+    :return: The nanoseconds per message
+    :rtype: float
+    """
+
+    server = HiSockServer(("127.0.0.1", 0), keepalive=False)
+    # The message is handled directly, no client has to be connected
+    client_socket = object()
+    server.clients.add(client_socket, ClientRecord(("127.0.0.1", 1)))
+
+    for number in range(handler_count):
+
+        @server.on(f"command{number}")
+        def on_command(client_data: dict, message: int):
+            pass
+
+    data = f"$CMD$command{handler_count - 1}$MSG$42".encode()
+    message = {"header": make_header(data, server.header_len), "data": data}
+
+    start = time.perf_counter()
+    for _ in range(MESSAGES):
+        server._handle_message(client_socket, message)
+    elapsed = time.perf_counter() - start
+
+    server.clients.clear()
+    server.close()
+    return elapsed / MESSAGES * 1e9
+
+
+def run():
+    print(f"{'handlers':>8} {'ns/message':>12}")
+    for handler_count in HANDLER_COUNTS:
+        print(f"{handler_count:>8} {bench_handlers(handler_count):>12.0f}")
+
+
+if __name__ == "__main__":
+    run()
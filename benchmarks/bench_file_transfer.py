@@ -0,0 +1,154 @@
+"""
+Benchmarks sending a large file as one message against sending it in chunks
+with ``send_file``, from the server to a client and back.
+
+As one message, the file is read into memory, and the whole message has to be
+received before it's handled. ``send_file`` sends it with ``sendfile``, and
+the receiver writes every chunk into the file as it arrives. This prints the
+throughput, and the peak memory Python allocated meanwhile (measured with
+:mod:`tracemalloc`, for the sender and the receiver together).
+
+Run from the repository root with ``python -m benchmarks.bench_file_transfer``
+"""
+
+from __future__ import annotations
+
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+import warnings
+
+from hisock.client import HiSockClient
+from hisock.server import HiSockServer
+from hisock.utils import File
+
+FILE_SIZES = (16 << 20, 128 << 20)
+
+
+def start_server(directory: pathlib.Path, received: threading.Event) -> HiSockServer:
+    # A whole file as one message is more than the default send buffer limit
+    server = HiSockServer(
+        ("127.0.0.1", 0),
+        keepalive=False,
+        send_buffer_limit=1 << 30,
+        download_dir=directory,
+    )
+    server.addr = server.sock.getsockname()
+
+    @server.on("blob")
+    def on_blob(client_data: dict, message: bytes):
+        received.set()
+
+    @server.on("file")
+    def on_file(client_data: dict, file: File):
+        received.set()
+
+    def run():
+        while not server.closed:
+            try:
+                server.run()
+            except (OSError, ValueError):
+                break
+
+    threading.Thread(target=run, daemon=True).start()
+    return server
+
+
+def measure(transfer, wait) -> tuple[float, int]:
+    """
+    Runs a transfer, and waits until it's received.
+
+    :return: The seconds it took, and the peak bytes Python allocated
+    :rtype: tuple[float, int]
+    """
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    transfer()
+    wait()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def run():
+    # There's no join function
+    warnings.simplefilter("ignore")
+    directory = pathlib.Path(tempfile.mkdtemp(prefix="hisock-bench-"))
+    (directory / "server").mkdir()
+    (directory / "client").mkdir()
+    received = threading.Event()
+    server = start_server(directory / "server", received)
+    client = HiSockClient(
+        server.addr, "client", None, download_dir=directory / "client"
+    )
+    client_received = []
+
+    @client.on("blob")
+    def on_blob(message: bytes):
+        client_received.append(message)
+
+    @client.on("file")
+    def on_file(file: File):
+        client_received.append(file)
+
+    def client_wait():
+        while not client_received:
+            client.update()
+        client_received.clear()
+
+    def server_wait():
+        received.wait()
+        received.clear()
+
+    print(f"{'':>22} {'MiB':>5} {'MiB/s':>8} {'peak MiB':>9}")
+    for size in FILE_SIZES:
+        path = directory / f"{size}.bin"
+        with open(path, "wb") as file:
+            for _ in range(size >> 20):
+                file.write(os.urandom(1 << 20))
+
+        for name, transfer, wait in (
+            (
+                "server: message",
+                lambda: server.send_client("client", "blob", path.read_bytes()),
+                client_wait,
+            ),
+            (
+                "server: send_file",
+                lambda: server.send_file("client", "file", path),
+                client_wait,
+            ),
+            (
+                "client: message",
+                lambda: client.send("blob", path.read_bytes()),
+                server_wait,
+            ),
+            (
+                "client: send_file",
+                lambda: client.send_file("file", path),
+                server_wait,
+            ),
+        ):
+            elapsed, peak = measure(transfer, wait)
+            print(
+                f"{name:>22} {size >> 20:>5} {size / elapsed / (1 << 20):>8.0f} "
+                f"{peak / (1 << 20):>9.1f}"
+            )
+
+        path.unlink()
+        for received_file in directory.glob("*/*"):
+            received_file.unlink()
+
+    client.close()
+    server._call_in_reactor(server.close)
+    shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,89 @@
+"""
+Benchmarks running threaded functions in a :class:`hisock.utils.HandlerPool`
+against starting a thread for every message (what ``threaded=True`` used to do).
+
+For bursts of messages, this shows how many functions per second are run, and
+the highest number of threads that were alive at once.
+
+Run from the repository root with ``python -m benchmarks.bench_handler_pool``
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+
+from hisock.utils import HandlerPool
+
+BURST_SIZES = (100, 1000, 10_000)
+WORK_SECONDS = 0.0005  # A short function, like most handlers
+
+
+def work():
+    time.sleep(WORK_SECONDS)
+
+
+def bench_thread_per_message(burst_size: int) -> tuple[float, int]:
+    """
+    Starts a thread for every function.
+
+    :return: The functions per second and the most threads alive at once
+    :rtype: tuple[float, int]
+    """
+
+    threads = []
+    peak_threads = 0
+
+    start = time.perf_counter()
+    for _ in range(burst_size):
+        thread = threading.Thread(target=work, daemon=True)
+        thread.start()
+        threads.append(thread)
+        peak_threads = max(peak_threads, threading.active_count())
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return burst_size / elapsed, peak_threads
+
+
+def bench_pool(burst_size: int) -> tuple[float, int]:
+    """
+    Runs every function in a :class:`HandlerPool` with the default limits.
+
+    :return: The functions per second and the most threads alive at once
+    :rtype: tuple[float, int]
+    """
+
+    pool = HandlerPool()
+    peak_threads = 0
+
+    start = time.perf_counter()
+    futures = []
+    for _ in range(burst_size):
+        futures.append(pool.submit(work))
+        peak_threads = max(peak_threads, threading.active_count())
+    for future in futures:
+        future.result()
+    elapsed = time.perf_counter() - start
+
+    pool.shutdown()
+    return burst_size / elapsed, peak_threads
+
+
+def run():
+    print(f"{'burst':>6} {'mode':>18} {'functions/s':>12} {'peak threads':>13}")
+    for burst_size in BURST_SIZES:
+        for mode, bench in (
+            ("thread per message", bench_thread_per_message),
+            ("handler pool", bench_pool),
+        ):
+            functions_per_second, peak_threads = bench(burst_size)
+            print(
+                f"{burst_size:>6} {mode:>18} "
+                f"{functions_per_second:>12.0f} {peak_threads:>13}"
+            )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,66 @@
+"""
+Benchmarks the padded ASCII header against the binary header.
+
+For each payload size, this shows how many bytes a frame takes on the wire
+and how many frames per second can be framed, sent over a socket pair and
+parsed back with :func:`hisock.utils.receive_message`.
+
+Run from the repository root with ``python -m benchmarks.bench_header``
+"""
+
+from __future__ import annotations
+
+import socket
+import threading
+import time
+
+from hisock.utils import make_header, receive_message
+
+HEADER_LEN = 16
+PAYLOAD_SIZES = (8, 64, 512, 4096)
+FRAMES = 20_000
+
+
+def bench_mode(payload_size: int, binary: bool) -> tuple[int, float]:
+    """
+    Sends :data:`FRAMES` frames through a socket pair.
+
+    :return: The bytes per frame and the frames per second
+    :rtype: tuple[int, float]
+    """
+
+    payload = b"x" * payload_size
+    frame_size = len(make_header(payload, HEADER_LEN, binary=binary)) + payload_size
+    sender, receiver = socket.socketpair()
+
+    def send_frames():
+        for _ in range(FRAMES):
+            sender.sendall(make_header(payload, HEADER_LEN, binary=binary) + payload)
+
+    send_thread = threading.Thread(target=send_frames)
+
+    start = time.perf_counter()
+    send_thread.start()
+    for _ in range(FRAMES):
+        receive_message(receiver, HEADER_LEN, binary=binary)
+    send_thread.join()
+    elapsed = time.perf_counter() - start
+
+    sender.close()
+    receiver.close()
+    return frame_size, FRAMES / elapsed
+
+
+def run():
+    print(f"{'payload':>8} {'mode':>7} {'bytes/frame':>12} {'frames/s':>12}")
+    for payload_size in PAYLOAD_SIZES:
+        for binary in (False, True):
+            frame_size, frames_per_second = bench_mode(payload_size, binary)
+            print(
+                f"{payload_size:>8} {'binary' if binary else 'ascii':>7} "
+                f"{frame_size:>12} {frames_per_second:>12.0f}"
+            )
+
+
+if __name__ == "__main__":
+    run()
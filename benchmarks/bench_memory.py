@@ -0,0 +1,97 @@
+"""
+Benchmarks how much memory the server keeps for each idle client.
+
+For every number of clients, a child process opens the connections and sends
+their client hellos, and the server accepts them and handles the hellos. The
+memory Python allocated meanwhile (measured with :mod:`tracemalloc`, so the
+kernel's socket buffers aren't counted) is divided by the number of clients.
+
+Run from the repository root with ``python -m benchmarks.bench_memory``
+"""
+
+from __future__ import annotations
+
+import json
+import multiprocessing
+import selectors
+import socket
+import threading
+import tracemalloc
+import warnings
+
+from benchmarks.bench_selector import raise_fd_limit
+from hisock.server import HiSockServer
+from hisock.utils import make_header
+
+CLIENT_COUNTS = (100, 1_000, 2_000)
+
+
+def drain(selector: selectors.BaseSelector):
+    """Receives what the server sends, so it doesn't pile up in the server"""
+
+    while True:
+        for key, _ in selector.select(timeout=0.1):
+            try:
+                key.fileobj.recv(65536)
+            except OSError:
+                pass
+
+
+def connect_clients(addr: tuple[str, int], client_count: int, done):
+    """Opens the connections of the clients, and keeps them until ``done`` is set"""
+
+    raise_fd_limit()
+    selector = selectors.DefaultSelector()
+    threading.Thread(target=drain, args=(selector,), daemon=True).start()
+
+    for number in range(client_count):
+        connection = socket.create_connection(addr)
+        # The legacy client hello, which doesn't get a server hello back
+        hello = f"$CLTHELLO$ {json.dumps({'name': f'client{number}', 'group': None})}"
+        connection.sendall(make_header(hello.encode(), 16) + hello.encode())
+        selector.register(connection, selectors.EVENT_READ)
+    done.wait()
+
+
+def bench_memory(client_count: int) -> float:
+    """Returns the bytes the server allocated per connected client"""
+
+    server = HiSockServer(
+        ("127.0.0.1", 0), max_connections=client_count, keepalive=False
+    )
+    server.addr = server.sock.getsockname()
+    done = multiprocessing.Event()
+    clients = multiprocessing.Process(
+        target=connect_clients, args=(server.addr, client_count, done)
+    )
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    clients.start()
+    while len(server.clients) < client_count:
+        server.run()
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    done.set()
+    clients.join()
+    server.close()
+    return allocated / client_count
+
+
+def run():
+    fd_limit = raise_fd_limit()
+    # There's no join function
+    warnings.simplefilter("ignore")
+
+    print(f"{'clients':>8} {'bytes per client':>18}")
+    for client_count in CLIENT_COUNTS:
+        if client_count + 64 > fd_limit:
+            print(f"{client_count:>8} skipped (file descriptor limit is {fd_limit})")
+            continue
+
+        print(f"{client_count:>8} {bench_memory(client_count):>18.0f}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,91 @@
+"""
+Benchmarks request/response round trips between a client and a server.
+
+Stop-and-wait sends one call and waits for its reply before sending the next
+one, like :meth:`hisock.client.HiSockClient.get_client` used to do. Pipelined
+sends every call first, then waits for all of the replies. Both print the
+calls per second and the latency of the calls, as measured by the futures.
+
+Run from the repository root with ``python -m benchmarks.bench_rpc``
+"""
+
+from __future__ import annotations
+
+import statistics
+import threading
+import time
+import warnings
+
+from hisock.client import HiSockClient
+from hisock.server import HiSockServer
+
+CALLS = 10_000
+
+
+def start_server() -> HiSockServer:
+    server = HiSockServer(("127.0.0.1", 0), keepalive=False)
+    server.addr = server.sock.getsockname()
+
+    @server.on("echo")
+    def on_echo(client_data: dict, message: bytes) -> bytes:
+        return message
+
+    def run():
+        while not server.closed:
+            try:
+                server.run()
+            except (OSError, ValueError):
+                break
+
+    threading.Thread(target=run, daemon=True).start()
+    return server
+
+
+def bench_stop_and_wait(client: HiSockClient) -> list:
+    """Returns the futures of the calls, made one at a time"""
+
+    futures = []
+    for _ in range(CALLS):
+        future = client.call("echo", b"ping")
+        future.result()
+        futures.append(future)
+    return futures
+
+
+def bench_pipelined(client: HiSockClient) -> list:
+    """Returns the futures of the calls, all made before the first reply"""
+
+    futures = [client.call("echo", b"ping") for _ in range(CALLS)]
+    for future in futures:
+        future.result()
+    return futures
+
+
+def run():
+    # There's no join function
+    warnings.simplefilter("ignore")
+    server = start_server()
+    client = HiSockClient(server.addr, "client", None)
+
+    print(f"{'':>14} {'calls/s':>10} {'p50 µs':>8} {'p99 µs':>8}")
+    for name, bench in (
+        ("stop-and-wait", bench_stop_and_wait),
+        ("pipelined", bench_pipelined),
+    ):
+        start = time.perf_counter()
+        futures = bench(client)
+        elapsed = time.perf_counter() - start
+
+        latencies = sorted(future.latency * 1e6 for future in futures)
+        p99 = latencies[int(len(latencies) * 0.99)]
+        print(
+            f"{name:>14} {CALLS / elapsed:>10.0f} "
+            f"{statistics.median(latencies):>8.0f} {p99:>8.0f}"
+        )
+
+    client.close()
+    server._call_in_reactor(server.close)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,117 @@
+"""
+Benchmarks how waiting for clients scales with the number of connections.
+
+``select.select`` is how :meth:`hisock.server.HiSockServer.run` used to wait:
+the whole socket list is passed in on every call. The selector backends
+(what ``run`` uses now) register every socket once. For every number of
+connections, all but one connection is idle and the one active connection
+sends a message per iteration, which is received and handled.
+
+Run from the repository root with ``python -m benchmarks.bench_selector``
+
+.. note::
+    The idle connections are unbound UDP sockets so that each one takes a
+    single file descriptor. The benchmark raises its soft limit as far as the
+    hard limit allows, and skips the counts that don't fit.
+"""
+
+from __future__ import annotations
+
+import select
+import selectors
+import socket
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+CLIENT_COUNTS = (100, 1_000, 10_000)
+ITERATIONS = 2_000
+
+
+def raise_fd_limit() -> int:
+    """Raises the soft file descriptor limit to the hard limit and returns it"""
+
+    if resource is None:
+        return 512
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def bench_select(server_sockets: list, active: socket.socket) -> float:
+    """Waits like the old ``run`` did, and returns the seconds per iteration"""
+
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        active.send(b"x")
+        read_sock, _, _ = select.select(server_sockets, [], server_sockets)
+        for client_socket in read_sock:
+            client_socket.recv(1)
+    return (time.perf_counter() - start) / ITERATIONS
+
+
+def bench_selector(
+    selector_class: type, server_sockets: list, active: socket.socket
+) -> float:
+    """Waits like ``run`` does now, and returns the seconds per iteration"""
+
+    selector = selector_class()
+    for client_socket in server_sockets:
+        selector.register(client_socket, selectors.EVENT_READ)
+
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        active.send(b"x")
+        for key, _ in selector.select():
+            key.fileobj.recv(1)
+    elapsed = time.perf_counter() - start
+
+    selector.close()
+    return elapsed / ITERATIONS
+
+
+def run():
+    fd_limit = raise_fd_limit()
+    backends = {"select.select": None, "SelectSelector": selectors.SelectSelector}
+    backends[selectors.DefaultSelector.__name__] = selectors.DefaultSelector
+
+    print(f"{'clients':>8} " + " ".join(f"{name:>16}" for name in backends))
+    for client_count in CLIENT_COUNTS:
+        if client_count + 32 > fd_limit:
+            print(f"{client_count:>8} skipped (file descriptor limit is {fd_limit})")
+            continue
+
+        idle_sockets = [
+            socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            for _ in range(client_count - 1)
+        ]
+        server_socket, active = socket.socketpair()
+        server_sockets = idle_sockets + [server_socket]
+
+        results = []
+        for name, selector_class in backends.items():
+            try:
+                if selector_class is None:
+                    seconds = bench_select(server_sockets, active)
+                else:
+                    seconds = bench_selector(selector_class, server_sockets, active)
+            except ValueError:
+                # select() can't wait on file descriptors above FD_SETSIZE
+                results.append(f"{'unsupported':>16}")
+                continue
+            results.append(f"{seconds * 1_000_000:>13.1f} us")
+
+        print(f"{client_count:>8} " + " ".join(results))
+
+        for client_socket in server_sockets:
+            client_socket.close()
+        active.close()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,137 @@
+"""
+Benchmarks the socket options of the server and the client, in latency mode
+against throughput mode.
+
+Latency mode turns ``TCP_NODELAY`` on, so every message is sent right away.
+Throughput mode uses bigger socket buffers, and coalesces the messages sent
+while handling a message into one system call. Corked is throughput mode with
+``TCP_CORK`` on as well (Linux only), which holds back what doesn't fill a
+packet for up to 200 ms. They're compared with the defaults of the OS, on two
+workloads:
+
+- Stop-and-wait calls, where every call waits for the reply to the one before
+  it. This prints the calls per second and the latency of the calls.
+- Bursts, where the server's function for a message sends many small messages
+  back. This prints the messages per second the client receives.
+
+Every workload stops after a few seconds, as corked calls take 200 ms each.
+
+Run from the repository root with ``python -m benchmarks.bench_socket_tuning``
+"""
+
+from __future__ import annotations
+
+import statistics
+import threading
+import time
+import warnings
+
+from hisock.client import HiSockClient
+from hisock.server import HiSockServer
+
+CALLS = 5000
+BURSTS = 20
+BURST_SIZE = 5000
+# The seconds a workload may take
+TIME_LIMIT = 3
+
+THROUGHPUT = {
+    "send_buffer_size": 1 << 20,
+    "receive_buffer_size": 1 << 20,
+    "coalesce_writes": True,
+}
+MODES = {
+    "default": {},
+    "latency": {"tcp_nodelay": True},
+    "throughput": THROUGHPUT,
+    "corked": {**THROUGHPUT, "tcp_cork": True},
+}
+
+
+def start_server(options: dict) -> HiSockServer:
+    server = HiSockServer(("127.0.0.1", 0), keepalive=False, **options)
+    server.addr = server.sock.getsockname()
+
+    @server.on("echo")
+    def on_echo(client_data: dict, message: bytes) -> bytes:
+        return message
+
+    @server.on("burst")
+    def on_burst(client_data: dict, count: int):
+        for number in range(count):
+            server.send_client(client_data["name"], "number", number)
+
+    def run():
+        while not server.closed:
+            try:
+                server.run()
+            except (OSError, ValueError):
+                break
+
+    threading.Thread(target=run, daemon=True).start()
+    return server
+
+
+def bench_stop_and_wait(client: HiSockClient) -> tuple[float, list]:
+    """
+    :return: The seconds the calls took, made one at a time, and their futures
+    :rtype: tuple[float, list]
+    """
+
+    futures = []
+    start = time.perf_counter()
+    while len(futures) < CALLS and time.perf_counter() - start < TIME_LIMIT:
+        future = client.call("echo", b"ping")
+        future.result()
+        futures.append(future)
+    return time.perf_counter() - start, futures
+
+
+def bench_bursts(client: HiSockClient) -> tuple[float, int]:
+    """
+    :return: The seconds it took to receive bursts of small messages, and the
+        number of messages
+    :rtype: tuple[float, int]
+    """
+
+    received = []
+
+    @client.on("number")
+    def on_number(number: int):
+        received.append(number)
+
+    start = time.perf_counter()
+    for burst in range(1, BURSTS + 1):
+        client.send("burst", BURST_SIZE)
+        while len(received) < burst * BURST_SIZE:
+            client.update()
+        if time.perf_counter() - start > TIME_LIMIT:
+            break
+    return time.perf_counter() - start, len(received)
+
+
+def run():
+    # There's no join function
+    warnings.simplefilter("ignore")
+
+    print(f"{'':>11} {'calls/s':>8} {'p50 µs':>7} {'p99 µs':>7} {'burst msg/s':>12}")
+    for name, options in MODES.items():
+        server = start_server(options)
+        client = HiSockClient(server.addr, "client", None, **options)
+
+        elapsed, futures = bench_stop_and_wait(client)
+        latencies = sorted(future.latency * 1e6 for future in futures)
+        p99 = latencies[int(len(latencies) * 0.99)]
+        burst_elapsed, messages = bench_bursts(client)
+        print(
+            f"{name:>11} {len(futures) / elapsed:>8.0f} "
+            f"{statistics.median(latencies):>7.0f} {p99:>7.0f} "
+            f"{messages / burst_elapsed:>12.0f}"
+        )
+
+        client.close()
+        server._call_in_reactor(server.close)
+
+
+if __name__ == "__main__":
+    run()
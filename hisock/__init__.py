@@ -2,7 +2,9 @@ import hisock.constants as constants  # lgtm [py/unused-import]
 import hisock.utils as utils  # lgtm [py/unused-import] lgtm [py/import-and-import-from]
 
 import hisock.client as client  # lgtm [py/unused-import]
+import hisock.async_client as async_client  # lgtm [py/unused-import]
 import hisock.server as server  # lgtm [py/unused-import]
+import hisock.async_server as async_server  # lgtm [py/unused-import]
 
 from hisock.constants import __version__
 
@@ -11,8 +13,21 @@ from .server import (
     start_threaded_server,
     HiSockServer,
 )  # lgtm [py/unused-import]
+from .async_server import (
+    start_async_server,
+    AsyncHiSockServer,
+)  # lgtm [py/unused-import]
 from .client import connect, threaded_connect, HiSockClient  # lgtm [py/unused-import]
+from .async_client import async_connect, AsyncHiSockClient  # lgtm [py/unused-import]
 from .utils import (  # lgtm [py/unused-import]
+    CallError,
+    CallFuture,
+    GroupCallFuture,
+    ClientRecord,
+    File,
+    FileIntegrityError,
+    HandlerPool,
+    Journal,
     get_local_ip,  # lgtm [py/unused-import]
     input_client_config,
     input_server_config,  # lgtm [py/unused-import]
@@ -20,4 +35,4 @@ from .utils import (  # lgtm [py/unused-import]
     iptup_to_str,  # lgtm [py/unused-import]
 )
 
-import examples  # lgtm [py/unused-import]
\ No newline at end of file
+import examples  # lgtm [py/unused-import]
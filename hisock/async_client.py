@@ -0,0 +1,649 @@
+"""
+This module contains the AsyncHiSockClient, a :class:`HiSockClient` that runs
+on an :mod:`asyncio` event loop instead of being updated in a loop, but also
+contains an `async_connect` function, to pass in things automatically.
+
+====================================
+Copyright SSS_Says_Snek, 2021-present
+====================================
+"""
+
+# Imports
+from __future__ import annotations  # Remove when 3.10 is used by majority
+
+import asyncio  # Event loop
+import functools  # Pass arguments to executor functions
+import inspect  # Coroutine function detection
+import pathlib  # Type hints
+import warnings  # Non-severe errors
+from typing import Callable, Union  # Type hints
+
+try:
+    # Pip builds require relative import
+    from .client import HiSockClient
+    from .utils import (
+        ClientException,
+        ServerException,
+        ServerNotRunning,
+        CallFuture,
+        File,
+        _FILE_MESSAGES,
+        _command_prefix,
+        _frame_buffers,
+        _set_socket_options,
+        _done_future,
+        HandlerPool,
+        HandlerPoolFull,
+        Journal,
+        Sendable,
+        Client,
+        iptup_to_str,
+        validate_ipv4,
+    )
+except ImportError:
+    # Relative import doesn't work for non-pip builds
+    from client import HiSockClient
+    from utils import (
+        ClientException,
+        ServerException,
+        ServerNotRunning,
+        CallFuture,
+        File,
+        _FILE_MESSAGES,
+        _command_prefix,
+        _frame_buffers,
+        _set_socket_options,
+        _done_future,
+        HandlerPool,
+        HandlerPoolFull,
+        Journal,
+        Sendable,
+        Client,
+        iptup_to_str,
+        validate_ipv4,
+    )
+
+# Messages that are handled by the client itself, and never returned by `recv`
+_RESERVED_MESSAGES = (
+    b"$CMD$",
+    b"$KEEPALIVE$",
+    b"$DISCONN$",
+    b"$CLTCONN$",
+    b"$CLTDISCONN$",
+    b"$REPLY$",
+    b"$CALL$",
+) + _FILE_MESSAGES
+
+
+class AsyncHiSockClient(HiSockClient):
+    """
+    A downside of :class:`HiSockClient` is that :meth:`HiSockClient.update` has
+    to be called in a loop (or thread) for every connection.
+    :class:`AsyncHiSockClient` receives on an :mod:`asyncio` event loop instead,
+    so one process can drive hundreds of connections without a thread for each
+    of them.
+
+    The client connects when :meth:`start` is awaited (:func:`async_connect` does
+    that for you). From then on, messages with a command are handled by the
+    functions registered with :meth:`on`, which can also be coroutine functions
+    (``async def``), and raw messages are returned by :meth:`recv`.
+    Threaded functions are run in :attr:`handler_pool` through the event loop.
+
+    .. note::
+        For documentation, see :class:`HiSockClient`. The sending methods,
+        :meth:`recv`, :meth:`change_name`, :meth:`change_group` and
+        :meth:`get_client` are coroutines.
+
+    .. code-block:: python
+       async def main():
+           client = await async_connect(("127.0.0.1", 6969), name="bot")
+
+           @client.on("client_connect")
+           async def on_connect(client_data: dict):
+               await client.send("greet", client_data["name"])
+
+           await client.send_raw("hello")
+           print(await client.recv())
+           await client.wait_closed()
+
+       asyncio.run(main())
+    """
+
+    def __init__(
+        self,
+        addr: tuple[str, int],
+        name: Union[str, None],
+        group: Union[str, None],
+        header_len: int = 16,
+        cache_size: int = -1,
+        binary_header: bool = True,
+        handler_pool: HandlerPool = None,
+        cache_max_bytes: int = 0,
+        journal: Journal = None,
+        compression: Union[str, tuple] = None,
+        compression_threshold: int = 1024,
+        download_dir: Union[str, pathlib.Path] = None,
+        file_progress: Callable = None,
+        tcp_nodelay: bool = None,
+        tcp_cork: bool = False,
+        send_buffer_size: int = None,
+        receive_buffer_size: int = None,
+        coalesce_writes: bool = False,
+    ):
+        super().__init__(
+            addr,
+            name,
+            group,
+            header_len=header_len,
+            cache_size=cache_size,
+            binary_header=binary_header,
+            handler_pool=handler_pool,
+            cache_max_bytes=cache_max_bytes,
+            journal=journal,
+            compression=compression,
+            compression_threshold=compression_threshold,
+            download_dir=download_dir,
+            file_progress=file_progress,
+            tcp_nodelay=tcp_nodelay,
+            tcp_cork=tcp_cork,
+            send_buffer_size=send_buffer_size,
+            receive_buffer_size=receive_buffer_size,
+            coalesce_writes=coalesce_writes,
+        )
+
+        self._loop = None
+        self._reader = None
+        self._writer = None
+        self._receive_task = None
+        # Raw messages waiting for `recv`, None is put in when the client closes
+        self._raw_messages = asyncio.Queue()
+
+    def __str__(self) -> str:
+        """Example: <AsyncHiSockClient connected to 192.168.1.133:5000>"""
+
+        return f"<AsyncHiSockClient connected to {iptup_to_str(self.addr)}>"
+
+    # Internal methods
+
+    def _connect(self, blocking: bool, binary_header: bool):
+        # There's no event loop yet, the client connects in `start`
+        self.sock = None
+        self._binary_header_requested = binary_header
+
+    def _write(self, *buffers: bytes):
+        """
+        Writes a message to the server, without waiting for it to be sent
+
+        With ``coalesce_writes``, the messages written in one iteration of the
+        event loop are written together once it's done.
+
+        :param buffers: The pieces of the message, see :meth:`HiSockClient._write`
+        :type buffers: bytes
+        """
+
+        if (
+            self.journal is not None
+            and self.journal.record_sent
+            and not buffers[0].startswith(_FILE_MESSAGES)
+        ):
+            self.journal.append(b"".join(buffers), sent=True)
+        buffers = _frame_buffers(
+            buffers,
+            self.header_len,
+            self.binary_header,
+            self._frame_reader.codec,
+            self.compression_threshold,
+        )
+        if not self.coalesce_writes:
+            # Sent with `sendmsg` by the transports that have it
+            self._writer.writelines(buffers)
+            return
+
+        if self._coalesced is None:
+            self._coalesced = []
+            self._loop.call_soon(self._write_coalesced)
+        self._coalesced.extend(buffers)
+
+    def _write_coalesced(self):
+        """Writes the messages coalesced in this iteration of the event loop"""
+
+        if self._coalesced is None:
+            return
+
+        buffers, self._coalesced = self._coalesced, None
+        if not self._writer.is_closing():
+            self._writer.writelines(buffers)
+
+    def _handle_keepalive(self):
+        self._write(f"$KEEPACK${iptup_to_str(self.get_client_addr())}".encode())
+
+    def _run_function(self, func: dict, *args, reply: Callable = None, **kwargs):
+        # Coroutine function
+        if inspect.iscoroutinefunction(func["func"]):
+            task = self._loop.create_task(func["func"](*args, **kwargs))
+            if reply is not None:
+                task.add_done_callback(reply)
+            return
+
+        # Normal
+        if not func["threaded"]:
+            if reply is None:
+                func["func"](*args, **kwargs)
+                return
+
+            # The exception is raised by the server instead
+            try:
+                result = func["func"](*args, **kwargs)
+            except Exception as e:
+                reply(_done_future(exception=e))
+                return
+            reply(_done_future(result))
+            return
+
+        # Threaded, the reply is written on the event loop
+        try:
+            future = self._loop.run_in_executor(
+                self.handler_pool, functools.partial(func["func"], *args, **kwargs)
+            )
+        except HandlerPoolFull as e:
+            warnings.warn(f"{func['name']} was not run: {e}", UserWarning)
+            if reply is not None:
+                reply(_done_future(exception=e))
+            return
+
+        if reply is not None:
+            future.add_done_callback(reply)
+
+    def _handle_message(self, message: dict[str, bytes]):
+        if not message["data"].startswith(_RESERVED_MESSAGES):
+            if self.journal is not None:
+                self.journal.append(message["data"])
+            self._raw_messages.put_nowait(message["data"])
+            return
+
+        super()._handle_message(message)
+
+    async def _receive(self):
+        """The receiving task, handles every message from the server"""
+
+        try:
+            while not self.closed:
+                data = await self._reader.read(self._frame_reader.recv_size)
+                if not data:
+                    break
+
+                self._frame_reader.feed(data)
+                for message in self._frame_reader.frames():
+                    self._handle_message(message)
+                    if self.closed:
+                        break
+        except (ConnectionResetError, ConnectionAbortedError):
+            pass
+        finally:
+            # The server closed the connection
+            if not self.closed:
+                self.closed = True
+                self._writer.close()
+            self._raw_messages.put_nowait(None)
+            self._calls.close(ServerNotRunning("Client is closed, aborting..."))
+            self._end_file_transfers(ServerNotRunning("Client is closed, aborting..."))
+
+    # Running
+
+    async def start(self):
+        """
+        Connects to the server on the running event loop, and starts handling
+        the messages it sends.
+
+        :raises ServerNotRunning: If the server isn't running.
+        :raises ServerException: If the server didn't answer the client hello.
+        """
+
+        self._loop = asyncio.get_running_loop()
+        try:
+            self._reader, self._writer = await asyncio.open_connection(*self.addr)
+        except ConnectionRefusedError:
+            raise ServerNotRunning(
+                "Server is not running! Aborting..."
+            ) from ConnectionRefusedError
+        self.sock = self._writer.get_extra_info("socket")
+        # asyncio turns TCP_NODELAY on by itself
+        _set_socket_options(
+            self.sock,
+            self.tcp_nodelay,
+            self.tcp_cork,
+            self.send_buffer_size,
+            self.receive_buffer_size,
+        )
+
+        self._write(self._client_hello(self._binary_header_requested).encode())
+
+        # Only a server asked for the binary header answers with a server hello,
+        # which is always sent with the ASCII header. Anything the server sends
+        # after it stays buffered in the frame reader for `_receive`
+        if self._binary_header_requested:
+            server_hello = self._frame_reader.next_frame()
+            while server_hello is None:
+                data = await self._reader.read(self._frame_reader.recv_size)
+                if not data:
+                    raise ServerException(
+                        "Server closed the connection during the hello."
+                    )
+                self._frame_reader.feed(data)
+                server_hello = self._frame_reader.next_frame()
+            self._server_hello(server_hello["data"])
+        else:
+            self._hello_done()
+
+        self._receive_task = self._loop.create_task(self._receive())
+
+    async def wait_closed(self):
+        """Waits until the client is closed, by either the server or :meth:`close`"""
+
+        if self._receive_task is not None:
+            await asyncio.shield(self._receive_task)
+
+    # Transmit data
+
+    async def send(self, command: str, content: Sendable = None):
+        """
+        Sends a command & content to the server, and waits until
+        it can be sent.
+
+        :param command: A string, containing the command to send
+        :type command: str
+        :param content: The message / content to send
+        :type content: Sendable, optional
+        """
+
+        self._write(_command_prefix(command), self._send_type_cast(content))
+        await self._writer.drain()
+
+    async def send_raw(self, content: Sendable = None):
+        """
+        Sends a message to the server: NO COMMAND REQUIRED, and waits
+        until it can be sent.
+
+        :param content: The message / content to send
+        :type content: Sendable, optional
+        """
+
+        self._write(self._send_type_cast(content))
+        await self._writer.drain()
+
+    async def send_file(
+        self,
+        command: str,
+        file_path: Union[str, pathlib.Path],
+        chunk_size: int = 65536,
+        progress: Callable = None,
+    ) -> File:
+        """
+        Sends a file to the server in chunks, see :meth:`HiSockClient.send_file`,
+        and waits until all of it is sent. Other messages are sent between its
+        chunks, and files sent from different tasks take turns.
+
+        The stream can't send from a file without holding back every other
+        message, so every chunk is read before it's sent, one at a time. The
+        file is hashed in the default executor first, and only the chunks the
+        server doesn't have yet are sent.
+
+        :param command: A string, containing the command to send the file with
+        :type command: str
+        :param file_path: The path of the file to send
+        :type file_path: Union[str, pathlib.Path]
+        :param chunk_size: The number of bytes in every chunk.
+            Default is 64 KiB.
+        :type chunk_size: int, optional
+        :param progress: Called with the :class:`File` after every chunk is sent.
+            Default is None.
+        :type progress: Callable[[File], None], optional
+        :return: The file, once the server verified it
+        :rtype: File
+
+        :raises ClientException: If the server can't receive files, or the
+            client was closed while sending it.
+        :raises ServerNotRunning: If the server closed the connection.
+        :raises FileIntegrityError: If the server didn't receive it intact.
+        :raises OSError: If the file can't be read.
+        """
+
+        if not self._server_files:
+            raise ClientException("The server can't receive files.")
+
+        file = File(file_path)
+        file._open(command, next(self._file_ids), chunk_size, progress)
+        try:
+            await self._loop.run_in_executor(None, file._hash)
+            file._acknowledge(
+                await self._wait_for_file_ack(file, file._start_message())
+            )
+            chunk = file._next_chunk()
+            while chunk is not None:
+                if self.closed:
+                    raise ClientException("The client was closed.")
+
+                prefix, offset, count = chunk
+                self._write(prefix, file._read(offset, count))
+                file._sent(count)
+                await self._writer.drain()
+                chunk = file._next_chunk()
+
+            file._acknowledge(await self._wait_for_file_ack(file, file._end_message()))
+        except (OSError, ClientException, ServerNotRunning) as e:
+            file._finish(e)
+            raise
+        return file.wait(0)
+
+    async def _wait_for_file_ack(self, file: File, message: bytes) -> bytes:
+        """
+        Sends the start or the end message of a file, and waits until the
+        server acknowledges it, see :meth:`HiSockClient._wait_for_file_ack`
+
+        :param file: The file
+        :type file: File
+        :param message: The message
+        :type message: bytes
+        :return: The bitmap of the chunks the server has
+        :rtype: bytes
+        """
+
+        # The acknowledgment is received by `_receive`
+        future = CallFuture()
+        self._file_acks[file.transfer_id] = future
+        self._write(message)
+        await self._writer.drain()
+        return await asyncio.wrap_future(future)
+
+    async def call(
+        self,
+        command: str,
+        content: Sendable = None,
+        timeout: float = None,
+        return_type: type = bytes,
+    ):
+        """
+        Sends a command & content to the server, and waits for the reply, which
+        is what the server's function for the command returned. Calls made from
+        different tasks don't wait for each other's replies.
+
+        :param command: A string, containing the command to send
+        :type command: str
+        :param content: The message / content to send
+        :type content: Sendable, optional
+        :param timeout: The number of seconds to wait for the reply.
+            Default is None (waits forever).
+        :type timeout: float, optional
+        :param return_type: The type to type cast the reply to.
+            Default is bytes.
+        :type return_type: type, optional
+        :return: The reply, type casted to ``return_type``
+
+        :raises asyncio.TimeoutError: If no reply was received in time.
+        :raises CallError: If the function failed, or there's no function for
+            the command.
+        :raises ClientException: If the server doesn't support calls.
+        """
+
+        return await self._wait_for_call(
+            b"$CMD$" + command.encode() + b"$MSG$" + self._send_type_cast(content),
+            timeout,
+            return_type,
+        )
+
+    def _call(
+        self, message: bytes, timeout: float = None, return_type: type = bytes
+    ) -> CallFuture:
+        if not self._server_calls:
+            raise ClientException("The server doesn't support calls.")
+
+        # The reply is received by `_receive`, and timeouts are up to the caller
+        future = CallFuture()
+        call_id = self._calls.add(future, return_type=return_type)
+        self._write(b"$CALL$%d" % call_id + message)
+        return future
+
+    async def _wait_for_call(
+        self, message: bytes, timeout: float = None, return_type: type = bytes
+    ):
+        """
+        Sends a message as a call, and waits for the reply
+
+        :param message: The message the server handles, e.g. a command
+        :type message: bytes
+        :param timeout: The number of seconds to wait for the reply
+        :type timeout: float, optional
+        :param return_type: The type to type cast the reply to
+        :type return_type: type, optional
+        :return: The reply
+        """
+
+        future = self._call(message, return_type=return_type)
+        await self._writer.drain()
+        # The call is forgotten if it times out, see `_PendingCalls.add`
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+
+    async def recv(self, timeout: float = None) -> bytes:
+        """
+        Waits until a raw message is received, and returns that message.
+        Messages with a command are handled by the functions registered with
+        :meth:`on` instead.
+
+        .. note::
+            Raw messages are kept until they are received with this method.
+
+        :param timeout: The number of seconds to wait for a message.
+            Default is None (waits forever).
+        :type timeout: float, optional
+
+        :return: A bytes-like object, containing the content/message
+            the client first receives
+        :rtype: bytes
+
+        :raises asyncio.TimeoutError: If no message was received in time.
+        :raises ServerNotRunning: If the client was closed.
+        """
+
+        data = await asyncio.wait_for(self._raw_messages.get(), timeout)
+        if data is None:
+            # Wake up the next waiting `recv`, too
+            self._raw_messages.put_nowait(None)
+            raise ServerNotRunning("Client is closed, aborting...")
+
+        return data
+
+    # Changers
+
+    async def change_name(self, new_name: Union[str, None]):
+        """
+        Changes the name of the client
+
+        :param new_name: The new name for the client to be called
+            If left blank, then the name will be reset.
+        :type new_name: str, optional
+        """
+
+        await self.send_raw("$CHNAME$" + (f" {new_name}" or ""))
+
+    async def change_group(self, new_group: Union[str, None]):
+        """
+        Changes the client's group.
+
+        :param new_group: The new group name of the client
+        :type new_group: Union[str, None]
+        """
+
+        await self.send_raw("$CHGROUP$" + (f" {new_group}" or ""))
+
+    # Getters
+
+    async def get_client(self, client: Client) -> dict:
+        """
+        Gets the client data for a client.
+
+        :param client: The client name or IP+port to get.
+        :type client: Client
+        :return: The client data.
+        :rtype: dict
+
+        :raises ValueError: If the client IP is invalid.
+        :raise ClientNotFound: If the client couldn't be found.
+        :raise ServerException: If another error occurred.
+        """
+
+        try:
+            validate_ipv4(iptup_to_str(client))
+        except ValueError as e:
+            # Names are allowed, too.
+            if not isinstance(client, str):
+                raise e
+
+        if self._server_calls:
+            response = await self._wait_for_call(f"$GETCLT$ {client}".encode())
+        else:
+            await self.send_raw(f"$GETCLT$ {client}")
+            response = await self.recv()
+        return self._get_client_response(client, response)
+
+    def close(self, emit_leave: bool = True):
+        """
+        Closes the client; the messages that weren't sent yet are still
+        sent before the connection is closed.
+
+        :param emit_leave: Decides if the client will emit `leave` to the server or not
+        :type emit_leave: bool
+        """
+
+        if self.closed:
+            return
+
+        self.closed = True
+        if emit_leave:
+            self._write(b"$USRCLOSE$")
+        self._write_coalesced()
+        self._writer.close()
+        self._calls.close(ClientException("The client was closed."))
+        self._end_file_transfers(ClientException("The client was closed."))
+        if self._owns_handler_pool:
+            self.handler_pool.shutdown(wait=False)
+
+
+async def async_connect(
+    addr,
+    name=None,
+    group=None,
+    header_len=16,
+    cache_size=-1,
+    binary_header=True,
+):
+    """
+    Creates an :class:`AsyncHiSockClient` instance and connects it to the server.
+    See :class:`AsyncHiSockClient` and :func:`connect` for more details.
+
+    :return: A connected :class:`AsyncHiSockClient` instance.
+    """
+
+    client = AsyncHiSockClient(addr, name, group, header_len, cache_size, binary_header)
+    await client.start()
+
+    return client
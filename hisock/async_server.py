@@ -0,0 +1,486 @@
+"""
+This module contains the AsyncHiSockServer, a :class:`HiSockServer` that runs
+on an :mod:`asyncio` event loop instead of its own ``run`` loop, but also
+contains a `start_async_server` function, to pass in things automatically.
+
+====================================
+Copyright SSS_Says_Snek 2021-present
+====================================
+"""
+
+# Imports
+from __future__ import annotations  # Remove when 3.10 is used by majority
+
+import asyncio  # Event loop
+import functools  # Pass arguments to executor functions
+import inspect  # Coroutine function detection
+import threading  # Thread-safe sending
+import pathlib  # Type hints
+import warnings  # Non-severe errors
+from collections import deque  # Files being sent
+from concurrent.futures import Executor  # Process pool type hint
+from typing import Callable, Union  # Type hints
+
+try:
+    # Pip builds require relative import
+    from .server import HiSockServer
+    from .utils import (
+        _FrameReader,
+        _FILE_MESSAGES,
+        _done_future,
+        _PendingCalls,
+        ClientRecord,
+        ClientNotFound,
+        File,
+        ServerException,
+        _frame_buffers,
+        HandlerPool,
+        Journal,
+        HandlerPoolFull,
+    )
+except ImportError:
+    # Relative import doesn't work for non-pip builds
+    from server import HiSockServer
+    from utils import (
+        _FrameReader,
+        _FILE_MESSAGES,
+        _done_future,
+        _PendingCalls,
+        ClientRecord,
+        ClientNotFound,
+        File,
+        ServerException,
+        _frame_buffers,
+        HandlerPool,
+        Journal,
+        HandlerPoolFull,
+    )
+
+
+class _AsyncConnection(asyncio.Protocol):
+    """
+    The protocol of one client connected to an :class:`AsyncHiSockServer`.
+
+    It is also used by the server in place of a client socket, so it provides
+    the socket methods :class:`HiSockServer` uses.
+    """
+
+    def __init__(self, server: AsyncHiSockServer):
+        self.server = server
+        self.transport = None
+        self.address = None
+
+        self._client_info = None
+        self._frame_reader = _FrameReader(server.header_len)
+        self._received_hello = False
+        # Files are only sent while the transport's buffer is below the high
+        # watermark, a chunk per callback
+        self._writing_paused = False
+        self._file_chunk_scheduled = False
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        self.address = transport.get_extra_info("peername")[:2]
+        self._client_info = ClientRecord(self.address, frame_reader=self._frame_reader)
+        self.server._connections[self] = self._client_info
+        transport.set_write_buffer_limits(
+            self.server.send_high_watermark, self.server.send_low_watermark
+        )
+        # asyncio turns TCP_NODELAY on by itself
+        self.server._tune_socket(transport.get_extra_info("socket"))
+
+    # The transport buffers what can't be sent right away, and tells when its
+    # buffer goes above the high watermark and back down to the low watermark
+
+    def pause_writing(self):
+        self._writing_paused = True
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self._writing_paused = False
+        self.transport.resume_reading()
+        self.schedule_file_chunk()
+
+    def schedule_file_chunk(self):
+        """Schedules sending the next chunk of the files being sent, if there are any"""
+
+        if (
+            self._file_chunk_scheduled
+            or self._writing_paused
+            or not self._client_info.files_sending
+        ):
+            return
+
+        self._file_chunk_scheduled = True
+        self.server._loop.call_soon(self._send_file_chunk)
+
+    def _send_file_chunk(self):
+        self._file_chunk_scheduled = False
+        if self._writing_paused:
+            return
+
+        self.server._send_file_chunk(self)
+        self.schedule_file_chunk()
+
+    def data_received(self, data: bytes):
+        self._frame_reader.feed(data)
+
+        for message in self._frame_reader.frames():
+            # The first message is always the client hello
+            if not self._received_hello:
+                self._received_hello = True
+                self.server._client_hello(self, message["data"])
+                continue
+
+            self._client_info.messages_received += 1
+            self.server._handle_message(self, message)
+
+            # The client disconnected, the rest of its messages are dropped
+            if self not in self.server.clients:
+                break
+
+    def connection_lost(self, exc: Union[Exception, None]):
+        if self in self.server.clients:
+            self.server._client_disconnection(self)
+            return
+
+        self.server._forget_connection(self)
+
+    # Socket methods
+
+    def send(self, buffers: list):
+        # Handlers running in an executor can send too, but transports
+        # may only be used from the event loop thread
+        if threading.get_ident() == self.server._loop_thread_id:
+            self._write(buffers)
+            return
+
+        self.server._loop.call_soon_threadsafe(self._write, buffers)
+
+    def _write(self, buffers: list):
+        # The messages written in one iteration of the event loop are written
+        # together once it's done
+        if self.server.coalesce_writes:
+            client_info = self._client_info
+            if client_info.coalesced is None:
+                client_info.coalesced = []
+                self.server._loop.call_soon(self._write_coalesced)
+            client_info.coalesced.extend(buffers)
+            return
+
+        self._write_now(buffers)
+
+    def _write_coalesced(self):
+        client_info = self._client_info
+        if client_info.coalesced is None:
+            return
+
+        buffers, client_info.coalesced = client_info.coalesced, None
+        if not self.transport.is_closing():
+            self._write_now(buffers)
+
+    def _write_now(self, buffers: list):
+        # Sent with `sendmsg` by the transports that have it
+        self.transport.writelines(buffers)
+
+        # The client is too slow to keep up. It's disconnected after the current
+        # callback, which could be going through the clients
+        if self.transport.get_write_buffer_size() > self.server.send_buffer_limit:
+            self.server._loop.call_soon(self._disconnect_slow_client)
+
+    def _disconnect_slow_client(self):
+        if self not in self.server.clients:
+            return
+
+        warnings.warn(
+            f"Disconnecting {self.address}: more than "
+            f"{self.server.send_buffer_limit} bytes are waiting to be sent to it.",
+            UserWarning,
+        )
+        self.server._client_disconnection(self)
+
+    def close(self):
+        # What was coalesced is still sent, like a disconnection message
+        self._write_coalesced()
+        self.transport.close()
+
+    def getpeername(self) -> tuple[str, int]:
+        return self.address
+
+
+class AsyncHiSockServer(HiSockServer):
+    """
+    A downside of :class:`HiSockServer` is that :meth:`HiSockServer.run` has to
+    be called in its own loop (or thread). :class:`AsyncHiSockServer` serves its
+    clients on an :mod:`asyncio` event loop instead, so it can share the loop
+    with other :mod:`asyncio` code, and thousands of clients can be served
+    without a thread for each of them.
+
+    Functions registered with :meth:`on` work the same way as they do with
+    :class:`HiSockServer`, and they can also be coroutine functions
+    (``async def``), which are run as tasks on the event loop.
+    Threaded functions are run in :attr:`handler_pool` through the event loop.
+
+    .. note::
+        For documentation, see :class:`HiSockServer`. ``blocking`` and
+        ``selector_class`` aren't used, as the event loop waits for the clients.
+
+    .. code-block:: python
+       server = AsyncHiSockServer(("127.0.0.1", 6969))
+
+       @server.on("ping")
+       async def on_ping(client_data: dict):
+           server.send_client(client_data["ip"], "pong")
+
+       asyncio.run(server.start())
+    """
+
+    def __init__(
+        self,
+        addr: tuple[str, int],
+        max_connections: int = 0,
+        header_len: int = 16,
+        cache_size: int = -1,
+        keepalive: bool = True,
+        binary_header: bool = True,
+        handler_pool: HandlerPool = None,
+        process_pool: Executor = None,
+        send_high_watermark: int = 1 << 20,
+        send_low_watermark: int = 1 << 18,
+        send_buffer_limit: int = 1 << 24,
+        cache_max_bytes: int = 0,
+        journal: Journal = None,
+        compression: Union[str, tuple] = None,
+        compression_threshold: int = 1024,
+        download_dir: Union[str, pathlib.Path] = None,
+        file_progress: Callable = None,
+        tcp_nodelay: bool = None,
+        tcp_cork: bool = False,
+        send_buffer_size: int = None,
+        receive_buffer_size: int = None,
+        coalesce_writes: bool = False,
+    ):
+        super().__init__(
+            addr,
+            max_connections=max_connections,
+            header_len=header_len,
+            cache_size=cache_size,
+            keepalive=keepalive,
+            binary_header=binary_header,
+            handler_pool=handler_pool,
+            process_pool=process_pool,
+            send_high_watermark=send_high_watermark,
+            send_low_watermark=send_low_watermark,
+            send_buffer_limit=send_buffer_limit,
+            cache_max_bytes=cache_max_bytes,
+            journal=journal,
+            compression=compression,
+            compression_threshold=compression_threshold,
+            download_dir=download_dir,
+            file_progress=file_progress,
+            tcp_nodelay=tcp_nodelay,
+            tcp_cork=tcp_cork,
+            send_buffer_size=send_buffer_size,
+            receive_buffer_size=receive_buffer_size,
+            coalesce_writes=coalesce_writes,
+        )
+
+        self._loop = None
+        self._loop_thread_id = None
+        self._server = None
+        self._keepalive_task = None
+        # There's no `run` loop to check the timeouts of calls, a thread does
+        self._calls = _PendingCalls()
+
+    def __str__(self):
+        """Example: <AsyncHiSockServer serving at 192.168.1.133:5000>"""
+
+        return f"<AsyncHiSockServer serving at {':'.join(map(str, self.addr))}>"
+
+    # Internal methods
+
+    def _create_socket(
+        self, blocking: bool, max_connections: int, selector_class: type
+    ):
+        # The socket is created by the event loop in `start`
+        self.sock = None
+        self._max_connections = max_connections
+
+    def _close_client_socket(self, client_socket: _AsyncConnection):
+        client_socket.close()
+
+    def _send_to_socket(self, client_socket: _AsyncConnection, *buffers: bytes):
+        client_info = self._connections.get(client_socket)
+        # Disconnected
+        if client_info is None:
+            return
+
+        # The transport has its own send buffer
+        client_info.messages_sent += 1
+        if (
+            self.journal is not None
+            and self.journal.record_sent
+            and not buffers[0].startswith(_FILE_MESSAGES)
+        ):
+            self.journal.append(b"".join(buffers), client_info, sent=True)
+        frame_reader = client_info.frame_reader
+        client_socket.send(
+            _frame_buffers(
+                buffers,
+                self.header_len,
+                frame_reader.binary_header,
+                frame_reader.codec,
+                self.compression_threshold,
+            )
+        )
+
+    def _queue_file(self, client_socket: _AsyncConnection, file: File):
+        client_info = self._connections.get(client_socket)
+        # Disconnected in the meantime
+        if client_info is None:
+            file._finish(ClientNotFound("The client disconnected."))
+            return
+
+        if client_info.files_sending is None:
+            client_info.files_sending = deque()
+        client_info.files_sending.append(file)
+        client_socket.schedule_file_chunk()
+
+    def _write_file_chunk(
+        self,
+        client_socket: _AsyncConnection,
+        client_info: ClientRecord,
+        file: File,
+        prefix: bytes,
+        offset: int,
+        count: int,
+    ) -> bool:
+        # Transports can't send from a file (`loop.sendfile` holds back every
+        # other message until the file is sent), so the chunk is read
+        self._send_to_socket(client_socket, prefix, file._read(offset, count))
+        file._sent(count)
+        return True
+
+    def _call_in_reactor(self, callback: Callable, *args):
+        self._loop.call_soon_threadsafe(callback, *args)
+
+    def _start_keepalive(self):
+        # There's no event loop yet, the keepalive task is started in `start`
+        pass
+
+    async def _keepalive_coroutine(self):
+        """The keepalive task, see :meth:`HiSockServer._keepalive_thread`"""
+
+        while not self.closed:
+            await asyncio.sleep(30)
+
+            # Send keepalive to all clients
+            for client, client_info in list(self.clients.items()):
+                client_info.keepalive_pending = True
+                self._send_to_socket(client, b"$KEEPALIVE$")
+
+            # Keepalive acknowledgments will be handled in `_handle_keepalive`
+            await asyncio.sleep(30)
+
+            # Keepalive response wait is over, remove the unresponsive clients
+            for client, client_info in list(self.clients.items()):
+                if client_info.keepalive_pending:
+                    self._drop_client(client)
+
+    def _run_function(self, func: dict, *args, reply: Callable = None, **kwargs):
+        # Coroutine function
+        if inspect.iscoroutinefunction(func["func"]):
+            task = self._loop.create_task(func["func"](*args, **kwargs))
+            if reply is not None:
+                task.add_done_callback(reply)
+            return
+
+        # Normal
+        if not func["threaded"]:
+            if reply is None:
+                func["func"](*args, **kwargs)
+                return
+
+            # The exception is raised by the caller instead
+            try:
+                result = func["func"](*args, **kwargs)
+            except Exception as e:
+                reply(_done_future(exception=e))
+                return
+            reply(_done_future(result))
+            return
+
+        # Threaded
+        try:
+            future = self._loop.run_in_executor(
+                self.handler_pool, functools.partial(func["func"], *args, **kwargs)
+            )
+        except HandlerPoolFull as e:
+            warnings.warn(f"{func['name']} was not run: {e}", UserWarning)
+            if reply is not None:
+                reply(_done_future(exception=e))
+            return
+
+        if reply is not None:
+            future.add_done_callback(reply)
+
+    # Running
+
+    async def start(self):
+        """
+        Starts serving clients on the running event loop, and waits until
+        the server is closed with :meth:`close`.
+        """
+
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._run_thread_id = self._loop_thread_id
+        self._server = await self._loop.create_server(
+            lambda: _AsyncConnection(self),
+            *self.addr,
+            backlog=self._max_connections or 100,
+        )
+        # The port is chosen by the OS if it was 0
+        self.addr = self._server.sockets[0].getsockname()[:2]
+
+        if self.keepalive:
+            self._keepalive_task = self._loop.create_task(self._keepalive_coroutine())
+
+        try:
+            await self._server.serve_forever()
+        except asyncio.CancelledError:
+            # Closed by `close`
+            pass
+
+    def close(self):
+        """
+        Closes the server; ALL clients will be disconnected, then the
+        server will stop serving, and :meth:`start` will return.
+        """
+
+        self.closed = True
+        self._keepalive_event.set()
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+
+        self.disconnect_all_clients()
+        self._calls.close(ServerException("The server was closed."))
+        if self._server is not None:
+            self._server.close()
+        if self._owns_handler_pool:
+            self.handler_pool.shutdown(wait=False)
+        if self._owns_process_pool and self.process_pool is not None:
+            self.process_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def start_async_server(addr, max_connections=0, header_len=16, binary_header=True):
+    """
+    Creates a :class:`AsyncHiSockServer` instance. See :class:`AsyncHiSockServer`
+    and :class:`HiSockServer` for more details and documentation.
+
+    :return: A :class:`AsyncHiSockServer` instance.
+    """
+
+    return AsyncHiSockServer(
+        addr, max_connections, header_len, binary_header=binary_header
+    )
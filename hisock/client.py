@@ -14,13 +14,19 @@ Copyright SSS_Says_Snek, 2021-present
 from __future__ import annotations  # Remove when 3.10 is used by majority
 
 import socket
+import pathlib  # Type hints
+import base64  # Receive the compression dictionary in the server hello
+import select  # Wait for replies to calls
 import inspect  # Type-hinting detection for type casting
+import itertools  # File transfer IDs
 import json  # Handle sending dictionaries
 import errno  # Handle fatal errors with the server
 import warnings  # Non-severe errors
 import sys  # Utilize stderr
+import tempfile  # Default directory of received files
 import threading  # Threaded client and decorators
 import traceback  # Error handling
+from concurrent.futures import wait  # Wait for replies received by another thread
 from typing import Callable, Union, Any  # Type hints
 from ipaddress import IPv4Address  # Comparisons
 from time import time  # Unix timestamp support
@@ -35,11 +41,35 @@ try:
         FunctionNotFoundWarning,
         ServerNotRunning,
         MessageCacheMember,
+        MessageCache,
+        Journal,
         Sendable,
         Client,
         _removeprefix,
         _type_cast,
         _str_type_to_type_annotations_dict,
+        _FrameReader,
+        _compression_codecs,
+        _dictionary_codec,
+        _CODECS,
+        _DICTIONARY_CODEC,
+        _Mailbox,
+        _PendingCalls,
+        CallFuture,
+        _make_reply,
+        _parse_reply,
+        _done_future,
+        File,
+        _FileReceiver,
+        _FILE_MESSAGES,
+        _parse_file_ack,
+        _make_length_header,
+        _command_prefix,
+        _frame_buffers,
+        _send_all_buffers,
+        _set_socket_options,
+        HandlerPool,
+        HandlerPoolFull,
         make_header,
         iptup_to_str,
         validate_ipv4,
@@ -55,11 +85,35 @@ except ImportError:
         FunctionNotFoundWarning,
         ServerNotRunning,
         MessageCacheMember,
+        MessageCache,
+        Journal,
         Sendable,
         Client,
         _removeprefix,
         _type_cast,
         _str_type_to_type_annotations_dict,
+        _FrameReader,
+        _compression_codecs,
+        _dictionary_codec,
+        _CODECS,
+        _DICTIONARY_CODEC,
+        _Mailbox,
+        _PendingCalls,
+        CallFuture,
+        _make_reply,
+        _parse_reply,
+        _done_future,
+        File,
+        _FileReceiver,
+        _FILE_MESSAGES,
+        _parse_file_ack,
+        _make_length_header,
+        _command_prefix,
+        _frame_buffers,
+        _send_all_buffers,
+        _set_socket_options,
+        HandlerPool,
+        HandlerPoolFull,
         make_header,
         iptup_to_str,
         validate_ipv4,
@@ -109,16 +163,90 @@ class HiSockClient:
         (hard to debug too!).
         Default sets to 16 (maximum length of content: 10 quadrillion bytes).
     :type header_len: int, optional
+    :param cache_size: The number of messages to cache, see :meth:`get_cache`.
+        0 or less doesn't cache any messages.
+        Default is -1.
+    :type cache_size: int, optional
+    :param binary_header: A boolean set to whether the client should ask the server
+        to use a compact 4-byte binary length prefix instead of the padded ASCII
+        header. The ASCII header is still used if the server doesn't allow it.
+        Older servers don't know about this request, so pass in False to connect
+        to them; the client hello is then sent the way they expect it.
+        Default is True.
+    :type binary_header: bool, optional
+    :param handler_pool: The pool of worker threads that runs the functions
+        registered with ``threaded=True``.
+        Default is None (a :class:`HandlerPool` with its default limits).
+    :type handler_pool: HandlerPool, optional
+    :param cache_max_bytes: The number of bytes the cached messages may take,
+        after which the oldest ones are evicted. 0 means no limit.
+        Default is 0.
+    :type cache_max_bytes: int, optional
+    :param journal: The journal every received frame is appended to (and every
+        sent one, if the journal records them), see :meth:`replay_journal`.
+        It isn't closed by the client.
+        Default is None (no journal).
+    :type journal: Journal, optional
+    :param compression: The codecs the client can decompress frames with, and
+        compress the frames it sends with, in order of preference: ``"zlib"``, or
+        ``"lz4"`` or ``"zstd"`` if they're installed, or ``"zlib-dict"`` to use the
+        dictionary the server sends in the hello. The server picks one of them
+        in the hello, if it compresses frames at all. Compression needs the
+        binary header.
+        Default is None (no compression).
+    :type compression: Union[str, tuple[str, ...]], optional
+    :param compression_threshold: The number of bytes from which frames are
+        compressed, as smaller ones don't get much smaller.
+        Default is 1 KiB.
+    :type compression_threshold: int, optional
+    :param download_dir: The directory the files the server sends with
+        :meth:`HiSockServer.send_file` are written into.
+        Transfers that were cut off are resumed from what's in it.
+        Default is None (a new temporary directory).
+    :type download_dir: Union[str, pathlib.Path], optional
+    :param file_progress: Called with the :class:`File` whenever a chunk of a
+        file the server sends is received.
+        Default is None.
+    :type file_progress: Callable[[File], None], optional
+    :param tcp_nodelay: Whether small messages are sent right away (True, for
+        latency, like in games), or held back until the ones before them are
+        acknowledged, so they're sent in fewer packets (False, Nagle's algorithm).
+        Default is None (the OS default, which is False).
+    :type tcp_nodelay: bool, optional
+    :param tcp_cork: Whether only full packets are sent (for throughput), holding
+        back what doesn't fill one for up to 200 ms, so it delays calls and
+        replies that are waited for. Only Linux has it.
+        Default is False.
+    :type tcp_cork: bool, optional
+    :param send_buffer_size: The size of the send buffer the OS keeps for the
+        socket (``SO_SNDBUF``).
+        Default is None (the OS default).
+    :type send_buffer_size: int, optional
+    :param receive_buffer_size: The size of the receive buffer the OS keeps for
+        the socket (``SO_RCVBUF``).
+        Default is None (the OS default).
+    :type receive_buffer_size: int, optional
+    :param coalesce_writes: Whether the messages sent while :meth:`update`
+        handles what it received (like by the functions registered with
+        :meth:`on`) are sent together once it's done, with one system call
+        instead of one for every message. Messages sent from other threads are
+        still sent right away.
+        Default is False.
+    :type coalesce_writes: bool, optional
 
     :ivar tuple addr: A two-element tuple containing the IP address and the
         port number of the server.
     :ivar int header_len: An integer storing the header length of each "message".
+    :ivar bool binary_header: A boolean storing if the binary header is used
+        (after negotiating it with the server).
     :ivar str name: A string representing the name of the client to identify by.
         Default is None.
     :ivar str group: A string representing the group of the client to identify by.
         Default is None.
     :ivar dict funcs: A list of functions registered with decorator :meth:`on`.
         **This is mainly used for under-the-hood-code.**
+    :ivar HandlerPool handler_pool: The pool that runs the threaded functions,
+        see :meth:`HandlerPool.metrics` for its metrics.
     :ivar int connect_time: An integer sotring the Unix timestamp of when the
         client connected to the server.
     """
@@ -131,24 +259,44 @@ class HiSockClient:
         blocking: bool = True,
         header_len: int = 16,
         cache_size: int = -1,
+        binary_header: bool = True,
+        handler_pool: HandlerPool = None,
+        cache_max_bytes: int = 0,
+        journal: Journal = None,
+        compression: Union[str, tuple] = None,
+        compression_threshold: int = 1024,
+        download_dir: Union[str, pathlib.Path] = None,
+        file_progress: Callable = None,
+        tcp_nodelay: bool = None,
+        tcp_cork: bool = False,
+        send_buffer_size: int = None,
+        receive_buffer_size: int = None,
+        coalesce_writes: bool = False,
     ):
         self.addr = addr
         self.name = name
         self.group = group
         self.header_len = header_len
-
-        # Socket initialization
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        try:
-            self.sock.connect(self.addr)
-        except ConnectionRefusedError:
-            raise ServerNotRunning(
-                "Server is not running! Aborting..."
-            ) from ConnectionRefusedError
+        # Only turned on once the server agrees to it in the server hello
+        self.binary_header = False
+        self._frame_reader = _FrameReader(header_len)
+        # The codecs to offer, the server picks one of them (if any)
+        self.compression = _compression_codecs(compression)
+        self.compression_threshold = compression_threshold
+        # The version of the server's dictionary, if "zlib-dict" is used
+        self.compression_dictionary_version = None
 
         # Function related storage
-        # {"command": {"func": Callable, "name": str, "type_hint": Any, "threaded": bool}}
+        # {"command": {"func": Callable, "name": str, "type_hint": Any,
+        #              "threaded": bool, "invoke": Callable}}
         self.funcs = {}
+        # Unreserved commands and the invoker of their function, to dispatch
+        # messages with one lookup
+        # {"command": Callable[[content], None]}
+        self._dispatch = {}
+        # Runs the threaded functions, it's shut down on close if it was created here
+        self._owns_handler_pool = handler_pool is None
+        self.handler_pool = handler_pool if handler_pool is not None else HandlerPool()
         # Stores the names of the reserved functions
         # Used for the `on` decorator
         self._reserved_functions = (
@@ -166,26 +314,52 @@ class HiSockClient:
 
         # Cache
         self.cache_size = cache_size
-        if cache_size > 0:
-            # cache_size <= 0: No cache
-            self.cache = []
+        # cache_size <= 0: No cache
+        self.cache = (
+            MessageCache(cache_size, cache_max_bytes) if cache_size > 0 else None
+        )
+        self.journal = journal
 
         # TLS arguments
         self.tls_arguments = {"tls": False}  # If TLS is false, then no TLS
 
         # Flags
         self.closed = False
-        # If `update` is trying to receive while `recv_raw` is running, bad things happen.
-        self._receiving_data = False
-        # The data received by `update if this is set to `I NEED YOUR DATA`... see
-        # `update` and `recv_raw` for info
-        self._recv_data = ""
+        # `update` and `recv_raw` can run on different threads. Only the one
+        # holding the lock receives, and `update` hands the messages that
+        # `recv_raw` waits for over through the mailbox
+        self._receive_lock = threading.RLock()
+        self._mailbox = _Mailbox()
+        # The calls waiting for their reply, see `call`. Only used if the
+        # server supports calls, which it says in the server hello
+        self._calls = _PendingCalls()
+        self._server_calls = False
+        # Files, see `send_file`. The receiver is created with the first file
+        self.download_dir = download_dir
+        self.file_progress = file_progress
+        self._file_receiver = None
+        self._file_ids = itertools.count(1)
+        # The futures of the acknowledgments the server sends for the start and
+        # the end of a file, by transfer ID
+        self._file_acks = {}
+        self._server_files = False
+        # Keeps the messages sent from different threads (like the chunks of
+        # files) from getting mixed up
+        self._send_lock = threading.Lock()
+        self.tcp_nodelay = tcp_nodelay
+        self.tcp_cork = tcp_cork
+        self.send_buffer_size = send_buffer_size
+        self.receive_buffer_size = receive_buffer_size
+        self.coalesce_writes = coalesce_writes
+        # The messages sent while `update` handles messages, on the thread
+        # running it, None otherwise
+        self._coalesced = None
+        self._coalescing_thread = None
         self.connected = False
         self.connect_time = 0  # Unix timestamp
-        self.sock.setblocking(blocking)
 
-        # Send client hello
-        self._send_client_hello()
+        # Socket initialization
+        self._connect(blocking, binary_header)
 
     def __str__(self) -> str:
         """Example: <HiSockClient connected to 192.168.1.133:5000>"""
@@ -252,9 +426,46 @@ class HiSockClient:
 
     # Internal methods
 
-    def _send_client_hello(self):
+    def _connect(self, blocking: bool, binary_header: bool):
         """
-        Sends a hello to the server for the first connection
+        Connects the socket to the server and sends the client hello
+
+        :param blocking: Whether the socket should block after the hello
+        :type blocking: bool
+        :param binary_header: Whether to ask for the binary header
+        :type binary_header: bool
+
+        :raises ServerNotRunning: If the server refused the connection
+        """
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # The buffer sizes have to be set before connecting to take full effect
+        _set_socket_options(
+            self.sock,
+            self.tcp_nodelay,
+            self.tcp_cork,
+            self.send_buffer_size,
+            self.receive_buffer_size,
+        )
+        self._recv_buffer = memoryview(bytearray(self._frame_reader.recv_size))
+        try:
+            self.sock.connect(self.addr)
+        except ConnectionRefusedError:
+            raise ServerNotRunning(
+                "Server is not running! Aborting..."
+            ) from ConnectionRefusedError
+
+        self._send_client_hello(binary_header)
+        self.sock.setblocking(blocking)
+
+    def _client_hello(self, binary_header: bool) -> str:
+        """
+        Creates the hello sent to the server for the first connection
+
+        :param binary_header: Whether to ask for the binary header
+        :type binary_header: bool
+        :return: The client hello
+        :rtype: str
 
         :raises ClientException: If the client is already connected
         """
@@ -264,12 +475,138 @@ class HiSockClient:
                 f"Client is already connected! (connected {time() - self.connect_time} seconds ago)"
             )
 
-        hello_dict = {"name": self.name, "group": self.group}
-        self.send_raw(f"$CLTHELLO$ {json.dumps(hello_dict)}")
+        # The client always replies to calls from the server, and receives files
+        hello_dict = {
+            "name": self.name,
+            "group": self.group,
+            "calls": True,
+            "files": True,
+        }
+        # Servers only answer with a server hello when asked for the binary header,
+        # which older servers never do
+        if binary_header:
+            hello_dict["binary_header"] = True
+            if self.compression:
+                hello_dict["compression"] = list(self.compression)
+        return f"$CLTHELLO$ {json.dumps(hello_dict)}"
+
+    def _send_client_hello(self, binary_header: bool):
+        """
+        Sends a hello to the server for the first connection, and negotiates
+        the header with the server hello it answers with if the binary header
+        was asked for
+
+        :param binary_header: Whether to ask for the binary header
+        :type binary_header: bool
+
+        :raises ClientException: If the client is already connected
+        :raises ServerException: If the server didn't answer with a server hello
+        """
+
+        self.send_raw(self._client_hello(binary_header))
+        if not binary_header:
+            self._hello_done()
+            return
+
+        # The server hello is always sent with the ASCII header. Anything the server
+        # sends after it stays buffered in the frame reader for `update`
+        server_hello = self._frame_reader.next_frame()
+        while server_hello is None:
+            if not self._frame_reader.recv(self.sock, self._recv_buffer):
+                raise ServerException("Server closed the connection during the hello.")
+            server_hello = self._frame_reader.next_frame()
+
+        self._server_hello(server_hello["data"])
+
+    def _server_hello(self, server_hello: bytes):
+        """
+        Negotiates the header with the hello the server answered with
+
+        :param server_hello: The server hello
+        :type server_hello: bytes
+
+        :raises ServerException: If the server didn't answer with a server hello
+        """
+
+        if not server_hello.startswith(b"$SRVHELLO$"):
+            raise ServerException("Server did not answer the client hello.")
+        server_hello = json.loads(_removeprefix(server_hello, b"$SRVHELLO$ "))
+        self.binary_header = server_hello["binary_header"]
+        self._frame_reader.binary_header = self.binary_header
+        self._server_calls = server_hello.get("calls", False)
+        self._server_files = server_hello.get("files", False)
+        codec = server_hello.get("compression")
+        if codec == _DICTIONARY_CODEC:
+            dictionary = server_hello["dictionary"]
+            self.compression_dictionary_version = dictionary["version"]
+            codec = _dictionary_codec(base64.b64decode(dictionary["data"]))
+        elif codec is not None:
+            codec = _CODECS[codec]
+        self._frame_reader.codec = codec
+
+        self._hello_done()
+
+    def _hello_done(self):
+        """Marks the client as connected, once the hello is done"""
 
         self.connected = True
         self.connect_time = time()
 
+    def _write(self, *buffers: bytes):
+        """
+        Sends a message to the server. The message can be in several pieces
+        (like the command and the content), which are sent with one system
+        call instead of being joined.
+
+        With ``coalesce_writes``, what :meth:`update` sends while it handles
+        messages is sent once it's done, see :meth:`_write_coalesced`.
+
+        :param buffers: The pieces of the message
+        :type buffers: bytes
+        """
+
+        # Files aren't journaled, see `send_file`
+        if (
+            self.journal is not None
+            and self.journal.record_sent
+            and not buffers[0].startswith(_FILE_MESSAGES)
+        ):
+            self.journal.append(b"".join(buffers), sent=True)
+        buffers = _frame_buffers(
+            buffers,
+            self.header_len,
+            self.binary_header,
+            self._frame_reader.codec,
+            self.compression_threshold,
+        )
+        if (
+            self._coalesced is not None
+            and threading.get_ident() == self._coalescing_thread
+        ):
+            self._coalesced.extend(buffers)
+            return
+
+        with self._send_lock:
+            _send_all_buffers(self.sock, buffers)
+
+    def _write_coalesced(self):
+        """
+        Sends the messages :meth:`update` coalesced so far, with one system
+        call, see ``coalesce_writes``. Only the thread running :meth:`update`
+        sends them, other threads don't have any.
+        """
+
+        if (
+            not self._coalesced
+            or threading.get_ident() != self._coalescing_thread
+            or self.closed
+        ):
+            return
+
+        buffers, self._coalesced = self._coalesced, []
+        with self._send_lock:
+            _send_all_buffers(self.sock, buffers)
+
     def _handle_keepalive(self):
         """Handle a keepalive sent from the server."""
 
@@ -327,19 +664,75 @@ class HiSockClient:
                 )
             func = func_name
 
+        self._run_function(self.funcs[func], *args, **kwargs)
+
+    def _run_function(self, func: dict, *args, reply: Callable = None, **kwargs):
+        """
+        Runs a function registered with :meth:`on`, in :attr:`handler_pool` if it's
+        threaded.
+
+        :param func: The function data stored in :attr:`funcs`
+        :type func: dict
+        :param args: The arguments to pass to the function.
+        :param reply: Called with the future of the result of the function, when
+            the function was called by the server (see :meth:`_handle_call`)
+        :type reply: Callable[[Future], None], optional
+        :param kwargs: The keyword arguments to pass to the function.
+        """
+
         # Normal
-        if not self.funcs[func]["threaded"]:
-            self.funcs[func]["func"](*args, **kwargs)
+        if not func["threaded"]:
+            if reply is None:
+                func["func"](*args, **kwargs)
+                return
+
+            # The exception is raised by the server instead
+            try:
+                result = func["func"](*args, **kwargs)
+            except Exception as e:
+                reply(_done_future(exception=e))
+                return
+            reply(_done_future(result))
             return
 
         # Threaded
-        function_thread = threading.Thread(
-            target=self.funcs[func]["func"],
-            args=args,
-            kwargs=kwargs,
-            daemon=True,
-        )
-        function_thread.start()
+        try:
+            future = self.handler_pool.submit(func["func"], *args, **kwargs)
+        except HandlerPoolFull as e:
+            warnings.warn(f"{func['name']} was not run: {e}", UserWarning)
+            if reply is not None:
+                reply(_done_future(exception=e))
+            return
+
+        if reply is not None:
+            future.add_done_callback(reply)
+
+    def _make_invoker(self, func: dict, number_of_func_args: int) -> Callable:
+        """
+        Prepares a function registered with :meth:`on` to be called for a message,
+        so the arguments to pass and the type cast are only resolved once.
+
+        :param func: The function data stored in :attr:`funcs`
+        :type func: dict
+        :param number_of_func_args: The number of arguments the function takes
+        :type number_of_func_args: int
+        :return: The invoker, which is called with the content of the message
+            and, for calls, the reply callback of :meth:`_run_function`
+        :rtype: Callable[[bytes, Optional[Callable]], None]
+        """
+
+        # No type hint: the content is passed in as a string
+        type_cast = func["type_hint"].get("message", str)
+
+        if number_of_func_args == 0:
+            return lambda content, reply=None: self._run_function(func, reply=reply)
+
+        def invoke(content: bytes, reply: Callable = None):
+            self._run_function(
+                func, _type_cast(type_cast, content, func["name"]), reply=reply
+            )
+
+        return invoke
 
     class _on:
         """Decorator used to handle something when receiving command"""
@@ -362,16 +755,22 @@ class HiSockClient:
             # Overriding a reserved command, remove it from reserved functions
             if self.override:
                 if self.command in self.outer._reserved_functions:
-                    self.outer.funcs.pop(self.command)
+                    self.outer.funcs.pop(self.command, None)
+
+                    index = self.outer._reserved_functions.index(self.command)
+                    self.outer._reserved_functions = (
+                        self.outer._reserved_functions[:index]
+                        + self.outer._reserved_functions[index + 1 :]
+                    )
+                    self.outer._reserved_functions_parameters_num = (
+                        self.outer._reserved_functions_parameters_num[:index]
+                        + self.outer._reserved_functions_parameters_num[index + 1 :]
+                    )
                 else:
                     warnings.warn(
                         f"Unnecessary override for {self.command}.", UserWarning
                     )
 
-                index = self.outer._reserved_functions.index(self.command)
-                self.outer._reserved_functions.pop(index)
-                self.outer._reserved_functions_parameters_num.pop(index)
-
             self._assert_num_func_args_valid(len(func_args))
 
             annotations = _str_type_to_type_annotations_dict(
@@ -390,16 +789,18 @@ class HiSockClient:
                         continue
                     parameter_annotations[argument_name] = annotations[func_argument]
 
-            # DEBUG PRINT PLEASE REMOVE LATER
-            print(f"{self.command=} {parameter_annotations=}")
-
             # Add function
-            self.outer.funcs[self.command] = {
+            func_data = {
                 "func": func,
                 "name": func.__name__,
                 "type_hint": parameter_annotations,
                 "threaded": self.threaded,
             }
+            func_data["invoke"] = self.outer._make_invoker(func_data, len(func_args))
+            self.outer.funcs[self.command] = func_data
+
+            if self.command not in self.outer._reserved_functions:
+                self.outer._dispatch[self.command] = func_data["invoke"]
 
             # Decorator stuff
             return func
@@ -469,14 +870,15 @@ class HiSockClient:
         - ``None``
         - ``list`` (with the types listed here)
         - ``dict`` (with the types listed here)
+        - ``File`` (for files sent with :meth:`HiSockServer.send_file`)
 
         For more information, read the wiki for type casting.
 
         :param command: A string, representing the command the function should activate
             when receiving it.
         :type command: str
-        :param threaded: A boolean, representing if the function should be run in a thread
-            in order to not block the update() loop.
+        :param threaded: A boolean, representing if the function should be run in
+            :attr:`handler_pool` in order to not block the update() loop.
             Default is False.
         :type threaded: bool, optional
         :param override: A boolean representing if the function should override the
@@ -494,22 +896,35 @@ class HiSockClient:
     def get_cache(
         self,
         idx: Union[int, slice, None] = None,
+        command: str = None,
+        since: float = None,
+        until: float = None,
     ) -> list[MessageCacheMember]:
         """
-        Gets the message cache.
+        Gets the cached messages that match all the given filters, oldest first.
+        The filters use the indexes of the cache, so they don't go through
+        every cached message.
 
-        :param idx: An integer or ``slice``, specifying what specific message caches to return.
+        :param idx: An integer or ``slice``, specifying which of the matching
+            messages to return.
 
-            Default is None (Retrieves the entire cache)
+            Default is None (Retrieves all of them)
         :type idx: Union[int, slice], optional
-
-        :return: A list of dictionaries, representing the cache
-        :rtype: list[dict]
+        :param command: Only get the messages of this command
+        :type command: str, optional
+        :param since: Only get the messages received at this Unix timestamp or later
+        :type since: float, optional
+        :param until: Only get the messages received at this Unix timestamp or earlier
+        :type until: float, optional
+
+        :return: A list of the cached messages, or the message at ``idx``
+        :rtype: list[MessageCacheMember]
         """
-        if idx is None:
-            return self.cache
 
-        return self.cache[idx]
+        if self.cache is None:
+            return []
+
+        return self.cache.get(idx, command, since=since, until=until)
 
     def get_client(self, client: Client):
         """
@@ -532,8 +947,30 @@ class HiSockClient:
             if not isinstance(client, str):
                 raise e
 
-        self.send_raw(f"$GETCLT$ {client}")
-        response = self.recv_raw()
+        # Servers that support calls correlate the response with the request,
+        # so other messages arriving in between don't matter
+        if self._server_calls:
+            response = self._call(f"$GETCLT$ {client}".encode()).result()
+        else:
+            self.send_raw(f"$GETCLT$ {client}")
+            response = self.recv_raw()
+        return self._get_client_response(client, response)
+
+    def _get_client_response(self, client: Client, response: bytes) -> dict:
+        """
+        Handles the response of the server to :meth:`get_client`
+
+        :param client: The client name or IP+port that was requested.
+        :type client: Client
+        :param response: The response of the server.
+        :type response: bytes
+        :return: The client data.
+        :rtype: dict
+
+        :raise ClientNotFound: If the client couldn't be found.
+        :raise ServerException: If another error occurred.
+        """
+
         response = _type_cast(dict, response, "<get_client response>")
 
         # Validate response
@@ -579,11 +1016,7 @@ class HiSockClient:
         :type content: Sendable, optional
         """
 
-        data_to_send = (
-            b"$CMD$" + command.encode() + b"$MSG$" + self._send_type_cast(content)
-        )
-        content_header = make_header(data_to_send, self.header_len)
-        self.sock.send(content_header + data_to_send)
+        self._write(_command_prefix(command), self._send_type_cast(content))
 
     def send_raw(self, content: Sendable = None):
         """
@@ -595,21 +1028,330 @@ class HiSockClient:
         :type content: Sendable, optional
         """
 
-        data_to_send = self._send_type_cast(content)
-        header = make_header(data_to_send, self.header_len)
-        self.sock.send(header + data_to_send)
+        self._write(self._send_type_cast(content))
+
+    def send_file(
+        self,
+        command: str,
+        file_path: Union[str, pathlib.Path],
+        chunk_size: int = 65536,
+        progress: Callable = None,
+    ) -> File:
+        """
+        Sends a file to the server, in chunks. Once all of it is received, the
+        server's function for the command is called with the client data and
+        the received :class:`File`.
+
+        The chunks are sent on a thread of their own with
+        :meth:`socket.socket.sendfile`, so the file isn't read into memory, and
+        other messages are sent between its chunks. Several files can be sent
+        at once. Files aren't journaled.
+
+        The file is hashed on that thread first. If the server already has some
+        of its chunks, because an earlier transfer of it was cut off (e.g. the
+        client lost the connection and connected again), only the rest is sent.
+        The transfer is over once the server verified the file. Like with
+        :meth:`call`, the server's acknowledgments are received by :meth:`update`
+        on another thread, or by the thread sending the file otherwise.
+
+        :param command: A string, containing the command to send the file with
+        :type command: str
+        :param file_path: The path of the file to send
+        :type file_path: Union[str, pathlib.Path]
+        :param chunk_size: The number of bytes in every chunk.
+            Default is 64 KiB.
+        :type chunk_size: int, optional
+        :param progress: Called with the :class:`File` after every chunk is sent.
+            Default is None.
+        :type progress: Callable[[File], None], optional
+        :return: The file, see :meth:`File.wait` to wait until it's received
+        :rtype: File
+
+        :raise ClientException: If the server can't receive files.
+        :raise OSError: If the file can't be opened.
+        """
+
+        if not self._server_files:
+            raise ClientException("The server can't receive files.")
+
+        file = File(file_path)
+        file._open(command, next(self._file_ids), chunk_size, progress)
+        threading.Thread(target=self._send_file, args=(file,), daemon=True).start()
+        return file
+
+    def call(
+        self,
+        command: str,
+        content: Sendable = None,
+        timeout: float = None,
+        return_type: type = bytes,
+    ) -> CallFuture:
+        """
+        Sends a command & content to the server, like :meth:`send`, and returns
+        the future of the reply. The server replies with what its function for the
+        command returns (or with the exception it raised).
+
+        Calls don't wait for each other, so many of them can be sent before the
+        first reply arrives. If nothing else is receiving (:meth:`update` on
+        another thread, or another call), getting the result of the future
+        receives until the reply arrives.
+
+        :param command: A string, containing the command to send
+        :type command: str
+        :param content: The message / content to send
+        :type content: Sendable, optional
+        :param timeout: The number of seconds to wait for the reply, after which
+            the future fails with :class:`TimeoutError`.
+            Default is None (waits forever).
+        :type timeout: float, optional
+        :param return_type: The type to type cast the reply to.
+            Default is bytes.
+        :type return_type: type, optional
+        :return: The future of the reply. It fails with :class:`CallError` if the
+            function failed or there's no function for the command. Its ``latency``
+            is the number of seconds it took the reply to arrive.
+        :rtype: CallFuture
+
+        :raise ClientException: If the server doesn't support calls.
+        """
+
+        return self._call(
+            b"$CMD$" + command.encode() + b"$MSG$" + self._send_type_cast(content),
+            timeout,
+            return_type,
+        )
+
+    def _call(
+        self, message: bytes, timeout: float = None, return_type: type = bytes
+    ) -> CallFuture:
+        """
+        Sends a message as a call, see :meth:`call`
+
+        :param message: The message the server handles, e.g. a command
+        :type message: bytes
+        :param timeout: The number of seconds to wait for the reply
+        :type timeout: float, optional
+        :param return_type: The type to type cast the reply to
+        :type return_type: type, optional
+        :return: The future of the reply
+        :rtype: CallFuture
+
+        :raise ClientException: If the server doesn't support calls.
+        """
+
+        if not self._server_calls:
+            raise ClientException("The server doesn't support calls.")
+
+        future = CallFuture(self._wait_for_reply)
+        call_id = self._calls.add(future, timeout, return_type)
+        self._write(b"$CALL$%d" % call_id + message)
+        return future
+
+    def _wait_for_reply(self, future: CallFuture, timeout: Union[float, None]):
+        """
+        Receives and handles messages until the future of a call is done. If
+        another thread is receiving, this waits for it to hand the reply over.
+
+        :param future: The future of the call
+        :type future: CallFuture
+        :param timeout: The number of seconds to wait, or None to wait forever
+        :type timeout: Union[float, None]
+
+        :raise ServerNotRunning: If the server closed the connection.
+        """
+
+        # The call may still be coalesced, see `update`
+        self._write_coalesced()
+        deadline = None if timeout is None else time() + timeout
+        while not future.done():
+            # Checked every so often, so a receiving thread that stops (or the
+            # client closing) doesn't leave this waiting
+            wait_for = 0.1 if deadline is None else min(deadline - time(), 0.1)
+            if wait_for <= 0:
+                return
+
+            if not self._receive_lock.acquire(blocking=False):
+                wait((future,), wait_for)
+                continue
+
+            try:
+                message = self._frame_reader.next_frame()
+                if message is None:
+                    if not select.select((self.sock,), (), (), wait_for)[0]:
+                        continue
+                    if not self._frame_reader.recv(self.sock, self._recv_buffer):
+                        raise ServerNotRunning(
+                            "Server has stopped running, aborting..."
+                        )
+                    message = self._frame_reader.next_frame()
+
+                while message is not None and not self.closed:
+                    self._handle_message(message)
+                    message = self._frame_reader.next_frame()
+            finally:
+                self._receive_lock.release()
+
+    def _handle_call(self, data: bytes):
+        """
+        Handles a call from the server, see :meth:`HiSockServer.call_client`: the
+        function for the command is run, and what it returns is the reply
+
+        :param data: The data of the call message
+        :type data: bytes
+        """
+
+        call_id, _, message = data[6:].partition(b"$")
+        reply = lambda future: self._write(_make_reply(call_id, future))
+
+        if message.startswith(b"CMD$"):
+            command, _, content = message[4:].partition(b"$MSG$")
+            command = command.decode()
+
+            invoke = self._dispatch.get(command)
+            if invoke is not None:
+                invoke(content, reply)
+                return
+            error = FunctionNotFoundException(
+                f"No function is registered for {command}"
+            )
+        else:
+            error = ClientException("Only commands can be called.")
+
+        reply(_done_future(exception=error))
+
+    def _send_file(self, file: File):
+        """
+        Hashes a file, then sends the chunks the server doesn't have and the
+        message that ends it, see :meth:`send_file`. Other threads can send
+        between the chunks.
+
+        :param file: The file, opened to be sent
+        :type file: File
+        """
+
+        try:
+            file._hash()
+            file._acknowledge(self._wait_for_file_ack(file, file._start_message()))
+            # The position of the file is only used by `sendfile`
+            with open(file._fd, "rb", buffering=0, closefd=False) as file_object:
+                chunk = file._next_chunk()
+                while chunk is not None:
+                    if self.closed:
+                        raise ClientException("The client was closed.")
+
+                    prefix, offset, count = chunk
+                    # Compressed chunks have to be read, and sendfile can't be used
+                    # with non-blocking sockets
+                    if (
+                        self._frame_reader.codec is not None
+                        or self.sock.gettimeout() == 0
+                    ):
+                        self._write(prefix, file._read(offset, count))
+                    else:
+                        header = _make_length_header(
+                            len(prefix) + count, self.header_len, self.binary_header
+                        )
+                        with self._send_lock:
+                            self.sock.sendall(header + prefix)
+                            self.sock.sendfile(file_object, offset, count)
+                    file._sent(count)
+                    chunk = file._next_chunk()
+
+            file._acknowledge(self._wait_for_file_ack(file, file._end_message()))
+        except (OSError, ClientException, ServerNotRunning) as e:
+            file._finish(e)
+
+    def _wait_for_file_ack(self, file: File, message: bytes) -> bytes:
+        """
+        Sends the start or the end message of a file, and waits until the
+        server acknowledges it
+
+        :param file: The file
+        :type file: File
+        :param message: The message
+        :type message: bytes
+        :return: The bitmap of the chunks the server has
+        :rtype: bytes
+
+        :raise ClientException: If the client was closed meanwhile.
+        :raise ServerNotRunning: If the server closed the connection.
+        """
+
+        future = CallFuture(self._wait_for_reply)
+        self._file_acks[file.transfer_id] = future
+        self._write(message)
+        return future.result()
+
+    def _end_file_transfers(self, exception: Exception):
+        """
+        Stops the file transfers when the client is closed. What was received
+        is kept, so sending the files again resumes the transfers.
+
+        :param exception: The exception the transfers fail with
+        :type exception: Exception
+        """
+
+        for future in self._file_acks.values():
+            if not future.done():
+                future.set_exception(exception)
+        self._file_acks.clear()
+        if self._file_receiver is not None:
+            self._file_receiver.close(exception)
+
+    def _receive_file(self, data: bytes):
+        """
+        Handles a message of a file the server is sending, see
+        :meth:`HiSockServer.send_file`. Once all of the file is received, the
+        function for its command is called with it.
 
-    def recv_raw(self, ignore_reserved: bool = False) -> bytes:
+        :param data: The data of the message
+        :type data: bytes
+        """
+
+        if data.startswith(b"$FILEACK$"):
+            transfer_id, have = _parse_file_ack(data)
+            future = self._file_acks.pop(transfer_id, None)
+            if future is not None and not future.done():
+                future.set_result(have)
+            return
+
+        if self._file_receiver is None:
+            if self.download_dir is None:
+                self.download_dir = tempfile.mkdtemp(prefix="hisock-")
+            self._file_receiver = _FileReceiver(
+                self.download_dir, self._write, self.file_progress
+            )
+
+        file = self._file_receiver.handle(data)
+        if file is None:
+            return
+
+        invoke = self._dispatch.get(file.command)
+        if invoke is not None:
+            invoke(file)
+            return
+
+        warnings.warn(
+            f"No function found for command {file.command}", FunctionNotFoundWarning
+        )
+
+    def recv_raw(self, ignore_reserved: bool = False, timeout: float = None) -> bytes:
         """
         Waits (blocks) until a message is sent, and returns that message.
         This is not recommended for content with commands attached;
         it is meant to be used alongside with :func:`HiSockServer.send_client_raw` and
         :func:`HiSockServer.send_group_raw`
 
+        If :meth:`update` is running on another thread, it receives the message
+        and hands it over, and this waits without using any CPU.
+
         :param ignore_reserved: A boolean, representing if the function should ignore
             reserved commands.
             Default is False.
         :type ignore_reserved: bool, optional
+        :param timeout: The number of seconds to wait for a message.
+            Default is None (waits forever).
+        :type timeout: float, optional
 
         .. note::
             If the message is a keepalive, the client will send an acknowledgement and
@@ -618,12 +1360,31 @@ class HiSockClient:
         :return: A bytes-like object, containing the content/message
             the client first receives
         :rtype: bytes
+
+        :raise TimeoutError: If no message was received in time.
         """
 
-        def _handle_data(data: bytes):
+        # What the reply is waited for may still be coalesced, see `update`
+        self._write_coalesced()
+        deadline = None if timeout is None else time() + timeout
+        while True:
+            remaining = None if deadline is None else max(deadline - time(), 0)
+            data = self._receive_raw(remaining)
+
             # DEBUG PRINT PLEASE REMOVE LATER
             print(f"Received data: {data}")
 
+            # Replies go to their call, not to whoever waits for a message
+            if data.startswith(b"$REPLY$"):
+                self._calls.resolve(*_parse_reply(data))
+                continue
+            if data.startswith(b"$CALL$"):
+                self._handle_call(data)
+                continue
+            if data.startswith(_FILE_MESSAGES):
+                self._receive_file(data)
+                continue
+
             # Reserved commands
             reserved_command = False
             try:
@@ -635,36 +1396,52 @@ class HiSockClient:
                 # Was there a keepalive?
                 if data == b"$KEEPALIVE$":
                     self._handle_keepalive()
-                    return self.recv_raw()
+                    continue
 
                 if not ignore_reserved:
-                    return self.recv_raw()
+                    continue
 
             return data
 
-        # Sometimes, `update` can be running at the same time as this is running
-        # (e.x. if this is in a thread). In this case, `update` will receive the data
-        # and send it to us, as we cannot receive data at the same time as it receives
-        # data.
-
-        if self._receiving_data:
-            self._recv_data = "I NEED YOUR DATA"
+    def _receive_raw(self, timeout: Union[float, None]) -> bytes:
+        """
+        Receives the next message for :meth:`recv_raw`
 
-            # Wait until the data is received
-            while self._recv_data == "I NEED YOUR DATA":
-                "...waiting..."
+        :param timeout: The number of seconds to wait, or None to wait forever
+        :type timeout: Union[float, None]
+        :return: The data of the message
+        :rtype: bytes
 
-            # Data is received
-            data_received = self._recv_data
-            self._recv_data = ""
-            return _handle_data(data_received)
+        :raise TimeoutError: If no message was received in time.
+        """
 
-        self._receiving_data = True
-        message_len = int(self.sock.recv(self.header_len).decode())
-        data_received = self.sock.recv(message_len)
-        self._receiving_data = False
+        # `update` is receiving on another thread, it hands the next message over
+        if not self._receive_lock.acquire(blocking=False):
+            return self._mailbox.get(timeout)
 
-        return _handle_data(data_received)
+        try:
+            message = self._frame_reader.next_frame()
+            if message is None:
+                blocking_timeout = self.sock.gettimeout()
+                if timeout is not None:
+                    self.sock.settimeout(timeout)
+                try:
+                    while message is None:
+                        if not self._frame_reader.recv(self.sock, self._recv_buffer):
+                            raise ServerNotRunning(
+                                "Server has stopped running, aborting..."
+                            )
+                        message = self._frame_reader.next_frame()
+                except (socket.timeout, BlockingIOError) as e:
+                    raise TimeoutError("No message was received in time.") from e
+                finally:
+                    self.sock.settimeout(blocking_timeout)
+        finally:
+            self._receive_lock.release()
+
+        if self.journal is not None:
+            self.journal.append(message["data"])
+        return message["data"]
 
     # Changers
 
@@ -704,150 +1481,215 @@ class HiSockClient:
         if self.closed:
             return
 
+        # Also when `update` is called from a function it called
+        if not self.coalesce_writes or self._coalesced is not None:
+            self._update()
+            return
+
+        # What's sent while handling messages is sent once they're handled
+        self._coalesced = []
+        self._coalescing_thread = threading.get_ident()
         try:
-            self._receiving_data = True
-            # Receive header
-            try:
-                content_header = self.sock.recv(self.header_len)
-            except ConnectionResetError:
-                raise ServerNotRunning(
-                    "Server has stopped running, aborting..."
-                ) from ConnectionResetError
-            except ConnectionAbortedError:
-                # Keepalive timeout reached
-                self.closed = True
-
-            # Most likely server has stopped running
-            if not content_header:
-                print("Connection forcibly closed by server, exiting...")
-                raise SystemExit
-
-            data = self.sock.recv(int(content_header.decode()))
-            self._receiving_data = False
-
-            # Handle keepalive
-            if data == b"$KEEPALIVE$":
-                self._handle_keepalive()
-                return
+            self._update()
+        finally:
+            self._write_coalesced()
+            self._coalesced = None
 
-            # `update` can be called and run at the same time as `recv_raw`, so we need
-            # to make sure receiving data doesn't clash.
-            # If `recv_raw` would like the data, send it to them and don't process it.
-            if self._recv_data == "I NEED YOUR DATA":
-                self._recv_data = data
-                return
+    def _update(self):
+        """Receives and handles messages for :meth:`update`"""
 
-            ### Reserved ###
+        try:
+            # `recv_raw` on another thread is done receiving first. Functions
+            # called from here can use `recv_raw` themselves
+            with self._receive_lock:
+                # Messages that were already received along with earlier ones are
+                # handled without receiving again
+                message = self._frame_reader.next_frame()
+                if message is None:
+                    try:
+                        connected = self._frame_reader.recv(
+                            self.sock, self._recv_buffer
+                        )
+                    except ConnectionResetError:
+                        raise ServerNotRunning(
+                            "Server has stopped running, aborting..."
+                        ) from ConnectionResetError
+                    except ConnectionAbortedError:
+                        # Keepalive timeout reached
+                        self.closed = True
+                        return
+
+                    # Most likely server has stopped running
+                    if not connected:
+                        print("Connection forcibly closed by server, exiting...")
+                        raise SystemExit
+
+                    message = self._frame_reader.next_frame()
+
+                # Handle every complete message that was received
+                while message is not None and not self.closed:
+                    self._handle_message(message)
+                    message = self._frame_reader.next_frame()
 
-            # Handle force disconnection
-            if data == b"$DISCONN$":
-                self.close()
-                if "force_disconnect" in self.funcs:
-                    self._call_function("force_disconnect", False)
+        except IOError as e:
+            # Normal, means message has ended
+            if not (
+                e.errno != errno.EAGAIN
+                and e.errno != errno.EWOULDBLOCK
+                and not self.closed
+            ):
                 return
 
-            # Handle new client connection
-            if data.startswith(b"$CLTCONN$"):
-                if "client_connect" not in self.funcs:
-                    warnings.warn("client_connect", FunctionNotFoundWarning)
-                    return
+            # Fatal error, abort client
+            traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+            print(
+                "\nServer error encountered, aborting client...",
+                file=sys.stderr,
+            )
+            self.close()
 
-                client_content = json.loads(_removeprefix(data, b"$CLTCONN$ "))
-                self._call_function("client_connect", False, client_content)
-                return
+            raise SystemExit
 
-            # Handle client disconnection
-            if data.startswith(b"$CLTDISCONN$"):
-                if "client_disconnect" not in self.funcs:
-                    warnings.warn("client_disconnect", FunctionNotFoundWarning)
-                    return
+    def _handle_message(self, message: dict[str, bytes]):
+        """
+        Handles a message received from the server
 
-                client_content = json.loads(_removeprefix(data, b"$CLTDISCONN$ "))
-                self._call_function("client_disconnect", False, client_content)
-                return
+        :param message: The received message, with the header and the data
+        :type message: dict["header": bytes, "data": bytes]
+        """
 
-            ### Unreserved ###
+        data = message["data"]
 
-            has_corresponding_function = False  # For cache
+        # Files are written to disk instead of the journal
+        if data.startswith(_FILE_MESSAGES):
+            self._receive_file(data)
+            return
 
-            decoded_data = data.decode()
-            if decoded_data.startswith("$CMD$"):
-                command = decoded_data.lstrip("$CMD$").split("$MSG$")[0]
-                content = _removeprefix(decoded_data, "$CMD$" + command + "$MSG$")
-                # No content? (_removeprefix didn't do anything)
-                if not content or content == decoded_data:
-                    content = None
+        if self.journal is not None:
+            self.journal.append(data)
 
-                # This shouldn't happen, but we'll handle it anyway
-                if command in self._reserved_functions:
-                    print("Reserved command received, but not handled properly.")
-                    return
+        # Handle keepalive
+        if data == b"$KEEPALIVE$":
+            self._handle_keepalive()
+            return
 
-                for matching_command, func in self.funcs.items():
-                    if command == matching_command:
-                        has_corresponding_function = True
+        # Handle the reply to a call, and calls from the server
+        if data.startswith(b"$REPLY$"):
+            self._calls.resolve(*_parse_reply(data))
+            return
+        if data.startswith(b"$CALL$"):
+            self._handle_call(data)
+            return
 
-                        # Call function with dynamic args
-                        if not len(func["type_hint"]) == 0:
-                            content = _type_cast(
-                                func["type_hint"]["message"], content, func["name"]
-                            )
-                            self._call_function(func["name"], True, content)
-                            break
+        # `recv_raw` is waiting on another thread, it gets the message instead
+        if self._mailbox.put(data):
+            return
 
-                        self._call_function(func["name"], True)
+        ### Reserved ###
 
-                # No function found
-                if not has_corresponding_function:
-                    # DEBUG PRINT PLEASE REMOVE LATER
-                    print(
-                        "No corresponding function, here are the functions: "
-                        f"{self.funcs.keys()}"
-                    )
-                    warnings.warn(
-                        f"No function found for command {command}",
-                        FunctionNotFoundWarning,
-                    )
+        # Handle force disconnection
+        if data == b"$DISCONN$":
+            self.close()
+            if "force_disconnect" in self.funcs:
+                self._call_function("force_disconnect", False)
+            return
 
-            # Caching
-            if self.cache_size >= 0:
-                if has_corresponding_function:
-                    cache_content = content
-                else:
-                    cache_content = data
-                self.cache.append(
-                    MessageCacheMember(
-                        {
-                            "header": content_header,
-                            "content": cache_content,
-                            "called": has_corresponding_function,
-                            "command": command,
-                        }
-                    )
-                )
+        # Handle new client connection
+        if data.startswith(b"$CLTCONN$"):
+            if "client_connect" not in self.funcs:
+                warnings.warn("client_connect", FunctionNotFoundWarning)
+                return
 
-                # Pop oldest from stack
-                if 0 < self.cache_size < len(self.cache):
-                    self.cache.pop(0)
+            client_content = json.loads(_removeprefix(data, b"$CLTCONN$ "))
+            self._call_function("client_connect", False, client_content)
+            return
 
-        except IOError as e:
-            # Normal, means message has ended
-            if not (
-                e.errno != errno.EAGAIN
-                and e.errno != errno.EWOULDBLOCK
-                and not self.closed
-            ):
+        # Handle client disconnection
+        if data.startswith(b"$CLTDISCONN$"):
+            if "client_disconnect" not in self.funcs:
+                warnings.warn("client_disconnect", FunctionNotFoundWarning)
                 return
 
-            # Fatal error, abort client
-            traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
-            print(
-                "\nServer error encountered, aborting client...",
-                file=sys.stderr,
+            client_content = json.loads(_removeprefix(data, b"$CLTDISCONN$ "))
+            self._call_function("client_disconnect", False, client_content)
+            return
+
+        ### Unreserved ###
+
+        has_corresponding_function = False  # For cache
+        command = None
+
+        if data.startswith(b"$CMD$"):
+            command, _, content = data[5:].partition(b"$MSG$")
+            command = command.decode()
+
+            # Reserved commands aren't in the dispatch table
+            invoke = self._dispatch.get(command)
+            if invoke is not None:
+                has_corresponding_function = True
+                invoke(content)
+
+            # No function found
+            else:
+                warnings.warn(
+                    f"No function found for command {command}",
+                    FunctionNotFoundWarning,
+                )
+
+        # Caching
+        if self.cache is not None:
+            if has_corresponding_function:
+                cache_content = content
+            else:
+                cache_content = data
+            self.cache.add(
+                MessageCacheMember(
+                    {
+                        "header": message["header"],
+                        "content": cache_content,
+                        "called": has_corresponding_function,
+                        "command": command,
+                        "time": time(),
+                    }
+                )
             )
-            self.close()
 
-            raise SystemExit
+    def replay_journal(
+        self,
+        start: int = None,
+        stop: int = None,
+        since: float = None,
+        until: float = None,
+    ):
+        """
+        Runs the functions registered with :meth:`on` again for the command
+        messages in the journal, e.g. to rebuild state after a restart.
+        Reserved messages and sent frames aren't replayed.
+
+        :param start: The offset of the first record to replay
+        :type start: int, optional
+        :param stop: The offset to stop replaying at (which isn't replayed)
+        :type stop: int, optional
+        :param since: Only replay the records journaled at this Unix timestamp or later
+        :type since: float, optional
+        :param until: Only replay the records journaled at this Unix timestamp or earlier
+        :type until: float, optional
+
+        :raise ClientException: If the client has no journal.
+        """
+
+        if self.journal is None:
+            raise ClientException("The client has no journal.")
+
+        self.journal.flush()
+        for record in self.journal.read(start, stop, since, until):
+            if record.sent or not record.data.startswith(b"$CMD$"):
+                continue
+
+            command, _, content = record.data[5:].partition(b"$MSG$")
+            invoke = self._dispatch.get(command.decode())
+            if invoke is not None:
+                invoke(content)
 
     def close(self, emit_leave: bool = True):
         """
@@ -856,11 +1698,19 @@ class HiSockClient:
         :param emit_leave: Decides if the client will emit `leave` to the server or not
         :type emit_leave: bool
         """
+        self._write_coalesced()
         self.closed = True
         if emit_leave:
-            close_header = make_header(b"$USRCLOSE$", self.header_len)
-            self.sock.send(close_header + b"$USRCLOSE$")
+            close_header = make_header(
+                b"$USRCLOSE$", self.header_len, binary=self.binary_header
+            )
+            with self._send_lock:
+                self.sock.send(close_header + b"$USRCLOSE$")
         self.sock.close()
+        self._calls.close(ClientException("The client was closed."))
+        self._end_file_transfers(ClientException("The client was closed."))
+        if self._owns_handler_pool:
+            self.handler_pool.shutdown(wait=False)
 
 
 class ThreadedHiSockClient(HiSockClient):
@@ -878,9 +1728,48 @@ class ThreadedHiSockClient(HiSockClient):
     """
 
     def __init__(
-        self, addr, name=None, group=None, blocking=True, header_len=16, cache_size=-1
+        self,
+        addr,
+        name=None,
+        group=None,
+        blocking=True,
+        header_len=16,
+        cache_size=-1,
+        binary_header=True,
+        handler_pool=None,
+        cache_max_bytes=0,
+        journal=None,
+        compression=None,
+        compression_threshold=1024,
+        download_dir=None,
+        file_progress=None,
+        tcp_nodelay=None,
+        tcp_cork=False,
+        send_buffer_size=None,
+        receive_buffer_size=None,
+        coalesce_writes=False,
     ):
-        super().__init__(addr, name, group, blocking, header_len, cache_size)
+        super().__init__(
+            addr,
+            name,
+            group,
+            blocking,
+            header_len,
+            cache_size,
+            binary_header,
+            handler_pool,
+            cache_max_bytes,
+            journal,
+            compression,
+            compression_threshold,
+            download_dir,
+            file_progress,
+            tcp_nodelay,
+            tcp_cork,
+            send_buffer_size,
+            receive_buffer_size,
+            coalesce_writes,
+        )
         self._thread = threading.Thread(target=self._run)
         self._stop_event = threading.Event()
 
@@ -916,7 +1805,15 @@ class ThreadedHiSockClient(HiSockClient):
         self._thread.join()
 
 
-def connect(addr, name=None, group=None, blocking=True, header_len=16, cache_size=-1):
+def connect(
+    addr,
+    name=None,
+    group=None,
+    blocking=True,
+    header_len=16,
+    cache_size=-1,
+    binary_header=True,
+):
     """
     Creates a `HiSockClient` instance. See HiSockClient for more details
 
@@ -937,6 +1834,13 @@ def connect(addr, name=None, group=None, blocking=True, header_len=16, cache_siz
     :param header_len: An integer defining the header length of every message.
         Default is True.
     :type header_len: int, optional
+    :param cache_size: The number of messages to cache.
+        Default is -1.
+    :type cache_size: int, optional
+    :param binary_header: A boolean specifying if the client should negotiate
+        the compact binary header with the server.
+        Default is True.
+    :type binary_header: bool, optional
 
     :return: A :class:`HiSockClient` instance.
     :rtype: instance
@@ -947,11 +1851,19 @@ def connect(addr, name=None, group=None, blocking=True, header_len=16, cache_siz
         call this function by simply doing ``connect(*input_client_config())``
     """
 
-    return HiSockClient(addr, name, group, blocking, header_len, cache_size)
+    return HiSockClient(
+        addr, name, group, blocking, header_len, cache_size, binary_header
+    )
 
 
 def threaded_connect(
-    addr, name=None, group=None, blocking=True, header_len=16, cache_size=-1
+    addr,
+    name=None,
+    group=None,
+    blocking=True,
+    header_len=16,
+    cache_size=-1,
+    binary_header=True,
 ):
     """
     Creates a :class:`ThreadedHiSockClient` instance. See :class:`ThreadedHiSockClient`
@@ -960,7 +1872,9 @@ def threaded_connect(
     :return: A :class:`ThreadedHiSockClient` instance
     """
 
-    return ThreadedHiSockClient(addr, name, group, blocking, header_len, cache_size)
+    return ThreadedHiSockClient(
+        addr, name, group, blocking, header_len, cache_size, binary_header
+    )
 
 
 if __name__ == "__main__":
@@ -13,11 +13,27 @@ Copyright SSS_Says_Snek 2021-present
 from __future__ import annotations  # Remove when 3.10 is used by majority
 
 import socket
+import os  # Send files with sendfile
+import pathlib  # Type hints
+import base64  # Send the compression dictionary in the server hello
 import inspect  # Type-hinting detection for type casting
-import select  # Handle multiple clients at once
+import itertools  # File transfer IDs
+import selectors  # Handle multiple clients at once
 import json  # Handle sending dictionaries
+import multiprocessing  # Process pool start method
 import threading  # Threaded server and decorators
+import time  # Cache timestamps
 import warnings  # Non-severe errors
+import sys  # Utilize stderr
+import tempfile  # Default directory of received files
+import traceback  # Error handling
+from collections import deque  # Calls handed to the run loop
+from concurrent.futures import (  # Process pool, and waiting for replies
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    wait,
+)
 from typing import Callable, Union, Any  # Type hints
 from ipaddress import IPv4Address  # Comparisons
 from hisock import constants
@@ -34,14 +50,40 @@ try:
         ClientNotFound,
         GroupNotFound,
         MessageCacheMember,
+        MessageCache,
+        Journal,
         Sendable,
         Client,
         _removeprefix,
-        _dict_tupkey_lookup,
-        _dict_tupkey_lookup_key,
         _type_cast,
         _str_type_to_type_annotations_dict,
-        receive_message,
+        _FrameReader,
+        _compression_codecs,
+        _build_dictionary,
+        _dictionary_codec,
+        _CODECS,
+        _DICTIONARY_CODEC,
+        _Mailbox,
+        _PendingCalls,
+        CallFuture,
+        GroupCallFuture,
+        _make_reply,
+        _parse_reply,
+        _done_future,
+        ClientRecord,
+        _ClientRegistry,
+        File,
+        _FileReceiver,
+        _FILE_MESSAGES,
+        _parse_file_ack,
+        _make_length_header,
+        _command_prefix,
+        _frame_buffers,
+        _send_buffers,
+        _unsent_buffers,
+        _set_socket_options,
+        HandlerPool,
+        HandlerPoolFull,
         make_header,
         validate_ipv4,
         validate_command_not_reserved,
@@ -59,14 +101,40 @@ except ImportError:
         ClientNotFound,
         GroupNotFound,
         MessageCacheMember,
+        MessageCache,
+        Journal,
         Sendable,
         Client,
         _removeprefix,
-        _dict_tupkey_lookup,
-        _dict_tupkey_lookup_key,
         _type_cast,
         _str_type_to_type_annotations_dict,
-        receive_message,
+        _FrameReader,
+        _compression_codecs,
+        _build_dictionary,
+        _dictionary_codec,
+        _CODECS,
+        _DICTIONARY_CODEC,
+        _Mailbox,
+        _PendingCalls,
+        CallFuture,
+        GroupCallFuture,
+        _make_reply,
+        _parse_reply,
+        _done_future,
+        ClientRecord,
+        _ClientRegistry,
+        File,
+        _FileReceiver,
+        _FILE_MESSAGES,
+        _parse_file_ack,
+        _make_length_header,
+        _command_prefix,
+        _frame_buffers,
+        _send_buffers,
+        _unsent_buffers,
+        _set_socket_options,
+        HandlerPool,
+        HandlerPoolFull,
         make_header,
         validate_ipv4,
         validate_command_not_reserved,
@@ -111,7 +179,8 @@ class HiSockServer:
         Default passed in by :meth:`start_server` is 16 (maximum length: 10
         quadrillion bytes).
     :type header_len: int, optional
-    :param cache_size: The number of messages to cache.
+    :param cache_size: The number of messages to cache, see :meth:`get_cache`.
+        0 or less doesn't cache any messages.
         Default passed in by :meth:`start_server` is -1.
     :type cache_size: int, optional
     :param keepalive: A bool indicating whether a keepalive signal should be sent or not.
@@ -120,16 +189,109 @@ class HiSockServer:
         acknowledge signal to show that they are still alive.
         Default is True.
     :type keepalive: bool, optional
+    :param binary_header: A boolean indicating whether clients may negotiate a compact
+        4-byte binary length prefix instead of the padded ASCII header of
+        ``header_len`` bytes. Clients that don't ask for it (including older clients)
+        keep using the ASCII header.
+        Default is True.
+    :type binary_header: bool, optional
+    :param selector_class: The :mod:`selectors` class used to wait for clients.
+        The default picks the most efficient one for the platform (epoll on Linux),
+        which can serve far more idle connections than :func:`select.select`.
+        Default is :class:`selectors.DefaultSelector`.
+    :type selector_class: type, optional
+    :param handler_pool: The pool of worker threads that runs the functions
+        registered with ``threaded=True``.
+        Default is None (a :class:`HandlerPool` with its default limits).
+    :type handler_pool: HandlerPool, optional
+    :param process_pool: The pool of processes that runs the functions registered
+        with ``executor="process"``.
+        Default is None (a :class:`concurrent.futures.ProcessPoolExecutor` with a
+        process for every CPU, created when the first function with
+        ``executor="process"`` is registered).
+    :type process_pool: concurrent.futures.Executor, optional
+    :param send_high_watermark: The number of bytes waiting to be sent to a client
+        after which the server stops receiving from it, until its send buffer is
+        down to ``send_low_watermark`` bytes again.
+        Default is 1 MiB.
+    :type send_high_watermark: int, optional
+    :param send_low_watermark: See ``send_high_watermark``.
+        Default is 256 KiB.
+    :type send_low_watermark: int, optional
+    :param send_buffer_limit: The number of bytes waiting to be sent to a client
+        after which it's disconnected, as it's too slow to keep up.
+        Default is 16 MiB.
+    :type send_buffer_limit: int, optional
+    :param cache_max_bytes: The number of bytes the cached messages may take,
+        after which the oldest ones are evicted. 0 means no limit.
+        Default is 0.
+    :type cache_max_bytes: int, optional
+    :param journal: The journal every received frame is appended to (and every
+        sent one, if the journal records them), see :meth:`replay_journal`.
+        It isn't closed by the server.
+        Default is None (no journal).
+    :type journal: Journal, optional
+    :param compression: The codec frames are compressed with, if the client
+        supports it: ``"zlib"``, or ``"lz4"`` or ``"zstd"`` if they're installed, or
+        ``"zlib-dict"`` once there's a dictionary
+        (see :meth:`train_compression_dictionary`). Several codecs can be given in
+        order of preference, and the first one the client also asked for is used.
+        Compression needs the binary header, so older clients keep getting
+        uncompressed frames.
+        Default is None (no compression).
+    :type compression: Union[str, tuple[str, ...]], optional
+    :param compression_threshold: The number of bytes from which frames are
+        compressed, as smaller ones don't get much smaller.
+        Default is 1 KiB.
+    :type compression_threshold: int, optional
+    :param download_dir: The directory the files clients send with
+        :meth:`HiSockClient.send_file` are written into.
+        Transfers that were cut off are resumed from what's in it.
+        Default is None (a new temporary directory).
+    :type download_dir: Union[str, pathlib.Path], optional
+    :param file_progress: Called with the :class:`File` whenever a chunk of a
+        file a client sends is received.
+        Default is None.
+    :type file_progress: Callable[[File], None], optional
+    :param tcp_nodelay: Whether small messages are sent right away (True, for
+        latency, like in games), or held back until the ones before them are
+        acknowledged, so they're sent in fewer packets (False, Nagle's algorithm).
+        Default is None (the OS default, which is False).
+    :type tcp_nodelay: bool, optional
+    :param tcp_cork: Whether only full packets are sent (for throughput), holding
+        back what doesn't fill one for up to 200 ms, so it delays calls and
+        replies that are waited for. Only Linux has it.
+        Default is False.
+    :type tcp_cork: bool, optional
+    :param send_buffer_size: The size of the send buffer the OS keeps for every
+        client (``SO_SNDBUF``).
+        Default is None (the OS default).
+    :type send_buffer_size: int, optional
+    :param receive_buffer_size: The size of the receive buffer the OS keeps for
+        every client (``SO_RCVBUF``).
+        Default is None (the OS default).
+    :type receive_buffer_size: int, optional
+    :param coalesce_writes: Whether the messages sent while :meth:`run` handles
+        what it received (like by the functions registered with :meth:`on`) are
+        sent together once it's done, with one system call for every client
+        instead of one for every message. Messages sent from other threads are
+        still sent right away.
+        Default is False.
+    :type coalesce_writes: bool, optional
 
     :ivar tuple addr: A two-element tuple containing the IP address and the port.
     :ivar int header_len: An integer storing the header length of each "message".
-    :ivar dict clients: A dictionary with the socket as its key and the
-        client info as its value.
+    :ivar clients: A read-only mapping with the socket as its key and the
+        client info as its value, which also finds clients by their address,
+        name and group.
     :ivar dict clients_rev: A dictionary with the client info as its key
         and the socket as its value (for reverse lookup, up-to-date with
-        :attr:`clients`).
+        :attr:`clients`). Prefer :meth:`get_client`, as it's made again
+        after the clients change.
     :ivar dict funcs: A list of functions registered with decorator :meth:`on`.
         **This is mainly used for under-the-hood-code.**
+    :ivar HandlerPool handler_pool: The pool that runs the threaded functions,
+        see :meth:`HandlerPool.metrics` for its metrics.
 
     :raise TypeError: If the address is not a tuple.
     """
@@ -142,22 +304,64 @@ class HiSockServer:
         header_len: int = 16,
         cache_size: int = -1,
         keepalive: bool = True,
+        binary_header: bool = True,
+        selector_class: type = selectors.DefaultSelector,
+        handler_pool: HandlerPool = None,
+        process_pool: Executor = None,
+        send_high_watermark: int = 1 << 20,
+        send_low_watermark: int = 1 << 18,
+        send_buffer_limit: int = 1 << 24,
+        cache_max_bytes: int = 0,
+        journal: Journal = None,
+        compression: Union[str, tuple] = None,
+        compression_threshold: int = 1024,
+        download_dir: Union[str, pathlib.Path] = None,
+        file_progress: Callable = None,
+        tcp_nodelay: bool = None,
+        tcp_cork: bool = False,
+        send_buffer_size: int = None,
+        receive_buffer_size: int = None,
+        coalesce_writes: bool = False,
     ):
         self.addr = addr
+        self.tcp_nodelay = tcp_nodelay
+        self.tcp_cork = tcp_cork
+        self.send_buffer_size = send_buffer_size
+        self.receive_buffer_size = receive_buffer_size
+        self.coalesce_writes = coalesce_writes
+        # The client sockets with coalesced messages while `run` handles
+        # messages, None otherwise
+        self._coalesced_sockets = None
+        self.send_high_watermark = send_high_watermark
+        self.send_low_watermark = send_low_watermark
+        self.send_buffer_limit = send_buffer_limit
         self.header_len = header_len
+        self.binary_header = binary_header
+        # The codecs to negotiate, in order of preference
+        self.compression = _compression_codecs(compression)
+        self.compression_threshold = compression_threshold
+        # The preset dictionaries of the "zlib-dict" codec, by version. Clients
+        # keep the version they got in the hello, see `train_compression_dictionary`
+        self.compression_dictionary_version = 0
+        self._dictionaries = {}
 
         # Socket initialization
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setblocking(blocking)
-        try:
-            self.sock.bind(addr)
-        except socket.gaierror:  # getaddrinfo error
-            raise TypeError("The IP address and/or port are invalid.")
-        self.sock.listen(max_connections)
+        self._create_socket(blocking, max_connections, selector_class)
 
         # Function related storage
-        # {"func_name": {"func": Callable, "name": str, "type_hint": {"arg": Any}, "threaded": bool}}
+        # {"command": {"func": Callable, "name": str, "type_hint": {"arg": Any},
+        #              "threaded": bool, "invoke": Callable}}
         self.funcs = {}
+        # Unreserved commands and the invoker of their function, to dispatch
+        # messages with one lookup
+        # {"command": Callable[[client_data, content], None]}
+        self._dispatch = {}
+        # Runs the threaded functions, it's shut down on close if it was created here
+        self._owns_handler_pool = handler_pool is None
+        self.handler_pool = handler_pool if handler_pool is not None else HandlerPool()
+        # Runs the functions with the process executor, created when it's needed
+        self._owns_process_pool = process_pool is None
+        self.process_pool = process_pool
         # Stores the names of the reserved functions
         # Used for the `on` decorator
         self._reserved_functions = (
@@ -180,29 +384,45 @@ class HiSockServer:
         # Cache
         self.cache_size = cache_size
         # cache_size <= 0: No cache
-        if cache_size > 0:
-            self.cache = []
-
-        # Dictionaries and lists for client lookup
-        self._sockets_list = [self.sock]  # Our socket will always be the first
-        # socket: {"ip": (ip, port), "name": str, "group": str}
-        self.clients = {}
-        # ((ip: str, port: int), name: str, group: str): socket
-        self.clients_rev = {}
+        self.cache = (
+            MessageCache(cache_size, cache_max_bytes) if cache_size > 0 else None
+        )
+        self.journal = journal
+
+        # Client lookup
+        # socket: ClientRecord, which is also indexed by address, name and group
+        self.clients = _ClientRegistry()
+        # socket: ClientRecord of every connection, including the ones that
+        # didn't send their hello yet and aren't in `clients`. The record holds
+        # all the state of the connection
+        self._connections = {}
+        # Every client is received from on the run loop, so they share the buffer
+        # that's received into
+        self._recv_buffer = memoryview(bytearray(65536))
+        # Guards the send buffers of the records
+        self._send_lock = threading.Lock()
+        # Hands the messages without a command over to `recv_raw`
+        self._mailbox = _Mailbox()
+        # The thread that last ran `run`
+        self._run_thread_id = None
+        # The calls to clients waiting for their reply, see `call_client`. Their
+        # timeouts are checked by `run`
+        self._calls = _PendingCalls(expire_in_thread=False)
+        # Received files, see `send_file`. Every connection has a `_FileReceiver`
+        # once it sends a file
+        self.download_dir = download_dir
+        self.file_progress = file_progress
+        self._file_ids = itertools.count(1)
 
         # Flags
         self.closed = False
 
         # Keepalive
         self._keepalive_event = threading.Event()
-        self._unresponsive_clients = []
         self.keepalive = keepalive
 
         if self.keepalive:
-            keepalive_thread = threading.Thread(
-                target=self._keepalive_thread, daemon=True
-            )
-            keepalive_thread.start()
+            self._start_keepalive()
 
     def __str__(self):
         """Example: <HiSockServer serving at 192.168.1.133:5000>"""
@@ -270,11 +490,100 @@ class HiSockServer:
 
     # Internal methods
 
+    def _create_socket(
+        self, blocking: bool, max_connections: int, selector_class: type
+    ):
+        """
+        Creates the server socket and the selector that waits for clients
+
+        :param blocking: Whether the server socket should block
+        :type blocking: bool
+        :param max_connections: The backlog of connections to listen for
+        :type max_connections: int
+        :param selector_class: The :mod:`selectors` class to use
+        :type selector_class: type
+
+        :raise TypeError: If the address is invalid.
+        """
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(blocking)
+        # The buffer sizes have to be set before listening to take full effect
+        self._tune_socket(self.sock)
+        try:
+            self.sock.bind(self.addr)
+        except socket.gaierror:  # getaddrinfo error
+            raise TypeError("The IP address and/or port are invalid.")
+        self.sock.listen(max_connections)
+
+        # Sockets are registered once when they connect and unregistered
+        # when they disconnect, instead of passing every socket each `run`
+        self._selector = selector_class()
+        self._selector.register(self.sock, selectors.EVENT_READ)
+
+        # Other threads hand calls to `run` through `_reactor_calls`, and wake it up
+        # by writing to the wakeup socket
+        self._reactor_calls = deque()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
+
+    def _tune_socket(self, sock: socket.socket):
+        """
+        Sets the socket options the server was created with
+
+        :param sock: The server socket, or a client socket
+        :type sock: socket.socket
+        """
+
+        _set_socket_options(
+            sock,
+            self.tcp_nodelay,
+            self.tcp_cork,
+            self.send_buffer_size,
+            self.receive_buffer_size,
+        )
+
+    def _close_client_socket(self, client_socket: socket.socket):
+        """
+        Stops waiting for a client socket and closes it
+
+        :param client_socket: The client socket to close
+        :type client_socket: socket.socket
+        """
+
+        # What `run` coalesced is still sent, like a disconnection message
+        if self._coalesced_sockets is not None:
+            self._write_coalesced(client_socket)
+        self._selector.unregister(client_socket)
+        client_socket.close()
+
+    def _forget_connection(self, client_socket: socket.socket):
+        """
+        Drops the record of a closed connection, and with it what couldn't be
+        sent to it
+
+        :param client_socket: The client socket
+        :type client_socket: socket.socket
+        """
+
+        with self._send_lock:
+            client_info = self._connections.pop(client_socket, None)
+        self._calls.fail(
+            client_socket, ClientNotFound("The client disconnected before replying.")
+        )
+        if client_info is not None:
+            self._end_file_transfers(
+                client_info, ClientNotFound("The client disconnected.")
+            )
+
     def _new_client_connection(
         self, connection: socket.socket, address: tuple[str, int]
     ):
         """
-        Handle the client hello handshake
+        Handle a new connection, which becomes a client once its client hello
+        is received
 
         :param connection: The client socket
         :type connection: socket.socket
@@ -284,27 +593,81 @@ class HiSockServer:
         :raise ServerException: If the client is already connected
         """
 
-        if connection in self._sockets_list:
+        if connection in self._connections:
             raise ServerException("Client already connected.")
 
-        self._sockets_list.append(connection)
+        # Sending never blocks, see `_write`. The client hello is received by
+        # `run` like any other message, so a client that doesn't send it can't
+        # hold up the others
+        connection.setblocking(False)
+        self._tune_socket(connection)
+        self._connections[connection] = ClientRecord(
+            address, frame_reader=_FrameReader(self.header_len)
+        )
+        self._selector.register(connection, selectors.EVENT_READ)
 
-        # Receive the client hello
-        client_hello = receive_message(connection, self.header_len)
+    def _client_hello(self, connection: socket.socket, client_hello: bytes):
+        """
+        Handle the client hello of a new connection, which already has a record
+        in :attr:`_connections`
+
+        :param connection: The client socket
+        :type connection: socket.socket
+        :param client_hello: The data of the client hello message
+        :type client_hello: bytes
+        """
 
-        client_hello = _removeprefix(client_hello["data"].decode(), "$CLTHELLO$ ")
+        client_info = self._connections[connection]
+        client_hello = _removeprefix(client_hello.decode(), "$CLTHELLO$ ")
         client_hello = json.loads(client_hello)
 
-        client_info = {
-            "ip": address,
-            "name": client_hello["name"],
-            "group": client_hello["group"],
-        }
-        self.clients[connection] = client_info
-        self._update_clients_rev_dict()
+        # Negotiate the header. Older clients don't send any options and
+        # don't expect a server hello back
+        if "binary_header" in client_hello:
+            binary_header = self.binary_header and bool(client_hello["binary_header"])
+            # The first codec of the server that the client has, too
+            client_codecs = client_hello.get("compression", ()) if binary_header else ()
+            codec = next(
+                (
+                    name
+                    for name in self.compression
+                    if name in client_codecs
+                    and (name != _DICTIONARY_CODEC or self._dictionaries)
+                ),
+                None,
+            )
+            server_hello = {
+                "binary_header": binary_header,
+                "calls": True,
+                "files": True,
+                "compression": codec,
+            }
+            if codec == _DICTIONARY_CODEC:
+                version = self.compression_dictionary_version
+                zdict, codec = self._dictionaries[version]
+                server_hello["dictionary"] = {
+                    "version": version,
+                    "data": base64.b64encode(zdict).decode(),
+                }
+            elif codec is not None:
+                codec = _CODECS[codec]
+
+            self._send_to_socket(
+                connection, f"$SRVHELLO$ {json.dumps(server_hello)}".encode()
+            )
+            client_info.frame_reader.binary_header = binary_header
+            client_info.frame_reader.codec = codec
+        client_info.calls = bool(client_hello.get("calls", False))
+        client_info.files = bool(client_hello.get("files", False))
+
+        client_info.name = client_hello["name"]
+        client_info.group = client_hello["group"]
+        self.clients.add(connection, client_info)
 
         # Send reserved command to existing clients
-        self.send_all_clients_raw(f"$CLTCONN$ {json.dumps(client_info)}".encode())
+        self.send_all_clients_raw(
+            f"$CLTCONN$ {json.dumps(client_info.copy())}".encode()
+        )
 
         if "join" in self.funcs:
             self._call_function("join", False, client_info)
@@ -312,6 +675,17 @@ class HiSockServer:
 
         warnings.warn("join", FunctionNotFoundWarning)
 
+    def _close_connection_awaiting_hello(self, connection: socket.socket):
+        """
+        Closes a connection that didn't send its client hello
+
+        :param connection: The client socket
+        :type connection: socket.socket
+        """
+
+        self._close_client_socket(connection)
+        self._forget_connection(connection)
+
     def _client_disconnection(self, client: socket.socket, call_func: bool = True):
         """
         Handle a client disconnecting
@@ -324,16 +698,14 @@ class HiSockServer:
         :raise ClientNotFound: The client wasn't connected to the server
         """
 
-        if client not in self._sockets_list:
+        if client not in self.clients:
             raise ClientNotFound(f'Client "{client}" is not connected.')
 
-        # Save the client info for leave command
-        client_info = self.clients[client]
-
-        # Remove socket from lists and dictionaries
-        self._sockets_list.remove(client)
-        del self.clients[client]
-        self._update_clients_rev_dict()
+        # Remove socket from the selector and dictionaries, and save the
+        # client info for leave command
+        self._close_client_socket(client)
+        client_info = self.clients.remove(client)
+        self._forget_connection(client)
 
         if not call_func:
             return
@@ -344,33 +716,6 @@ class HiSockServer:
 
         warnings.warn("leave", FunctionNotFoundWarning)
 
-    def _update_clients_rev_dict(self, idx: int = None):
-        """
-        Updates the reversed clients dictionary to the normal dictionary
-
-        :param idx: Index of the client to update if known. If not known,
-            the whole dictionary will be updated.
-        :type idx: int
-
-        :raise IndexError: If the client idx doesn't exist.
-        :raise TypeError: If the client idx is not an integer.
-        :raise KeyError: If the client doesn't exist in :ivar:`self.clients`
-        :raise KeyError: If the client isn't a valid client.
-        """
-
-        clients = self.clients
-        if idx is not None:
-            clients = (self.clients[self._sockets_list[idx]],)
-
-        # There was a client removed
-        if len(self.clients_rev) > len(self._sockets_list) - 1:
-            self.clients_rev.clear()
-
-        for client_socket, client_info in clients.items():
-            self.clients_rev[
-                (client_info["ip"], client_info["name"], client_info["group"])
-            ] = client_socket
-
     def _send_type_cast(self, content: Sendable = None) -> bytes:
         """
         Type casting content for the send methods.
@@ -387,6 +732,472 @@ class HiSockServer:
 
         return _type_cast(bytes, content, "<server sending function>")
 
+    def _send_to_socket(self, client_socket: socket.socket, *buffers: bytes):
+        """
+        Sends a message to a client socket, prefixed with the header the client
+        negotiated. The message can be in several pieces (like the command and
+        the content), which aren't joined before they're sent.
+
+        :param client_socket: The client socket to send to
+        :type client_socket: socket.socket
+        :param buffers: The pieces of the message
+        :type buffers: bytes
+        """
+
+        client_info = self._connections.get(client_socket)
+        # Disconnected
+        if client_info is None:
+            return
+
+        client_info.messages_sent += 1
+        # Files aren't journaled, see `send_file`
+        if (
+            self.journal is not None
+            and self.journal.record_sent
+            and not buffers[0].startswith(_FILE_MESSAGES)
+        ):
+            self.journal.append(b"".join(buffers), client_info, sent=True)
+        frame_reader = client_info.frame_reader
+        self._write(
+            client_socket,
+            _frame_buffers(
+                buffers,
+                self.header_len,
+                frame_reader.binary_header,
+                frame_reader.codec,
+                self.compression_threshold,
+            ),
+        )
+
+    def _write(self, client_socket: socket.socket, buffers: list):
+        """
+        Sends data to a client socket without blocking, with one system call
+        for all of its buffers. What can't be sent right away is added to the
+        client's send buffer, which :meth:`run` sends when the socket is
+        writable. This can be called from any thread.
+
+        With ``coalesce_writes``, what :meth:`run` sends while it handles
+        messages is sent once it's done, see :meth:`_write_coalesced`.
+
+        :param client_socket: The client socket to send to
+        :type client_socket: socket.socket
+        :param buffers: The data to send
+        :type buffers: list
+        """
+
+        if (
+            self._coalesced_sockets is not None
+            and threading.get_ident() == self._run_thread_id
+        ):
+            client_info = self._connections.get(client_socket)
+            # Disconnected
+            if client_info is None:
+                return
+
+            if client_info.coalesced is None:
+                client_info.coalesced = []
+                self._coalesced_sockets.append(client_socket)
+            client_info.coalesced.extend(buffers)
+            return
+
+        self._write_now(client_socket, buffers)
+
+    def _write_now(self, client_socket: socket.socket, buffers: list):
+        """
+        Sends data to a client socket without blocking, see :meth:`_write`
+
+        :param client_socket: The client socket to send to
+        :type client_socket: socket.socket
+        :param buffers: The data to send
+        :type buffers: list
+        """
+
+        with self._send_lock:
+            client_info = self._connections.get(client_socket)
+            # Disconnected
+            if client_info is None:
+                return
+
+            # Idle connections don't keep a send buffer around
+            send_buffer = client_info.send_buffer
+            buffered = len(send_buffer) if send_buffer is not None else 0
+            # The socket may take more than one `sendmsg` sends, like when
+            # there are more buffers than it takes at once
+            while not buffered and buffers:
+                try:
+                    sent = _send_buffers(client_socket, buffers)
+                except BlockingIOError:
+                    break
+                except OSError:
+                    # The connection is broken, `run` will handle the disconnection
+                    return
+                if not sent:
+                    break
+                buffers = _unsent_buffers(buffers, sent)
+            if not buffers:
+                return
+
+            if send_buffer is None:
+                send_buffer = client_info.send_buffer = bytearray()
+            for buffer in buffers:
+                send_buffer += buffer
+
+        # Only `run` may change what the selector waits for, and only when the
+        # socket needs to be waited on differently
+        if (
+            not buffered
+            or buffered <= self.send_high_watermark < len(send_buffer)
+            or buffered <= self.send_buffer_limit < len(send_buffer)
+        ):
+            self._call_in_reactor(self._update_send_events, client_socket)
+
+    def _write_coalesced(self, client_socket: socket.socket):
+        """
+        Sends the messages :meth:`run` coalesced for a client, with one system
+        call, see ``coalesce_writes``
+
+        :param client_socket: The client socket to send to
+        :type client_socket: socket.socket
+        """
+
+        client_info = self._connections.get(client_socket)
+        if client_info is None or client_info.coalesced is None:
+            return
+
+        buffers, client_info.coalesced = client_info.coalesced, None
+        self._write_now(client_socket, buffers)
+
+    def _flush(self, client_socket: socket.socket):
+        """
+        Sends as much of a client's send buffer as the socket accepts
+
+        :param client_socket: The client socket to send to
+        :type client_socket: socket.socket
+        """
+
+        with self._send_lock:
+            client_info = self._connections.get(client_socket)
+            if client_info is None or not client_info.send_buffer:
+                return
+
+            send_buffer = client_info.send_buffer
+
+            try:
+                sent = client_socket.send(send_buffer)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                # The connection is broken, nothing will be sent anymore
+                sent = len(send_buffer)
+            del send_buffer[:sent]
+            if not send_buffer:
+                # A bytearray keeps its memory, so a burst would stay allocated
+                client_info.send_buffer = None
+
+    def _update_send_events(self, client_socket: socket.socket):
+        """
+        Makes the selector wait for a client socket to be writable if its send
+        buffer isn't empty, and stops receiving from it while the send buffer is
+        above the high watermark. Clients above the send buffer limit are
+        disconnected.
+
+        :param client_socket: The client socket
+        :type client_socket: socket.socket
+        """
+
+        client_info = self._connections.get(client_socket)
+        # Disconnected in the meantime
+        if client_info is None:
+            return
+
+        send_buffer = client_info.send_buffer
+        buffered = len(send_buffer) if send_buffer is not None else 0
+
+        if buffered > self.send_buffer_limit:
+            warnings.warn(
+                f"Disconnecting {client_info.ip}: more than "
+                f"{self.send_buffer_limit} bytes are waiting to be sent to it.",
+                UserWarning,
+            )
+            self._client_disconnection(client_socket)
+            return
+
+        if buffered > self.send_high_watermark:
+            client_info.reading_paused = True
+        elif buffered <= self.send_low_watermark:
+            client_info.reading_paused = False
+
+        # Files are sent a chunk at a time, whenever the socket is writable
+        events = selectors.EVENT_WRITE if buffered or client_info.files_sending else 0
+        if not client_info.reading_paused:
+            events |= selectors.EVENT_READ
+        self._selector.modify(client_socket, events)
+
+    # Files
+
+    def _hash_file(self, client_socket: socket.socket, file: File):
+        """
+        Hashes the chunks of a file, then has :meth:`run` send its start
+        message, see :meth:`send_file`. This runs on a thread of its own, as it
+        reads the whole file.
+
+        :param client_socket: The client socket to send to
+        :type client_socket: socket.socket
+        :param file: The file, opened to be sent
+        :type file: File
+        """
+
+        try:
+            file._hash()
+        except OSError as e:
+            file._finish(e)
+            return
+        self._call_in_reactor(self._start_file, client_socket, file)
+
+    def _start_file(self, client_socket: socket.socket, file: File):
+        """
+        Sends the start message of a file to a client, which acknowledges it
+        with the chunks it already has. This is called by :meth:`run`.
+
+        :param client_socket: The client socket to send to
+        :type client_socket: socket.socket
+        :param file: The file, hashed
+        :type file: File
+        """
+
+        client_info = self._connections.get(client_socket)
+        # Disconnected in the meantime
+        if client_info is None:
+            file._finish(ClientNotFound("The client disconnected."))
+            return
+
+        self._wait_for_file_ack(client_socket, client_info, file)
+        self._send_to_socket(client_socket, file._start_message())
+
+    def _wait_for_file_ack(
+        self, client_socket: socket.socket, client_info: ClientRecord, file: File
+    ):
+        """
+        Waits for a client to acknowledge the start or the end of a file,
+        see :meth:`_file_acknowledged`
+
+        :param client_socket: The client socket the file is sent to
+        :type client_socket: socket.socket
+        :param client_info: The record of the client
+        :type client_info: ClientRecord
+        :param file: The file
+        :type file: File
+        """
+
+        if client_info.files_waiting is None:
+            client_info.files_waiting = {}
+        client_info.files_waiting[file.transfer_id] = file
+
+    def _file_acknowledged(self, client_socket: socket.socket, data: bytes):
+        """
+        Handles a client acknowledging the start of a file, after which the
+        chunks it doesn't have are sent, or the end of a file, which ends the
+        transfer
+
+        :param client_socket: The client socket that sent the acknowledgment
+        :type client_socket: socket.socket
+        :param data: The data of the acknowledgment
+        :type data: bytes
+        """
+
+        client_info = self.clients[client_socket]
+        transfer_id, have = _parse_file_ack(data)
+        file = (client_info.files_waiting or {}).pop(transfer_id, None)
+        if file is not None and file._acknowledge(have):
+            self._queue_file(client_socket, file)
+
+    def _queue_file(self, client_socket: socket.socket, file: File):
+        """
+        Starts sending the chunks of a file the client doesn't have, once it
+        acknowledged the start message, see :meth:`send_file`. This is called by
+        :meth:`run`.
+
+        :param client_socket: The client socket to send to
+        :type client_socket: socket.socket
+        :param file: The file, opened to be sent
+        :type file: File
+        """
+
+        client_info = self._connections.get(client_socket)
+        # Disconnected in the meantime
+        if client_info is None:
+            file._finish(ClientNotFound("The client disconnected."))
+            return
+
+        if client_info.files_sending is None:
+            client_info.files_sending = deque()
+        client_info.files_sending.append(file)
+        self._update_send_events(client_socket)
+
+    def _send_file_chunk(self, client_socket: socket.socket):
+        """
+        Sends the next chunk of one of the files being sent to a client, once
+        everything sent before it is sent. The files take turns, so several of
+        them are sent at once, and other messages are sent between the chunks.
+
+        :param client_socket: The client socket to send to
+        :type client_socket: socket.socket
+        """
+
+        # The chunks are sent after the messages coalesced before them
+        if self._coalesced_sockets is not None:
+            self._write_coalesced(client_socket)
+        client_info = self._connections.get(client_socket)
+        if (
+            client_info is None
+            or not client_info.files_sending
+            or client_info.send_buffer
+        ):
+            return
+
+        files = client_info.files_sending
+        file = files.popleft()
+        chunk = file._next_chunk()
+        if chunk is not None:
+            if not self._write_file_chunk(client_socket, client_info, file, *chunk):
+                # The connection is broken, `run` will handle the disconnection
+                files.appendleft(file)
+                return
+            chunk = file._next_chunk()
+
+        if chunk is not None:
+            files.append(file)
+        else:
+            # The transfer is over once the client verified the file
+            self._wait_for_file_ack(client_socket, client_info, file)
+            self._send_to_socket(client_socket, file._end_message())
+        if not files:
+            client_info.files_sending = None
+
+    def _write_file_chunk(
+        self,
+        client_socket: socket.socket,
+        client_info: ClientRecord,
+        file: File,
+        prefix: bytes,
+        offset: int,
+        count: int,
+    ) -> bool:
+        """
+        Sends a chunk of a file with :func:`os.sendfile`, so it isn't copied
+        into memory. What the socket doesn't take right away is read into the
+        send buffer.
+
+        :param client_socket: The client socket to send to
+        :type client_socket: socket.socket
+        :param client_info: The record of the client
+        :type client_info: ClientRecord
+        :param file: The file
+        :type file: File
+        :param prefix: The start of the message of the chunk
+        :type prefix: bytes
+        :param offset: The offset of the chunk in the file
+        :type offset: int
+        :param count: The size of the chunk
+        :type count: int
+        :return: False if the connection is broken
+        :rtype: bool
+        """
+
+        frame_reader = client_info.frame_reader
+        # Compressed chunks have to be read, as does everything without sendfile
+        if frame_reader.codec is not None or not hasattr(os, "sendfile"):
+            self._send_to_socket(client_socket, prefix, file._read(offset, count))
+            file._sent(count)
+            return True
+
+        head = (
+            _make_length_header(
+                len(prefix) + count, self.header_len, frame_reader.binary_header
+            )
+            + prefix
+        )
+        with self._send_lock:
+            # Another thread sent something since it was checked
+            if client_info.send_buffer:
+                client_info.send_buffer += head + file._read(offset, count)
+            else:
+                head_sent = sent = 0
+                try:
+                    head_sent = client_socket.send(head)
+                    if head_sent == len(head):
+                        sent = os.sendfile(
+                            client_socket.fileno(), file._fd, offset, count
+                        )
+                except BlockingIOError:
+                    pass
+                except OSError:
+                    return False
+
+                if head_sent < len(head) or sent < count:
+                    client_info.send_buffer = bytearray(head[head_sent:]) + file._read(
+                        offset + sent, count - sent
+                    )
+
+        client_info.messages_sent += 1
+        file._sent(count)
+        return True
+
+    def _receive_file(self, client_socket: socket.socket, data: bytes):
+        """
+        Handles a message of a file a client is sending, see
+        :meth:`HiSockClient.send_file`. Once all of the file is received, the
+        function for its command is called with it.
+
+        :param client_socket: The client socket that sent the message
+        :type client_socket: socket.socket
+        :param data: The data of the message
+        :type data: bytes
+        """
+
+        if data.startswith(b"$FILEACK$"):
+            self._file_acknowledged(client_socket, data)
+            return
+
+        client_info = self.clients[client_socket]
+        if client_info.files_receiving is None:
+            if self.download_dir is None:
+                self.download_dir = tempfile.mkdtemp(prefix="hisock-")
+            client_info.files_receiving = _FileReceiver(
+                self.download_dir,
+                lambda data: self._send_to_socket(client_socket, data),
+                self.file_progress,
+            )
+
+        file = client_info.files_receiving.handle(data)
+        if file is None:
+            return
+
+        invoke = self._dispatch.get(file.command)
+        if invoke is not None:
+            invoke(client_info, file)
+
+    def _end_file_transfers(self, client_info: ClientRecord, exception: Exception):
+        """
+        Stops the file transfers of a connection that's closed
+
+        :param client_info: The record of the connection
+        :type client_info: ClientRecord
+        :param exception: The exception the transfers fail with
+        :type exception: Exception
+        """
+
+        files_sending = client_info.files_sending
+        files_waiting = client_info.files_waiting
+        client_info.files_sending = client_info.files_waiting = None
+        for file in files_sending or ():
+            file._finish(exception)
+        for file in (files_waiting or {}).values():
+            file._finish(exception)
+
+        if client_info.files_receiving is not None:
+            client_info.files_receiving.close(exception)
+
     # Keepalive
 
     def _handle_keepalive(self, client_socket: socket.socket):
@@ -397,30 +1208,35 @@ class HiSockServer:
         :type client_socket: socket.socket
         """
 
-        if client_socket in self._unresponsive_clients:
-            self._unresponsive_clients.remove(client_socket)
+        self.clients[client_socket].keepalive_pending = False
 
         # DEBUG PRINT PLEASE REMOVE LATER
         print(f"{self.clients[client_socket]['ip']} is alive.")
 
+    def _start_keepalive(self):
+        """Starts the thread that sends keepalives to the clients"""
+
+        keepalive_thread = threading.Thread(target=self._keepalive_thread, daemon=True)
+        keepalive_thread.start()
+
     def _keepalive_thread(self):
         while not self._keepalive_event.is_set():
             self._keepalive_event.wait(30)
 
             # Send keepalive to all clients
             if not self._keepalive_event.is_set():
-                for client in self.clients:
-                    self._unresponsive_clients.append(client)
-                    self.send_client_raw(self.clients[client]["ip"], "$KEEPALIVE$")
+                for client, client_info in list(self.clients.items()):
+                    client_info.keepalive_pending = True
+                    self._send_to_socket(client, b"$KEEPALIVE$")
 
             # Keepalive acknowledgments will be handled in `_handle_keepalive`
             self._keepalive_event.wait(30)
 
             # Keepalive response wait is over, remove the unresponsive clients
             if not self._keepalive_event.is_set():
-                for client in self._unresponsive_clients:
-                    self.disconnect_client(self.clients[client]["ip"], force=True)
-                self._unresponsive_clients.clear()
+                for client, client_info in list(self.clients.items()):
+                    if client_info.keepalive_pending:
+                        self._call_in_reactor(self._drop_client, client)
 
     # On decorator
 
@@ -428,49 +1244,271 @@ class HiSockServer:
         """
         Calls a function with the given arguments and returns the result.
 
-        :param func_name: The name of the function to call.
-        :type func_name: str
-        :param sort_by_name: Whether to sort the arguments by name or not.
-        :type sort_by_name: bool
-        :param args: The arguments to pass to the function.
-        :param kwargs: The keyword arguments to pass to the function.
+        :param func_name: The name of the function to call.
+        :type func_name: str
+        :param sort_by_name: Whether to sort the arguments by name or not.
+        :type sort_by_name: bool
+        :param args: The arguments to pass to the function.
+        :param kwargs: The keyword arguments to pass to the function.
+
+        :raise FunctionNotFoundException: If the function is not found.
+        """
+
+        func: dict
+
+        # Find the function by the function name
+        if sort_by_name:
+            for func_command, func_data in self.funcs.items():
+                if func_data["name"] == func_name:
+                    func = func_command
+                    break
+            else:
+                raise FunctionNotFoundException(
+                    f"Function with name {func_name} not found"
+                )
+        # Find the function by the function command
+        else:
+            if func_name not in self.funcs:
+                raise FunctionNotFoundException(
+                    f"Function with command {func_name} not found"
+                )
+            func = func_name
+
+        self._run_function(self.funcs[func], *args, **kwargs)
+
+    def _run_function(self, func: dict, *args, reply: Callable = None, **kwargs):
+        """
+        Runs a function registered with :meth:`on`, in :attr:`handler_pool` if it's
+        threaded.
+
+        :param func: The function data stored in :attr:`funcs`
+        :type func: dict
+        :param args: The arguments to pass to the function.
+        :param reply: Called with the future of the result of the function, when
+            the function was called by a call (see :meth:`_send_reply`)
+        :type reply: Callable[[Future], None], optional
+        :param kwargs: The keyword arguments to pass to the function.
+        """
+
+        # Normal
+        if not func["threaded"]:
+            if reply is None:
+                func["func"](*args, **kwargs)
+                return
+
+            # The exception is raised by the caller instead
+            try:
+                result = func["func"](*args, **kwargs)
+            except Exception as e:
+                reply(_done_future(exception=e))
+                return
+            reply(_done_future(result))
+            return
+
+        # Threaded
+        try:
+            future = self.handler_pool.submit(func["func"], *args, **kwargs)
+        except HandlerPoolFull as e:
+            warnings.warn(f"{func['name']} was not run: {e}", UserWarning)
+            if reply is not None:
+                reply(_done_future(exception=e))
+            return
+
+        if reply is not None:
+            future.add_done_callback(reply)
+
+    def _call_in_reactor(self, callback: Callable, *args):
+        """
+        Calls a function in the thread running :meth:`run`, from any thread.
+
+        :param callback: The function to call.
+        :type callback: Callable
+        :param args: The arguments to pass to the function.
+        """
+
+        self._reactor_calls.append((callback, args))
+        try:
+            self._wakeup_send.send(b"\0")
+        except (BlockingIOError, OSError):
+            # It's already woken up (or closed)
+            pass
+
+    def _run_reactor_calls(self):
+        """Runs the calls handed to :meth:`run` by :meth:`_call_in_reactor`"""
+
+        try:
+            while self._wakeup_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        while self._reactor_calls:
+            callback, args = self._reactor_calls.popleft()
+            callback(*args)
+
+    def _send_function_result(self, client_data: dict, command: str, future: Future):
+        """
+        Sends the result of a function run in :attr:`process_pool` to the client
+        that sent the message, with the same command.
+
+        :param client_data: The client data the function was called with.
+        :type client_data: dict
+        :param command: The command of the message.
+        :type command: str
+        :param future: The future of the result of the function.
+        :type future: concurrent.futures.Future
+        """
+
+        if future.cancelled():
+            return
+
+        exception = future.exception()
+        if exception is not None:
+            traceback.print_exception(
+                type(exception), exception, exception.__traceback__, file=sys.stderr
+            )
+            return
+
+        result = future.result()
+        if result is None:
+            return
+
+        try:
+            client_socket = self._get_client_from_name_or_ip_port(client_data["ip"])
+        except ClientNotFound:
+            # The client disconnected while the function was running
+            return
+
+        self._send_to_socket(
+            client_socket,
+            b"$CMD$" + command.encode() + b"$MSG$" + self._send_type_cast(result),
+        )
+
+    def _send_reply(self, client_socket: socket.socket, call_id: bytes, future: Future):
+        """
+        Sends the result of a function to the client that called it with
+        :meth:`HiSockClient.call`, or the exception the function raised. This can
+        be called from any thread.
+
+        :param client_socket: The client socket that made the call
+        :type client_socket: socket.socket
+        :param call_id: The ID of the call, as the client sent it
+        :type call_id: bytes
+        :param future: The future of the result of the function.
+        :type future: concurrent.futures.Future
+        """
+
+        self._send_to_socket(client_socket, _make_reply(call_id, future))
+
+    def _make_invoker(
+        self, command: str, func: dict, number_of_func_args: int
+    ) -> Callable:
+        """
+        Prepares a function registered with :meth:`on` to be called for a message,
+        so the arguments to pass and the type cast are only resolved once.
+
+        :param command: The command the function is registered for
+        :type command: str
+        :param func: The function data stored in :attr:`funcs`
+        :type func: dict
+        :param number_of_func_args: The number of arguments the function takes
+        :type number_of_func_args: int
+        :return: The invoker, which is called with the client data, the content
+            of the message and, for calls, the reply callback of :meth:`_run_function`
+        :rtype: Callable[[dict, bytes, Optional[Callable]], None]
+        """
+
+        # No type hint: the content is passed in as a string
+        type_cast = func["type_hint"].get("message", str)
+
+        if func["executor"] == "process":
+            return self._make_process_invoker(
+                command, func, number_of_func_args, type_cast
+            )
+
+        if number_of_func_args == 0:
+            invoke = lambda client_data, content, reply=None: self._run_function(
+                func, reply=reply
+            )
+        elif number_of_func_args == 1:
+            invoke = lambda client_data, content, reply=None: self._run_function(
+                func, client_data, reply=reply
+            )
+        else:
+
+            def invoke(client_data: dict, content: bytes, reply: Callable = None):
+                self._run_function(
+                    func,
+                    client_data,
+                    _type_cast(type_cast, content, func["name"]),
+                    reply=reply,
+                )
+
+        if func["ordered_by"] is None:
+            return invoke
+
+        # Ordered: the whole invoker runs in the handler pool, after the earlier
+        # messages of the same client or group
+        key_name = "ip" if func["ordered_by"] == "client" else "group"
+
+        def invoke_ordered(client_data: dict, content: bytes, reply: Callable = None):
+            try:
+                self.handler_pool.submit_keyed(
+                    (key_name, client_data[key_name]),
+                    invoke,
+                    client_data,
+                    content,
+                    reply,
+                )
+            except HandlerPoolFull as e:
+                warnings.warn(f"{func['name']} was not run: {e}", UserWarning)
+                if reply is not None:
+                    reply(_done_future(exception=e))
+
+        return invoke_ordered
 
-        :raise FunctionNotFoundException: If the function is not found.
+    def _make_process_invoker(
+        self, command: str, func: dict, number_of_func_args: int, type_cast: type
+    ) -> Callable:
+        """
+        Prepares a function registered with ``executor="process"``, see
+        :meth:`_make_invoker`. The type casted arguments are sent to
+        :attr:`process_pool`, and the result is sent back to the client by `run`
+        (as the reply, if it was a call).
         """
 
-        func: dict
+        if self.process_pool is None:
+            # Forked processes would inherit the server and client sockets, so
+            # clients that are disconnected wouldn't see their connection close
+            start_method = (
+                "forkserver"
+                if "forkserver" in multiprocessing.get_all_start_methods()
+                else "spawn"
+            )
+            self.process_pool = ProcessPoolExecutor(
+                mp_context=multiprocessing.get_context(start_method)
+            )
 
-        # Find the function by the function name
-        if sort_by_name:
-            for func_command, func_data in self.funcs.items():
-                if func_data["name"] == func_name:
-                    func = func_command
-                    break
-            else:
-                raise FunctionNotFoundException(
-                    f"Function with name {func_name} not found"
-                )
-        # Find the function by the function command
-        else:
-            if func_name not in self.funcs:
-                raise FunctionNotFoundException(
-                    f"Function with command {func_name} not found"
-                )
-            func = func_name
+        def invoke_in_process(
+            client_data: dict, content: bytes, reply: Callable = None
+        ):
+            arguments = (client_data,)
+            if number_of_func_args == 2:
+                arguments += (_type_cast(type_cast, content, func["name"]),)
 
-        # Normal
-        if not self.funcs[func]["threaded"]:
-            self.funcs[func]["func"](*args, **kwargs)
-            return
+            future = self.process_pool.submit(
+                func["func"], *arguments[:number_of_func_args]
+            )
+            if reply is not None:
+                future.add_done_callback(reply)
+                return
+            future.add_done_callback(
+                lambda future: self._call_in_reactor(
+                    self._send_function_result, client_data, command, future
+                )
+            )
 
-        # Threaded
-        function_thread = threading.Thread(
-            target=self.funcs[func]["func"],
-            args=args,
-            kwargs=kwargs,
-            daemon=True,
-        )
-        function_thread.start()
+        return invoke_in_process
 
     class _on:
         """Decorator used to handle something when receiving command"""
@@ -481,13 +1519,27 @@ class HiSockServer:
             command: str,
             threaded: bool,
             override: bool,
+            ordered_by: str = None,
+            executor: str = None,
         ):
             self.outer = outer
             self.command = command
-            self.threaded = threaded
+            self.threaded = threaded or executor == "thread"
             self.override = override
+            self.ordered_by = ordered_by
+            self.executor = executor
 
             validate_command_not_reserved(self.command)
+            if self.ordered_by not in (None, "client", "group"):
+                raise ValueError(
+                    f'ordered_by must be None, "client" or "group", not {ordered_by!r}.'
+                )
+            if self.executor not in (None, "thread", "process"):
+                raise ValueError(
+                    f'executor must be None, "thread" or "process", not {executor!r}.'
+                )
+            if self.executor == "process" and self.ordered_by is not None:
+                raise ValueError("Functions run in a process can't be ordered.")
 
         def __call__(self, func: Callable) -> Callable:
             """
@@ -499,13 +1551,18 @@ class HiSockServer:
             func_args = inspect.getfullargspec(func).args
 
             # Overriding a reserved command, remove it from reserved functions
-            if self.override:
-                if self.command in self.outer.reserved_commands.keys():
-                    self.outer.funcs.pop(self.command)
+            if self.override and self.command in self.outer._reserved_functions:
+                self.outer.funcs.pop(self.command, None)
 
                 index = self.outer._reserved_functions.index(self.command)
-                self.outer._reserved_functions.pop(index)
-                self.outer._reserved_functions_parameters_num.pop(index)
+                self.outer._reserved_functions = (
+                    self.outer._reserved_functions[:index]
+                    + self.outer._reserved_functions[index + 1 :]
+                )
+                self.outer._reserved_functions_parameters_num = (
+                    self.outer._reserved_functions_parameters_num[:index]
+                    + self.outer._reserved_functions_parameters_num[index + 1 :]
+                )
 
             self._assert_num_func_args_valid(len(func_args))
 
@@ -529,13 +1586,31 @@ class HiSockServer:
                         continue
                     parameter_annotations[argument_name] = annotations[func_argument]
 
+            if (
+                self.ordered_by is not None or self.executor == "process"
+            ) and inspect.iscoroutinefunction(func):
+                raise ValueError(
+                    f"{self.command} is a coroutine function, it can't be ordered "
+                    "or run in a process."
+                )
+
             # Add function
-            self.outer.funcs[self.command] = {
+            func_data = {
                 "func": func,
                 "name": func.__name__,
                 "type_hint": parameter_annotations,
-                "threaded": self.threaded,
+                # Ordered functions already run in the handler pool
+                "threaded": self.threaded and self.ordered_by is None,
+                "ordered_by": self.ordered_by,
+                "executor": self.executor,
             }
+            func_data["invoke"] = self.outer._make_invoker(
+                self.command, func_data, len(func_args)
+            )
+            self.outer.funcs[self.command] = func_data
+
+            if self.command not in self.outer._reserved_functions:
+                self.outer._dispatch[self.command] = func_data["invoke"]
 
             # Decorator stuff
             return func
@@ -573,7 +1648,12 @@ class HiSockServer:
                 )
 
     def on(
-        self, command: str, threaded: bool = False, override: bool = False
+        self,
+        command: str,
+        threaded: bool = False,
+        override: bool = False,
+        ordered_by: str = None,
+        executor: str = None,
     ) -> Callable:
         """
         A decorator that adds a function that gets called when the server
@@ -608,31 +1688,149 @@ class HiSockServer:
         - ``None``
         - ``list`` (with the types listed here)
         - ``dict`` (with the types listed here)
+        - ``File`` (for files sent with :meth:`HiSockClient.send_file`)
 
         For more information, read the wiki for type casting.
 
         :param command: A string representing the command the function should activate
             when receiving it.
         :type command: str
-        :param threaded: A boolean representing if the function should be run in a thread
-            in order to not block the run() loop.
+        :param threaded: A boolean representing if the function should be run in
+            :attr:`handler_pool` in order to not block the run() loop.
             Default is False.
         :type threaded: bool
         :param override: A boolean representing if the function should override the
             reserved function with the same name and to treat it as an unreserved function.
             Default is False.
         :type override: bool
+        :param ordered_by: Either ``"client"`` or ``"group"``, to run the function in
+            :attr:`handler_pool` one message at a time, in the order the messages of
+            the same client (or group) arrived. Messages of different clients (or groups)
+            are still handled in parallel. Only used for unreserved commands and
+            ``message``.
+            Default is None (not ordered).
+        :type ordered_by: str, optional
+        :param executor: Either ``"thread"`` (the same as ``threaded=True``) or
+            ``"process"``, to run CPU-bound functions in :attr:`process_pool`, so they
+            aren't held back by the GIL. The function gets the client data and the
+            type casted message, so it must be picklable (defined at the top level of
+            a module), and if it returns something other than None, the result is
+            sent back to the client with the same command. Only used for unreserved
+            commands and ``message``.
+            Default is None (the function is run in the run() loop, unless it's threaded).
+        :type executor: str, optional
         :return: The same function (the decorator just appended the function to a stack).
         :rtype: function
 
-        :raise ValueError: If the number of function arguments is invalid.
+        :raise ValueError: If the number of function arguments is invalid, or if
+            ``ordered_by`` or ``executor`` is invalid.
         """
 
         # Passes in outer to _on decorator/class
-        return self._on(self, command, threaded, override)
+        return self._on(self, command, threaded, override, ordered_by, executor)
+
+    def train_compression_dictionary(
+        self, samples: list[bytes] = None, size: int = 16384
+    ) -> int:
+        """
+        Builds a new preset dictionary for the ``"zlib-dict"`` codec, which makes
+        small messages that look alike (like JSON objects with the same keys)
+        compress well. Clients that connect from now on get it in the hello, and
+        the clients that are already connected keep the dictionary they have.
+
+        :param samples: The data of messages like the ones that will be sent.
+            Default is None (the messages in :attr:`cache`).
+        :type samples: list[bytes], optional
+        :param size: The maximum size of the dictionary, at most 32 KiB.
+            Default is 16 KiB.
+        :type size: int, optional
+        :return: The version of the dictionary
+        :rtype: int
+
+        :raise ServerException: If there are no samples.
+        """
+
+        if samples is None:
+            samples = [
+                (
+                    cached.content
+                    if cached.command is None
+                    else b"$CMD$" + cached.command.encode() + b"$MSG$" + cached.content
+                )
+                for cached in (self.cache or ())
+            ]
+        if not samples:
+            raise ServerException("There are no samples to build a dictionary from.")
+
+        zdict = _build_dictionary(samples, size)
+        self.compression_dictionary_version += 1
+        self._dictionaries[self.compression_dictionary_version] = (
+            zdict,
+            _dictionary_codec(zdict),
+        )
+
+        # A client only records the codec it got after its hello is sent, so
+        # the old dictionaries are pruned by the thread that sends the hellos
+        if self._run_thread_id in (None, threading.get_ident()):
+            self._prune_dictionaries()
+        else:
+            self._call_in_reactor(self._prune_dictionaries)
+
+        return self.compression_dictionary_version
+
+    def _prune_dictionaries(self):
+        """Forgets the old dictionaries that no client uses anymore"""
+
+        used = {
+            client_info.frame_reader.codec
+            for client_info in list(self._connections.values())
+        }
+        for version, (_, codec) in list(self._dictionaries.items()):
+            if version != self.compression_dictionary_version and codec not in used:
+                del self._dictionaries[version]
 
     # Getters
 
+    def get_cache(
+        self,
+        idx: Union[int, slice, None] = None,
+        command: str = None,
+        client: Union[str, tuple[str, int]] = None,
+        since: float = None,
+        until: float = None,
+    ) -> list[MessageCacheMember]:
+        """
+        Gets the cached messages that match all the given filters, oldest first.
+        The filters use the indexes of the cache, so they don't go through
+        every cached message.
+
+        :param idx: An integer or ``slice``, specifying which of the matching
+            messages to return.
+
+            Default is None (Retrieves all of them)
+        :type idx: Union[int, slice], optional
+        :param command: Only get the messages of this command
+        :type command: str, optional
+        :param client: Only get the messages sent by the client with this
+            address, as a tuple or an "ip:port" string. Clients that left are
+            still in the cache, so names aren't supported.
+        :type client: Union[str, tuple[str, int]], optional
+        :param since: Only get the messages received at this Unix timestamp or later
+        :type since: float, optional
+        :param until: Only get the messages received at this Unix timestamp or earlier
+        :type until: float, optional
+
+        :return: A list of the cached messages, or the message at ``idx``
+        :rtype: list[MessageCacheMember]
+        """
+
+        if self.cache is None:
+            return []
+
+        if isinstance(client, str):
+            client = ipstr_to_tup(client)
+        return self.cache.get(idx, command, client, since, until)
+
     def _get_client_from_name_or_ip_port(self, client: Client) -> socket.socket:
         """
         Gets a client socket from a name or tuple in the form of (ip, port).
@@ -648,64 +1846,41 @@ class HiSockServer:
             the same name is detected.
         """
 
-        ret_client_socket = None
-
         # Search by IPv4
         if isinstance(client, tuple):
-            try:
-                validate_ipv4(client)  # Raises ValueError if invalid
-                client_socket: socket.socket = next(
-                    _dict_tupkey_lookup(
-                        client,
-                        self.clients_rev,
-                        idx_to_match=0,
-                    )
-                )
-            except StopIteration:
+            validate_ipv4(client)  # Raises ValueError if invalid
+            client_socket = self.clients.by_address(client)
+            if client_socket is None:
                 raise ClientNotFound(f'Client with IP "{client}" is not connected.')
+            return client_socket
 
-            ret_client_socket = client_socket
-
-        # Search by name
-        elif isinstance(client, str):
-            try:
-                # Modify dictionary so only names are included
-                try:
-                    client = ipstr_to_tup(client)
-                except ValueError:
-                    client_sockets = list(
-                        _dict_tupkey_lookup(
-                            client,
-                            self.clients_rev,
-                            idx_to_match=1,
-                        )
-                    )
-                else:
-                    client_sockets = list(
-                        _dict_tupkey_lookup(
-                            client,
-                            self.clients_rev,
-                            idx_to_match=0,
-                        )
-                    )
-
-            except StopIteration:
-                raise TypeError(f'Client with name "{client}" does not exist.')
-
-            if len(client_sockets) > 1:
-                warnings.warn(
-                    f'{len(client_sockets)} clients with name "{client}" detected; sending data to '
-                    f"Client with IP {':'.join(map(str, client_sockets[0].getpeername()))}"
-                )
-            ret_client_socket = client_sockets[0]
+        if not isinstance(client, str):
+            raise ValueError("Client format is wrong (must be of type tuple or str).")
 
+        # Search by IPv4 string
+        try:
+            address = ipstr_to_tup(client)
+        except ValueError:
+            pass
         else:
-            raise ValueError("Client format is wrong (must be of type tuple or str).")
+            client_socket = self.clients.by_address(address)
+            if client_socket is None:
+                raise ClientNotFound(f'Client with IP "{client}" is not connected.')
+            return client_socket
 
-        if ret_client_socket is None:
-            raise ValueError("Client socket does not exist.")
+        # Search by name
+        client_sockets = self.clients.by_name(client)
+        if not client_sockets:
+            raise ClientNotFound(f'Client with name "{client}" does not exist.')
+
+        client_socket = client_sockets[0]
+        if len(client_sockets) > 1:
+            warnings.warn(
+                f'{len(client_sockets)} clients with name "{client}" detected; sending data to '
+                f"Client with IP {':'.join(map(str, client_socket.getpeername()))}"
+            )
 
-        return ret_client_socket
+        return client_socket
 
     def _get_all_client_sockets_in_group(self, group: str) -> iter[socket.socket]:
         """
@@ -720,7 +1895,8 @@ class HiSockServer:
            If the group does not exist, an empty iterable is returned.
         """
 
-        return _dict_tupkey_lookup(group, self.clients_rev, idx_to_match=2)
+        # A copy, as clients can leave the group while sending from another thread
+        return self.clients.by_group(group)
 
     def start(self):
         """
@@ -754,13 +1930,17 @@ class HiSockServer:
 
         mod_group_clients = []  # Will be a list of dicts
 
-        for client in self._get_all_client_sockets_in_group(group):
-            socket = self.clients_rev[client]
+        for client_socket in self._get_all_client_sockets_in_group(group):
+            client_info = self.clients.get(client_socket)
+            # Left in the meantime
+            if client_info is None:
+                continue
+
             mod_dict = {
-                "ip": client[0],
-                "name": client[1],
-                "group": client[2],
-                "socket": socket,
+                "ip": client_info["ip"],
+                "name": client_info["name"],
+                "group": client_info["group"],
+                "socket": client_socket,
             }
             mod_group_clients.append(mod_dict)
 
@@ -774,9 +1954,14 @@ class HiSockServer:
     ) -> list[dict[str, str]]:  # TODO: Add socket output as well
         """
         Get all clients currently connected to the server.
-        This is recommended over the class attribute :ivar:`self._clients` or
+        This is recommended over the class attribute :ivar:`self.clients` or
         :ivar:`self.clients_rev`, as it is in a dictionary-like format.
 
+        .. note::
+            The client data is shared with the server, so it mustn't be changed.
+            It's only gathered again after a client joins, leaves or changes,
+            so calling this repeatedly is cheap.
+
         :param key: If specified, there are two outcomes: If it is a string,
             it will search for the dictionary for the key, and output it to a list
             (currently supports "ip", "name", "group").
@@ -787,16 +1972,10 @@ class HiSockServer:
         :rtype: list[dict, ...]
         """
 
-        clients = []
-        for client in self.clients_rev:
-            client_dict = {
-                dict_key: client[value]
-                for value, dict_key in enumerate(("ip", "name", "group"))
-            }
-            clients.append(client_dict)
+        clients = self.clients.snapshot()
 
         if key is None:
-            return clients
+            return list(clients)
 
         filter_clients = []
         if isinstance(key, str):
@@ -825,6 +2004,15 @@ class HiSockServer:
 
         return self.clients[self._get_client_from_name_or_ip_port(client)]
 
+    @property
+    def clients_rev(self) -> dict[tuple, socket.socket]:
+        """
+        The clients keyed by their client info, in the form of
+        ``{((ip, port), name, group): socket}``
+        """
+
+        return self.clients.reversed()
+
     def get_addr(self) -> tuple[str, int]:
         """
         Gets the address of where the HiSock server is serving at.
@@ -847,12 +2035,11 @@ class HiSockServer:
         :type content: Sendable, optional
         """
 
-        data_to_send = (
-            b"$CMD$" + command.encode() + b"$MSG$" + self._send_type_cast(content)
-        )
-        content_header = make_header(data_to_send, self.header_len)
-        for client in self.clients:
-            client.send(content_header + data_to_send)
+        command_prefix = _command_prefix(command)
+        content = self._send_type_cast(content)
+        # Clients can disconnect while sending from another thread
+        for client in list(self.clients):
+            self._send_to_socket(client, command_prefix, content)
 
     def send_all_clients_raw(self, content: Sendable = None):
         """
@@ -862,9 +2049,10 @@ class HiSockServer:
         :type content: Sendable
         """
 
-        content_header = make_header(content, self.header_len)
-        for client in self.clients:
-            client.send(content_header + content)
+        data_to_send = self._send_type_cast(content)
+        # Clients can disconnect while sending from another thread
+        for client in list(self.clients):
+            self._send_to_socket(client, data_to_send)
 
     def send_group(self, group: str, command: str, content: Sendable = None):
         """
@@ -883,12 +2071,10 @@ class HiSockServer:
         :raise GroupNotFound: The group does not exist.
         """
 
-        data_to_send = (
-            b"$CMD$" + command.encode() + b"$MSG$" + self._send_type_cast(content)
-        )
-        content_header = make_header(data_to_send, self.header_len)
+        command_prefix = _command_prefix(command)
+        content = self._send_type_cast(content)
         for client in self._get_all_client_sockets_in_group(group):
-            client.send(content_header + data_to_send)
+            self._send_to_socket(client, command_prefix, content)
 
     def send_client(self, client: Client, command: str, content: Sendable = None):
         """
@@ -908,12 +2094,10 @@ class HiSockServer:
             the same name is detected.
         """
 
-        data_to_send = (
-            b"$CMD$" + command.encode() + b"$MSG$" + self._send_type_cast(content)
-        )
-        content_header = make_header(data_to_send, self.header_len)
-        self._get_client_from_name_or_ip_port(client).send(
-            content_header + data_to_send
+        self._send_to_socket(
+            self._get_client_from_name_or_ip_port(client),
+            _command_prefix(command),
+            self._send_type_cast(content),
         )
 
     def send_client_raw(self, client: Client, content: Sendable = None):
@@ -934,10 +2118,8 @@ class HiSockServer:
         """
 
         data_to_send = self._send_type_cast(content)
-        content_header = make_header(data_to_send, self.header_len)
-        print(f"{content_header=}, {data_to_send=}")
-        self._get_client_from_name_or_ip_port(client).send(
-            content_header + data_to_send
+        self._send_to_socket(
+            self._get_client_from_name_or_ip_port(client), data_to_send
         )
 
     def send_group_raw(self, group: str, content: Sendable = None):
@@ -959,69 +2141,253 @@ class HiSockServer:
         """
 
         data_to_send = self._send_type_cast(content)
-        content_header = make_header(data_to_send, self.header_len)
         for client in self._get_all_client_sockets_in_group(group):
-            client.send(content_header + data_to_send)
+            self._send_to_socket(client, data_to_send)
 
-    def recv_raw(self, ignore_reserved: bool = False) -> bytes:
+    def send_file(
+        self,
+        client: Client,
+        command: str,
+        file_path: Union[str, pathlib.Path],
+        chunk_size: int = 65536,
+        progress: Callable = None,
+    ) -> File:
         """
-        Waits (blocks) until a message is sent, and returns that message.
-        This is not recommended for content with commands attached;
-        it is meant to be used alongside with :func:`HiSockClient.send_raw`.
+        Sends a file to a specific client, in chunks. Once all of it is received,
+        the client's function for the command is called with the received
+        :class:`File`.
+
+        The chunks are sent by :meth:`run` with :func:`os.sendfile` whenever the
+        client can take more, so the file isn't read into memory, and other
+        messages are sent between its chunks. Several files can be sent at once.
+        Files aren't journaled.
+
+        The file is hashed on a thread first. If the client already has some of
+        its chunks, because an earlier transfer of it was cut off (e.g. by a
+        reconnection), only the rest is sent. The transfer is over once the
+        client verified the file.
+
+        :param client: The client to send the file to. The format could be either
+            by IP+port, or a client name.
+        :type client: Client
+        :param command: A string, containing the command to send the file with
+        :type command: str
+        :param file_path: The path of the file to send
+        :type file_path: Union[str, pathlib.Path]
+        :param chunk_size: The number of bytes in every chunk.
+            Default is 64 KiB.
+        :type chunk_size: int, optional
+        :param progress: Called with the :class:`File` after every chunk is sent.
+            Default is None.
+        :type progress: Callable[[File], None], optional
+        :return: The file, see :meth:`File.wait` to wait until it's received
+        :rtype: File
 
-        :param ignore_reserved: A boolean, representing if the function should ignore
-            reserved commands.
-            Default is False.
-        :type ignore_reserved: bool, optional
+        :raise ClientNotFound: If the client does not exist.
+        :raise ServerException: If the client can't receive files.
+        :raise OSError: If the file can't be opened.
+        """
 
-        .. note::
-            If the message is a keepalive, the client will send an acknowledgement and
-            then ignore it, even if ``ignore_reserved`` is False.
+        client_socket = self._get_client_from_name_or_ip_port(client)
+        if not self.clients[client_socket].files:
+            raise ServerException(f"Client {client} can't receive files.")
 
-        :return: A bytes-like object, containing the content/message
-            the client first receives
-        :rtype: bytes
+        file = File(file_path)
+        file._open(command, next(self._file_ids), chunk_size, progress)
+        threading.Thread(
+            target=self._hash_file, args=(client_socket, file), daemon=True
+        ).start()
+        return file
+
+    def call_client(
+        self,
+        client: Client,
+        command: str,
+        content: Sendable = None,
+        timeout: float = None,
+        return_type: type = bytes,
+    ) -> CallFuture:
         """
+        Sends a command & content to a specific client, like :meth:`send_client`,
+        and returns the future of the reply. The client replies with what its
+        function for the command returns (or with the exception it raised).
 
-        def _handle_data(data: bytes):
-            # DEBUG PRINT PLEASE REMOVE LATER
-            print(f"Received data: {data}")
+        The reply is received by :meth:`run`, so the result can't be waited for
+        on the thread that runs the server (use a threaded function, or
+        :meth:`concurrent.futures.Future.add_done_callback`).
 
-            # Reserved commands
-            reserved_command = True
-            try:
-                validate_command_not_reserved(str(data))
-            except ValueError:
-                reserved_command = False
+        :param client: The client to call. The format could be either by IP+port,
+            or a client name.
+        :type client: Client
+        :param command: A string, containing the command to send
+        :type command: str
+        :param content: The message / content to send
+        :type content: Sendable, optional
+        :param timeout: The number of seconds to wait for the reply, after which
+            the future fails with :class:`TimeoutError`.
+            Default is None (waits forever).
+        :type timeout: float, optional
+        :param return_type: The type to type cast the reply to.
+            Default is bytes.
+        :type return_type: type, optional
+        :return: The future of the reply. It fails with :class:`CallError` if the
+            function failed or there's no function for the command, and with
+            :class:`ClientNotFound` if the client disconnects before replying.
+        :rtype: CallFuture
+
+        :raise ClientNotFound: If the client does not exist.
+        :raise ServerException: If the client doesn't support calls.
+        """
+
+        client_socket = self._get_client_from_name_or_ip_port(client)
+        if not self.clients[client_socket].calls:
+            raise ServerException(f"Client {client} doesn't support calls.")
+
+        return self._call(
+            client_socket,
+            b"$CMD$" + command.encode() + b"$MSG$" + self._send_type_cast(content),
+            timeout,
+            return_type,
+        )
+
+    def call_group(
+        self,
+        group: str,
+        command: str,
+        content: Sendable = None,
+        timeout: float = None,
+        return_type: type = bytes,
+    ) -> GroupCallFuture:
+        """
+        Calls every client in a group, see :meth:`call_client`, and returns the
+        future of all of the replies.
+
+        The future is done once every client replied or failed to, which is at
+        most ``timeout`` seconds. Its result is a dictionary of the replies of
+        the clients that replied, by client address, and its ``errors`` are the
+        exceptions of the ones that didn't (e.g. they timed out, disconnected
+        or don't support calls). ``partial()`` returns the replies received so far.
+
+        :param group: A string, representing the group to call.
+        :type group: str
+        :param command: A string, containing the command to send
+        :type command: str
+        :param content: The message / content to send
+        :type content: Sendable, optional
+        :param timeout: The number of seconds to wait for the replies.
+            Default is None (waits forever).
+        :type timeout: float, optional
+        :param return_type: The type to type cast the replies to.
+            Default is bytes.
+        :type return_type: type, optional
+        :return: The future of the replies, by client address
+        :rtype: GroupCallFuture
+        """
+
+        message = b"$CMD$" + command.encode() + b"$MSG$" + self._send_type_cast(content)
+
+        futures = {}
+        for client_socket in self._get_all_client_sockets_in_group(group):
+            client_info = self.clients.get(client_socket)
+            # Left while calling the group
+            if client_info is None:
+                continue
+
+            if client_info.calls:
+                futures[client_info.ip] = self._call(
+                    client_socket, message, timeout, return_type
+                )
+            else:
+                futures[client_info.ip] = future = CallFuture()
+                future.set_exception(
+                    ServerException(f"Client {client_info.ip} doesn't support calls.")
+                )
+
+        return GroupCallFuture(futures, self._wait_for_reply)
+
+    def _call(
+        self,
+        client_socket: socket.socket,
+        message: bytes,
+        timeout: float = None,
+        return_type: type = bytes,
+    ) -> CallFuture:
+        """
+        Sends a message to a client as a call, see :meth:`call_client`
+
+        :param client_socket: The client socket to call
+        :type client_socket: socket.socket
+        :param message: The message the client handles, e.g. a command
+        :type message: bytes
+        :param timeout: The number of seconds to wait for the reply
+        :type timeout: float, optional
+        :param return_type: The type to type cast the reply to
+        :type return_type: type, optional
+        :return: The future of the reply
+        :rtype: CallFuture
+        """
+
+        future = CallFuture(self._wait_for_reply)
+        call_id = self._calls.add(future, timeout, return_type, owner=client_socket)
+        self._send_to_socket(client_socket, b"$CALL$%d" % call_id + message)
+        if timeout is not None:
+            # `run` waits until the new timeout at most
+            self._call_in_reactor(self._calls.expire)
+        return future
 
-            if reserved_command and not ignore_reserved:
-                return self.recv_raw()
+    def _wait_for_reply(self, future: CallFuture, timeout: Union[float, None]):
+        """
+        Waits until the future of a call is done, the reply is received by :meth:`run`
+
+        :param future: The future of the call
+        :type future: CallFuture
+        :param timeout: The number of seconds to wait, or None to wait forever
+        :type timeout: Union[float, None]
+
+        :raise ServerException: If it's called from the thread that runs the
+            server, as it would wait forever.
+        """
 
-            return data
+        if threading.get_ident() == self._run_thread_id:
+            raise ServerException(
+                "A reply can't be waited for on the thread that runs the server."
+            )
+
+        wait((future,), timeout)
+
+    def recv_raw(self, ignore_reserved: bool = False, timeout: float = None) -> bytes:
+        """
+        Waits (blocks) until a client sends a message without a command, and
+        returns that message.
+        This is not recommended for content with commands attached;
+        it is meant to be used alongside with :func:`HiSockClient.send_raw`.
 
-        # Sometimes, `update` can be running at the same time as this is running
-        # (e.x. if this is in a thread). In this case, `update` will receive the data
-        # and send it to us, as we cannot receive data at the same time as it receives
-        # data.
+        The message is received by :meth:`run`, which hands it over, so the
+        server has to run on another thread (like :class:`ThreadedHiSockServer`
+        does). Waiting doesn't use any CPU.
 
-        if self._receiving_data:
-            self._recv_data = "I NEED YOUR DATA"
+        :param ignore_reserved: Unused, as reserved commands are always handled
+            by the server. Kept for compatibility.
+        :type ignore_reserved: bool, optional
+        :param timeout: The number of seconds to wait for a message.
+            Default is None (waits forever).
+        :type timeout: float, optional
 
-            # Wait until the data is received
-            while self._recv_data == "I NEED YOUR DATA":
-                "...waiting..."
+        :return: A bytes-like object, containing the content/message
+            the client first receives
+        :rtype: bytes
 
-            # Data is received
-            data_received = self._recv_data
-            self._recv_data = ""
-            return _handle_data(data_received)
+        :raise TimeoutError: If no message was received in time.
+        :raise ServerException: If it's called from the thread that runs the
+            server, as it would wait forever.
+        """
 
-        self._receiving_data = True
-        message_len = int(self.sock.recv(self.header_len).decode())
-        data_received = self.sock.recv(message_len)
-        self._receiving_data = False
+        if threading.get_ident() == self._run_thread_id:
+            raise ServerException(
+                "recv_raw can't be called from the thread that runs the server."
+            )
 
-        return _handle_data(data_received)
+        return self._mailbox.get(timeout)
 
     # Disconnect
 
@@ -1045,11 +2411,21 @@ class HiSockServer:
             self.send_client_raw(self.clients[client_socket]["ip"], b"$DISCONN$")
             return
 
-        client_socket.close()
-        self._sockets_list.remove(client_socket)
-        del self.clients[client_socket]
-        self._update_clients_rev_dict()
-        # Note: ``self._unresponsive_clients`` should be handled by the keepalive
+        # The selector may only be changed by the run loop, and the client
+        # could be in the events `run` is going through
+        self._call_in_reactor(self._drop_client, client_socket)
+
+    def _drop_client(self, client_socket: socket.socket):
+        """
+        Disconnects a client without calling the leave function, if it's
+        still connected
+
+        :param client_socket: The client socket
+        :type client_socket: socket.socket
+        """
+
+        if client_socket in self.clients:
+            self._client_disconnection(client_socket, call_func=False)
 
     def disconnect_all_clients(self, force=False):
         """Disconnect all clients."""
@@ -1058,11 +2434,10 @@ class HiSockServer:
             self.send_all_clients_raw("$DISCONN$")
             return
 
-        (conn.close() for conn in self._sockets_list)
-        self._sockets_list.clear()
+        for client_socket in list(self.clients):
+            self._close_client_socket(client_socket)
+            self._forget_connection(client_socket)
         self.clients.clear()
-        self.clients_rev.clear()
-        self._unresponsive_clients.clear()
 
     def run(self):
         """
@@ -1074,14 +2449,36 @@ class HiSockServer:
         if self.closed:
             return
 
-        read_sock, write_sock, exception_sock = select.select(
-            self._sockets_list, [], self._sockets_list
-        )
+        self._run_thread_id = threading.get_ident()
+        # Wakes up for the next timeout of a call, see `call_client`
+        events = self._selector.select(timeout=self._calls.expire())
+        if not self.coalesce_writes:
+            self._handle_events(events)
+            return
+
+        # What's sent while handling the events is sent once they're handled
+        self._coalesced_sockets = []
+        try:
+            self._handle_events(events)
+        finally:
+            coalesced_sockets, self._coalesced_sockets = self._coalesced_sockets, None
+            for client_socket in coalesced_sockets:
+                self._write_coalesced(client_socket)
+
+    def _handle_events(self, ready: list):
+        """
+        Handles what the selector waited for in :meth:`run`
+
+        :param ready: The sockets that are ready, with their events
+        :type ready: list[tuple[selectors.SelectorKey, int]]
+        """
+
+        for key, events in ready:
+            client_socket = key.fileobj
 
-        for client_socket in read_sock:
-            # Handle bad client
+            # Handle bad client, or a client disconnected earlier in these events
             if client_socket.fileno() == -1:
-                self._client_disconnection(client_socket, call_func=False)
+                self._drop_client(client_socket)
                 continue
 
             ### Reserved ###
@@ -1091,170 +2488,253 @@ class HiSockServer:
                 self._new_client_connection(*self.sock.accept())
                 continue
 
+            # Handle calls from other threads
+            if client_socket == self._wakeup_recv:
+                self._run_reactor_calls()
+                continue
+
+            # Sending data that couldn't be sent right away
+            if events & selectors.EVENT_WRITE:
+                self._flush(client_socket)
+                self._send_file_chunk(client_socket)
+                self._update_send_events(client_socket)
+                if not events & selectors.EVENT_READ:
+                    continue
+
+            # The client disconnected while sending to it
+            client_info = self._connections.get(client_socket)
+            if client_info is None:
+                continue
+
             # Receiving data
+            # Everything the client sent is read at once, and then every
+            # complete message in it is handled
+            frame_reader = client_info.frame_reader
+            try:
+                connected = frame_reader.recv(client_socket, self._recv_buffer)
+            except BlockingIOError:
+                continue
+            except ConnectionResetError:
+                # This is most likely where clients will disconnect
+                connected = False
+
+            # Most likely client disconnect, could be client error
+            if not connected:
+                if client_socket not in self.clients:
+                    self._close_connection_awaiting_hello(client_socket)
+                    continue
+                self._client_disconnection(client_socket)
+                continue
 
             # "header" - The header of the message, mostly unneeded
             # "data" - The actual data/content of the message (type: bytes)
-            data = receive_message(client_socket, self.header_len)
+            for data in frame_reader.frames():
+                # The first message is always the client hello
+                if client_socket not in self.clients:
+                    self._client_hello(client_socket, data["data"])
+                    continue
 
-            # DEBUG PRINT PLEASE REMOVE LATER
-            print(f"{data=}")
+                client_info.messages_received += 1
+                self._handle_message(client_socket, data)
 
-            # Handle client disconnection
-            if (
-                not data  # Most likely client disconnect, could be client error
-                or data["data"] == b"$USRCLOSE$"
-            ):
-                self._client_disconnection(client_socket)
-                continue
+                # The client disconnected, the rest of its messages are dropped
+                if client_socket not in self.clients:
+                    break
 
-            # Handle keepalive acknowledgement
-            if data["data"].startswith(b"$KEEPACK$"):
-                self._handle_keepalive(client_socket)
-                continue
+    def _handle_message(self, client_socket: socket.socket, data: dict[str, bytes]):
+        """
+        Handles a message received from a client
 
-            # Actual client message received
-            client_data = self.clients[client_socket]
+        :param client_socket: The client socket that sent the message
+        :type client_socket: socket.socket
+        :param data: The received message, with the header and the data
+        :type data: dict["header": bytes, "data": bytes]
+        """
 
-            # Get client
-            if data["data"].startswith(b"$GETCLT$"):
-                try:
-                    client_identifier = _removeprefix(
-                        data["data"], b"$GETCLT$ "
-                    ).decode()
-
-                    # Determine if the client identifier is a name or an IP+port
-                    try:
-                        validate_ipv4(client_identifier)
-                        client_identifier = ipstr_to_tup(client_identifier)
-                    except ValueError:
-                        pass
-
-                    client = self.get_client(client_identifier)
-                except ValueError as e:
-                    client = {"traceback": f"{e!s}"}
-                except ClientNotFound:
-                    client = {"traceback": f"$NOEXIST$"}
-
-                self.send_client_raw(self.clients[client_socket]["ip"], client)
-                continue
+        # Files are written to disk instead of the journal
+        if data["data"].startswith(_FILE_MESSAGES):
+            self._receive_file(client_socket, data["data"])
+            return
 
-            # Change name or group
-            for matching_reserve, key in zip(
-                (b"$CHNAME$", b"$CHGROUP$"), ("name", "group")
-            ):
-                if not data["data"].startswith(matching_reserve):
-                    continue
+        if self.journal is not None:
+            self.journal.append(data["data"], self.clients[client_socket])
 
-                change_to = _removeprefix(
-                    data["data"], matching_reserve + b" "
-                ).decode()
+        # Handle client disconnection
+        if data["data"] == b"$USRCLOSE$":
+            self._client_disconnection(client_socket)
+            return
 
-                # Resetting
-                if change_to == data["data"].decode():
-                    change_to = None
+        # Handle keepalive acknowledgement
+        if data["data"].startswith(b"$KEEPACK$"):
+            self._handle_keepalive(client_socket)
+            return
 
-                client_info = self.clients[client_socket]
+        # Handle the reply to a call, only the client that was called can reply
+        if data["data"].startswith(b"$REPLY$"):
+            self._calls.resolve(*_parse_reply(data["data"]), owner=client_socket)
+            return
 
-                # Change it
-                changed_client_info = client_info.copy()
-                changed_client_info[key] = change_to
-                self.clients[client_socket] = changed_client_info
-                self._update_clients_rev_dict()
+        # Actual client message received
+        client_data = self.clients[client_socket]
 
-                # Call reserved function
-                reserved_func_name = f"{key}_change"
+        # A call: the message after the call ID is handled like any other, and
+        # the result of its function is sent back as the reply
+        reply = None
+        if data["data"].startswith(b"$CALL$"):
+            call_id, _, message = data["data"][6:].partition(b"$")
+            reply = lambda future: self._send_reply(client_socket, call_id, future)
+            data = {"header": data["header"], "data": b"$" + message}
 
-                if reserved_func_name in self._reserved_functions:
-                    old_value = client_info[key]
-                    new_value = changed_client_info[key]
+        # Get client
+        if data["data"].startswith(b"$GETCLT$"):
+            try:
+                client_identifier = _removeprefix(data["data"], b"$GETCLT$ ").decode()
 
-                    self._call_function(
-                        reserved_func_name,
-                        False,
-                        changed_client_info,
-                        old_value,
-                        new_value,
-                    )
+                # Determine if the client identifier is a name or an IP+port
+                try:
+                    validate_ipv4(client_identifier)
+                    client_identifier = ipstr_to_tup(client_identifier)
+                except ValueError:
+                    pass
+
+                client = self.get_client(client_identifier)
+            except ValueError as e:
+                client = {"traceback": f"{e!s}"}
+            except ClientNotFound:
+                client = {"traceback": f"$NOEXIST$"}
+
+            if reply is not None:
+                reply(_done_future(client))
+                return
+            self.send_client_raw(self.clients[client_socket]["ip"], client)
+            return
 
-            ### Unreserved ###
+        # Change name or group
+        for matching_reserve, key in zip(
+            (b"$CHNAME$", b"$CHGROUP$"), ("name", "group")
+        ):
+            if not data["data"].startswith(matching_reserve):
+                continue
 
-            has_corresponding_function = False  # For cache
+            change_to = _removeprefix(data["data"], matching_reserve + b" ").decode()
 
-            decoded_data = data["data"].decode()
-            if decoded_data.startswith("$CMD$"):
-                command = decoded_data.lstrip("$CMD$").split("$MSG$")[0]
-                content = _removeprefix(decoded_data, "$CMD$" + command + "$MSG$")
-                # No content? (_removeprefix didn't do anything)
-                if not content or content == decoded_data:
-                    content = None
+            # Resetting
+            if change_to == data["data"].decode():
+                change_to = None
 
-                for matching_command, func in self.funcs.items():
-                    if not command == matching_command:
-                        continue
+            old_value = self.clients[client_socket][key]
 
-                    # Call function with dynamic args
-
-                    arguments = ()
-                    # client_data
-                    if len(func["type_hint"].keys()) == 1:
-                        arguments = (client_data,)
-                    # client_data, message
-                    elif len(func["type_hint"].keys()) >= 2:
-                        arguments = (
-                            client_data,
-                            _type_cast(
-                                func["type_hint"]["message"], content, func["name"]
-                            ),
-                        )
+            # Change it
+            client_info = self.clients.update(client_socket, **{key: change_to})
 
-                    # DEBUG PRINT PLEASE REMOVE LATER
-                    print(
-                        f"{command=} {arguments=} len: {len(arguments)} {arguments}"
-                        f"list of type hints: {tuple(func['type_hint'].keys())}"
-                    )
+            # Call reserved function
+            reserved_func_name = f"{key}_change"
 
-                    self._call_function(func["name"], True, *arguments)
-            else:
-                # Not a reserved or unreserved message??
-                # Should it be handled by `recv_raw`?
-                print(f'Unhandled message: {data["data"]}')
-
-            # Caching
-            if self.cache_size >= 0:
-                cache_content = content if has_corresponding_function else data["data"]
-                self.cache.append(
-                    MessageCacheMember(
-                        {
-                            "header": data["header"],
-                            "command": command,
-                            "content": cache_content,
-                            "called": has_corresponding_function,
-                        }
+            if reserved_func_name in self.funcs:
+                self._call_function(
+                    reserved_func_name,
+                    False,
+                    client_info,
+                    old_value,
+                    change_to,
+                )
+            return
+
+        ### Unreserved ###
+
+        has_corresponding_function = False  # For cache
+        command = None
+
+        if data["data"].startswith(b"$CMD$"):
+            command, _, content = data["data"][5:].partition(b"$MSG$")
+            command = command.decode()
+
+            invoke = self._dispatch.get(command)
+            if invoke is not None:
+                has_corresponding_function = True
+                invoke(client_data, content, reply)
+            elif reply is not None:
+                reply(
+                    _done_future(
+                        exception=FunctionNotFoundException(
+                            f"No function is registered for {command}"
+                        )
                     )
                 )
+        elif reply is not None:
+            reply(
+                _done_future(exception=ServerException("Only commands can be called."))
+            )
+        # A message without a command, which `recv_raw` may be waiting for
+        elif not self._mailbox.put(data["data"]):
+            print(f'Unhandled message: {data["data"]}')
+
+        # Caching
+        if self.cache is not None:
+            cache_content = content if has_corresponding_function else data["data"]
+            self.cache.add(
+                MessageCacheMember(
+                    {
+                        "header": data["header"],
+                        "command": command,
+                        "content": cache_content,
+                        "called": has_corresponding_function,
+                        "client": client_data["ip"],
+                        "time": time.time(),
+                    }
+                )
+            )
+
+        # Extra special case! Message reserved (listens on every command)
+        if "message" not in self.funcs.keys():
+            return
+
+        self.funcs["message"]["invoke"](self.clients[client_socket], data["data"])
+
+    def replay_journal(
+        self,
+        start: int = None,
+        stop: int = None,
+        since: float = None,
+        until: float = None,
+    ):
+        """
+        Runs the functions registered with :meth:`on` again for the command
+        messages in the journal, e.g. to rebuild state after a restart. The
+        functions get the client data the client had when the message was
+        journaled. Reserved messages and sent frames aren't replayed.
+
+        :param start: The offset of the first record to replay
+        :type start: int, optional
+        :param stop: The offset to stop replaying at (which isn't replayed)
+        :type stop: int, optional
+        :param since: Only replay the records journaled at this Unix timestamp or later
+        :type since: float, optional
+        :param until: Only replay the records journaled at this Unix timestamp or earlier
+        :type until: float, optional
+
+        :raise ServerException: If the server has no journal.
+        """
 
-                # Pop oldest from stack
-                if len(self.cache) > self.cache_size:
-                    self.cache.pop(0)
+        if self.journal is None:
+            raise ServerException("The server has no journal.")
 
-            # Extra special case! Message reserved (listens on every command)
-            if "message" not in self.funcs.keys():
+        self.journal.flush()
+        for record in self.journal.read(start, stop, since, until):
+            data = record.data
+            # Calls are replayed without replying to them
+            if data.startswith(b"$CALL$"):
+                data = b"$" + data[6:].partition(b"$")[2]
+            if record.sent or not data.startswith(b"$CMD$"):
                 continue
 
-            client_data = self.clients[client_socket]
-            content = data["data"]
+            command, _, content = data[5:].partition(b"$MSG$")
+            invoke = self._dispatch.get(command.decode())
+            if invoke is not None:
+                invoke(record.client, content)
 
-            self._call_function(
-                "message",
-                False,
-                client_data,
-                _type_cast(
-                    self.funcs["message"]["type_hint"]["message"],
-                    content,
-                    func_name="message",
-                ),
-            )
+            if "message" in self.funcs:
+                self.funcs["message"]["invoke"](record.client, data)
 
     def close(self):
         """
@@ -1267,7 +2747,25 @@ class HiSockServer:
         self.closed = True
         self._keepalive_event.set()
         self.disconnect_all_clients()
+        for connection in list(self._connections):
+            if connection not in self.clients:
+                self._close_connection_awaiting_hello(connection)
+        # What the clients can take right away is still sent
+        for client_socket in list(self._connections):
+            self._flush(client_socket)
+        for client_info in list(self._connections.values()):
+            self._end_file_transfers(
+                client_info, ServerException("The server was closed.")
+            )
+        self._calls.close(ServerException("The server was closed."))
+        self._selector.close()
         self.sock.close()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
+        if self._owns_handler_pool:
+            self.handler_pool.shutdown(wait=False)
+        if self._owns_process_pool and self.process_pool is not None:
+            self.process_pool.shutdown(wait=False, cancel_futures=True)
 
 
 class ThreadedHiSockServer(HiSockServer):
@@ -1335,7 +2833,9 @@ class ThreadedHiSockServer(HiSockServer):
         self._thread.join()
 
 
-def start_server(addr, blocking=True, max_connections=0, header_len=16):
+def start_server(
+    addr, blocking=True, max_connections=0, header_len=16, binary_header=True
+):
     """
     Creates a :class:`HiSockServer` instance. See :class:`HiSockServer` for
     more details and documentation.
@@ -1343,10 +2843,14 @@ def start_server(addr, blocking=True, max_connections=0, header_len=16):
     :return: A :class:`HiSockServer` instance.
     """
 
-    return HiSockServer(addr, blocking, max_connections, header_len)
+    return HiSockServer(
+        addr, blocking, max_connections, header_len, binary_header=binary_header
+    )
 
 
-def start_threaded_server(addr, blocking=True, max_connections=0, header_len=16):
+def start_threaded_server(
+    addr, blocking=True, max_connections=0, header_len=16, binary_header=True
+):
     """
     Creates a :class:`ThreadedHiSockServer` instance. See :class:`HiSockServer`
     for more details and documentation.
@@ -1354,7 +2858,9 @@ def start_threaded_server(addr, blocking=True, max_connections=0, header_len=16)
     :return: A :class:`ThreadedHiSockServer` instance.
     """
 
-    return ThreadedHiSockServer(addr, blocking, max_connections, header_len)
+    return ThreadedHiSockServer(
+        addr, blocking, max_connections, header_len, binary_header=binary_header
+    )
 
 
 if __name__ == "__main__":
@@ -13,13 +13,41 @@ Copyright SSS_Says_Snek, 2021-present
 
 from __future__ import annotations
 
+import bisect
+import functools
+import hashlib
+import select
+import heapq
+import itertools
 import json
+import os
 import pathlib
+import queue
 import socket
-from typing import Union, Any, Optional
+import struct
+import sys
+import threading
+import time
+import traceback
+import zlib
+from concurrent.futures import Executor, Future
+from typing import Union, Any, Callable, Iterator, Optional
 from ipaddress import IPv4Address
 from re import search
 import builtins
+from collections import Counter, deque
+from collections.abc import Mapping
+
+# Optional compression codecs, see `_compression_codecs`
+try:
+    import lz4.frame as _lz4_frame
+except ImportError:
+    _lz4_frame = None
+try:
+    import zstandard as _zstandard
+except ImportError:
+    _zstandard = None
+
 
 # Custom exceptions
 class ClientException(Exception):
@@ -58,6 +86,22 @@ class GroupNotFound(Exception):
     pass
 
 
+class CallError(Exception):
+    """The function a call was made to failed, or couldn't be called"""
+
+    pass
+
+
+class HandlerPoolFull(Exception):
+    pass
+
+
+class FileIntegrityError(Exception):
+    """A file wasn't received intact, some of its chunks don't match their hashes"""
+
+    pass
+
+
 # Custom warnings
 class NoHeaderWarning(UserWarning):
     pass
@@ -87,39 +131,2436 @@ Client = Union[
 ]
 
 
+# Binary header: a 4-byte unsigned big-endian length prefix
+_BINARY_HEADER = struct.Struct("!I")
+# The highest bit of the binary header marks a compressed frame, on
+# connections that negotiated compression
+_COMPRESSED_FLAG = 1 << 31
+# Windows has no `sendmsg`, so the buffers of a message are joined there
+_HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+# The most buffers `sendmsg` takes at once
+try:
+    _IOV_MAX = max(os.sysconf("SC_IOV_MAX"), 16)
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = 16
+# The messages of a file transfer, see `File`
+_FILE_MESSAGES = (b"$FILESTART$", b"$FILECHUNK$", b"$FILEEND$", b"$FILEACK$")
+# The size of the SHA-256 hash of every chunk of a file
+_CHUNK_HASH_SIZE = hashlib.sha256().digest_size
+
+
 # Custom classes
 class _Sentinel:
     pass
 
 
 class MessageCacheMember:
-    _available_attrs = ["header", "content", "called", "command"]
+    """
+    A message in the cache of a server or client. The attributes that weren't
+    passed in aren't set.
 
-    def __init__(self, message_dict: dict):
-        self.header = message_dict.get("header", _Sentinel)
-        self.content = message_dict.get("content", _Sentinel)
-        self.called = message_dict.get("called", _Sentinel)
-        self.command = message_dict.get("command", _Sentinel)
+    :param message_dict: The attributes of the message: "header", "content",
+        "called", "command", and the server also passes in "client" (the address
+        of the client that sent it) and "time"
+    :type message_dict: dict
+    """
+
+    _available_attrs = ["header", "content", "called", "command", "client", "time"]
+    __slots__ = ("header", "content", "called", "command", "client", "time")
 
-        for key, values in dict(self.__dict__).items():
-            if values is _Sentinel:
-                del self.__dict__[key]
+    def __init__(self, message_dict: dict):
+        for key in self._available_attrs:
+            if key in message_dict:
+                setattr(self, key, message_dict[key])
 
     def __str__(self):
-        return f"<MessageCacheMember: {self.content}>"
+        return f"<MessageCacheMember: {getattr(self, 'content', None)}>"
 
     def __repr__(self):
         return self.__str__()
 
 
+class MessageCache:
+    """
+    The messages cached by a server or client: a ring buffer of the latest
+    :class:`MessageCacheMember`, with indexes by command, client and time.
+
+    Adding a message takes constant time. The oldest messages are evicted once
+    there are more than ``max_entries`` of them, or once their headers and
+    content take more than ``max_bytes``.
+
+    :param max_entries: The maximum number of messages to keep
+    :type max_entries: int
+    :param max_bytes: The maximum number of bytes the messages may take,
+        0 for no limit
+    :type max_bytes: int, optional
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int = 0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+
+        # The messages in a fixed-size ring, the oldest one is at `_start`
+        self._ring = [None] * max_entries
+        self._start = 0
+        self._len = 0
+        # command or client address: deque of its messages, oldest first
+        self._by_command = {}
+        self._by_client = {}
+        # Messages are added on the receiving thread, and read from any thread
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self):
+        with self._lock:
+            return iter([self._at(idx) for idx in range(self._len)])
+
+    def __getitem__(
+        self, idx: Union[int, slice]
+    ) -> Union[MessageCacheMember, list[MessageCacheMember]]:
+        with self._lock:
+            if isinstance(idx, slice):
+                return [self._at(i) for i in range(*idx.indices(self._len))]
+
+            if idx < 0:
+                idx += self._len
+            if not 0 <= idx < self._len:
+                raise IndexError("cache index out of range")
+            return self._at(idx)
+
+    def add(self, message: MessageCacheMember):
+        """
+        Adds a message, and evicts the oldest messages that don't fit anymore
+
+        :param message: The message to add
+        :type message: MessageCacheMember
+        """
+
+        with self._lock:
+            if self._len == self.max_entries:
+                self._evict()
+
+            self._ring[(self._start + self._len) % self.max_entries] = message
+            self._len += 1
+            self.size += self._message_size(message)
+            for index, key in self._index_keys(message):
+                if key not in index:
+                    index[key] = deque()
+                index[key].append(message)
+
+            while self.max_bytes and self.size > self.max_bytes:
+                self._evict()
+
+    def get(
+        self,
+        idx: Union[int, slice, None] = None,
+        command: Optional[str] = None,
+        client: Optional[tuple[str, int]] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+    ) -> Union[MessageCacheMember, list[MessageCacheMember]]:
+        """
+        Gets the cached messages that match all the given filters, oldest first.
+
+        :param idx: An integer or ``slice``, specifying which of the matching
+            messages to return. Default is None (all of them)
+        :type idx: Union[int, slice], optional
+        :param command: Only get the messages of this command
+        :type command: str, optional
+        :param client: Only get the messages of the client with this address
+        :type client: tuple[str, int], optional
+        :param since: Only get the messages received at this time (from
+            :func:`time.time`) or later
+        :type since: float, optional
+        :param until: Only get the messages received at this time or earlier
+        :type until: float, optional
+        :return: The matching messages, or the one message at ``idx``
+        :rtype: Union[MessageCacheMember, list[MessageCacheMember]]
+        """
+
+        with self._lock:
+            # Start from the smallest index that applies
+            candidates = [
+                index.get(key, ())
+                for index, key in (
+                    (self._by_command, command),
+                    (self._by_client, client),
+                )
+                if key is not None
+            ]
+            if candidates:
+                messages = min(candidates, key=len)
+                get_message = messages.__getitem__
+                length = len(messages)
+            else:
+                get_message = self._at
+                length = self._len
+
+            start = 0 if since is None else self._bisect(get_message, length, since)
+            stop = (
+                length
+                if until is None
+                else self._bisect(get_message, length, until, right=True)
+            )
+            matching = [
+                get_message(i)
+                for i in range(start, stop)
+                if (
+                    command is None
+                    or getattr(get_message(i), "command", None) == command
+                )
+                and (
+                    client is None or getattr(get_message(i), "client", None) == client
+                )
+            ]
+
+        return matching if idx is None else matching[idx]
+
+    def clear(self):
+        """Removes every message"""
+
+        with self._lock:
+            self._ring = [None] * self.max_entries
+            self._start = 0
+            self._len = 0
+            self.size = 0
+            self._by_command.clear()
+            self._by_client.clear()
+
+    def _at(self, idx: int) -> MessageCacheMember:
+        return self._ring[(self._start + idx) % self.max_entries]
+
+    def _evict(self):
+        message = self._ring[self._start]
+        self._ring[self._start] = None
+        self._start = (self._start + 1) % self.max_entries
+        self._len -= 1
+        self.size -= self._message_size(message)
+
+        # It's also the oldest message in its indexes
+        for index, key in self._index_keys(message):
+            index[key].popleft()
+            if not index[key]:
+                del index[key]
+
+    def _index_keys(self, message: MessageCacheMember):
+        # Messages without a command (or client) aren't indexed by it
+        keys = (
+            (self._by_command, getattr(message, "command", None)),
+            (self._by_client, getattr(message, "client", None)),
+        )
+        return [(index, key) for index, key in keys if key is not None]
+
+    @staticmethod
+    def _message_size(message: MessageCacheMember) -> int:
+        return len(getattr(message, "header", b"")) + len(
+            getattr(message, "content", b"")
+        )
+
+    @staticmethod
+    def _bisect(get_message, length: int, when: float, right: bool = False) -> int:
+        # The messages are ordered by the time they were received
+        low, high = 0, length
+        while low < high:
+            middle = (low + high) // 2
+            message_time = getattr(get_message(middle), "time", 0)
+            if message_time < when or (right and message_time == when):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
 class File:
-    def __init__(self, file_path: Union[str, pathlib.Path]):
-        # TODO: implement this!
+    """
+    A file that's sent or received in chunks, see :meth:`HiSockClient.send_file`
+    and :meth:`HiSockServer.send_file`. Chunks are sent with :func:`os.sendfile`
+    where possible, and written into the preallocated file as they're received,
+    so the file is never in memory as a whole, and other messages are still sent
+    between its chunks.
+
+    Every chunk is hashed before the file is sent, and the receiver checks the
+    chunks against their hashes. A transfer that's cut off (e.g. because the
+    connection was lost) can be resumed by sending the same file again: the
+    receiver keeps what it received, finds the chunks it already has by their
+    hashes, and only the other ones are sent. Once all of it is received, the
+    receiver tells the sender whether the file is intact.
+
+    Functions registered for the command the file is sent with are called with
+    the client data (on a server) and the received file, once all of it is
+    received intact. With a ``File`` type hint they get this object, which can
+    be passed to :func:`open`. A ``bytes`` type hint reads the whole file, and
+    ``str`` (or no type hint) gets its path.
+
+    :param file_path: The path of the file
+    :type file_path: Union[str, pathlib.Path]
+    :param size: The size of the file in bytes.
+        Default is None (the size of the file on disk).
+    :type size: int, optional
+    :param name: The name of the file, which the receiver names its copy after.
+        Default is None (the name in the path).
+    :type name: str, optional
+
+    :ivar pathlib.Path file_path: The path of the file.
+    :ivar str name: The name of the file.
+    :ivar int size: The size of the file in bytes.
+    :ivar str command: The command the file is sent with.
+    :ivar int transferred: The number of bytes sent (or received) so far.
+    :ivar int resumed: The number of bytes the receiver already had from an
+        earlier transfer, which weren't sent again.
+    :ivar str digest: The SHA-256 hash of the hashes of the chunks, as hex,
+        or None until the file is hashed.
+    """
+
+    def __init__(
+        self,
+        file_path: Union[str, pathlib.Path],
+        size: Optional[int] = None,
+        name: Optional[str] = None,
+    ):
+        self.file_path = pathlib.Path(file_path)
+        self.name = name if name is not None else self.file_path.name
+        self.size = size if size is not None else self.file_path.stat().st_size
+        self.command = None
+        self.transferred = 0
+        self.resumed = 0
+        self.digest = None
+        self.transfer_id = None
+
+        # The descriptor of the file while it's transferred
+        self._fd = None
+        self._chunk_size = 65536
+        self._progress = None
+        self._done = threading.Event()
+        self._exception = None
+        # The hashes of the chunks, one after another
+        self._hashes = b""
+        # Sending: the indexes of the chunks the receiver doesn't have (known
+        # once it acknowledged the start message), and how many were sent
+        self._missing = None
+        self._position = 0
+        # Receiving: the bitmap of the chunks that were received intact
+        self._have = None
+
+    def __repr__(self):
+        return (
+            f"<File {self.name!r}: {self.transferred}/{self.size} bytes "
+            f"of {str(self.file_path)!r}>"
+        )
+
+    def __fspath__(self) -> str:
+        return str(self.file_path)
+
+    def __reduce__(self):
+        # Only the file itself is sent to other processes
+        return File, (self.file_path, self.size, self.name)
+
+    @property
+    def progress(self) -> float:
+        """
+        :return: The fraction of the file that was transferred, from 0 to 1
+        :rtype: float
+        """
+
+        return self.transferred / self.size if self.size else 1.0
+
+    def done(self) -> bool:
+        """
+        :return: Whether the transfer is over, whether it succeeded or not
+        :rtype: bool
+        """
+
+        return self._done.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> File:
+        """
+        Waits until the transfer is over
+
+        :param timeout: The number of seconds to wait.
+            Default is None (waits forever).
+        :type timeout: float, optional
+        :return: The file itself
+        :rtype: File
+
+        :raise TimeoutError: If the transfer isn't over in time.
+        :raise Exception: The exception the transfer failed with, e.g.
+            :class:`ClientNotFound` if the client disconnected, or
+            :class:`FileIntegrityError` if the receiver didn't get it intact.
+        """
+
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"{self.name} wasn't transferred in time.")
+        if self._exception is not None:
+            raise self._exception
+        return self
+
+    def read_bytes(self) -> bytes:
+        """
+        :return: The whole content of the file
+        :rtype: bytes
+        """
+
+        return self.file_path.read_bytes()
+
+    # Chunks
+
+    def _chunk_count(self) -> int:
+        """
+        :return: The number of chunks of the file
+        :rtype: int
+        """
+
+        return -(-self.size // self._chunk_size)
+
+    def _chunk_range(self, index: int) -> tuple[int, int]:
+        """
+        :param index: The index of a chunk
+        :type index: int
+        :return: The offset and the size of the chunk
+        :rtype: tuple[int, int]
+        """
+
+        offset = index * self._chunk_size
+        return offset, min(self._chunk_size, self.size - offset)
+
+    def _chunk_hash(self, index: int) -> bytes:
+        """
+        :param index: The index of a chunk
+        :type index: int
+        :return: The hash the chunk should have
+        :rtype: bytes
+        """
+
+        return self._hashes[index * _CHUNK_HASH_SIZE : (index + 1) * _CHUNK_HASH_SIZE]
+
+    def _read(self, offset: int, count: int) -> bytes:
+        """
+        Reads part of the file, where it can't be sent with :func:`os.sendfile`
+
+        :param offset: Where to start reading
+        :type offset: int
+        :param count: The number of bytes to read
+        :type count: int
+        :return: The data
+        :rtype: bytes
+        """
+
+        # Several transfers of the same file don't share the position
+        if hasattr(os, "pread"):
+            return os.pread(self._fd, count, offset)
+        os.lseek(self._fd, offset, os.SEEK_SET)
+        return os.read(self._fd, count)
+
+    # Sending
+
+    def _open(
+        self,
+        command: str,
+        transfer_id: int,
+        chunk_size: int,
+        progress: Optional[Callable] = None,
+    ):
+        """Opens the file to send it, see :meth:`_hash`"""
+
+        self.command = command
+        self.transfer_id = transfer_id
+        self._chunk_size = chunk_size
+        self._progress = progress
+        self._fd = os.open(self.file_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+
+    def _hash(self):
+        """
+        Hashes every chunk of the file, before its start message is sent. This
+        reads the whole file, so it isn't done by the thread that sends it.
+        """
+
+        self._hashes = b"".join(
+            hashlib.sha256(self._read(*self._chunk_range(index))).digest()
+            for index in range(self._chunk_count())
+        )
+        self.digest = hashlib.sha256(self._hashes).hexdigest()
+
+    def _start_message(self) -> bytes:
+        """
+        :return: The message that announces the file to the receiver, which it
+            acknowledges with the chunks it already has
+        :rtype: bytes
+        """
+
+        info = {
+            "command": self.command,
+            "name": self.name,
+            "size": self.size,
+            "chunk_size": self._chunk_size,
+            "digest": self.digest,
+        }
+        # The hashes follow the first line break, which JSON doesn't have
+        return (
+            b"$FILESTART$%d$" % self.transfer_id
+            + json.dumps(info).encode()
+            + b"\n"
+            + self._hashes
+        )
+
+    def _end_message(self) -> bytes:
+        """
+        :return: The message sent after the last chunk, which the receiver
+            acknowledges once it verified the file
+        :rtype: bytes
+        """
+
+        return b"$FILEEND$%d" % self.transfer_id
+
+    def _acknowledge(self, have: bytes) -> bool:
+        """
+        Handles an acknowledgment of the receiver, with the bitmap of the
+        chunks it has. The one for the start message decides which chunks are
+        sent, the one for the end message whether the transfer succeeded.
+
+        :param have: The bitmap of the chunks the receiver has
+        :type have: bytes
+        :return: Whether the chunks (and the end message) have to be sent now
+        :rtype: bool
+        """
+
+        missing = [
+            index
+            for index in range(self._chunk_count())
+            if index >> 3 >= len(have) or not have[index >> 3] & 1 << (index & 7)
+        ]
+
+        if self._missing is None:
+            self._missing = missing
+            self.resumed = self.size - sum(
+                self._chunk_range(index)[1] for index in missing
+            )
+            if self.resumed:
+                self._transferred(self.resumed)
+            return True
+
+        self._finish(
+            FileIntegrityError(
+                f"{len(missing)} chunks of {self.name} weren't received intact."
+            )
+            if missing
+            else None
+        )
+        return False
+
+    def _next_chunk(self) -> Optional[tuple[bytes, int, int]]:
+        """
+        :return: The prefix of the message of the next chunk, its offset and
+            its size, or None if every chunk was sent
+        :rtype: Optional[tuple[bytes, int, int]]
+        """
+
+        if self._position >= len(self._missing):
+            return None
+
+        offset, count = self._chunk_range(self._missing[self._position])
+        return b"$FILECHUNK$%d$%d$" % (self.transfer_id, offset), offset, count
+
+    def _sent(self, count: int):
+        """
+        Moves on to the next chunk, once one was sent
+
+        :param count: The size of the chunk that was sent
+        :type count: int
+        """
+
+        self._position += 1
+        self._transferred(count)
+
+    # Receiving
+
+    @classmethod
+    def _create(cls, directory: pathlib.Path, info: dict, hashes: bytes) -> File:
+        """
+        Opens the file a received file is written into, preallocated to its
+        size. It's named after the hashes of the chunks, so if an earlier
+        transfer of the same file was cut off, the chunks it received are
+        found and aren't sent again.
+
+        :param directory: The directory of the file
+        :type directory: pathlib.Path
+        :param info: The information in the start message
+        :type info: dict
+        :param hashes: The hashes of the chunks
+        :type hashes: bytes
+        :return: The file, opened for :meth:`_write`
+        :rtype: File
+        """
+
+        part_path = _FileReceiver._reserve_part(
+            directory, hashlib.sha256(hashes).hexdigest()
+        )
+        # Only the name is used, so the sender can't write outside the directory
+        file = cls(part_path, info["size"], pathlib.PurePath(info["name"]).name)
+        file.name = file.name or "file"
+        file.command = info["command"]
+        file.digest = info["digest"]
+        file._chunk_size = info["chunk_size"]
+        file._hashes = hashes
+        file._have = bytearray(-(-file._chunk_count() // 8))
+        file._fd = os.open(
+            part_path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        )
+
+        # Left by a transfer that was cut off, the chunks that match their
+        # hashes were received
+        if os.fstat(file._fd).st_size == file.size:
+            for index in range(file._chunk_count()):
+                data = file._read(*file._chunk_range(index))
+                if hashlib.sha256(data).digest() == file._chunk_hash(index):
+                    file._have[index >> 3] |= 1 << (index & 7)
+                    file.transferred += len(data)
+            file.resumed = file.transferred
+            return file
+
+        # The blocks are allocated once, instead of with every chunk
+        os.truncate(file._fd, 0)
+        try:
+            if file.size and hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(file._fd, 0, file.size)
+            else:
+                os.truncate(file._fd, file.size)
+        except OSError:
+            os.truncate(file._fd, file.size)
+        return file
+
+    def _write(self, offset: int, data: Union[bytes, memoryview]):
+        """
+        Writes a received chunk into the file, if it matches its hash.
+        Chunks that don't are left out, and the sender is told when the
+        file ends.
+
+        :param offset: The offset of the chunk
+        :type offset: int
+        :param data: The chunk
+        :type data: Union[bytes, memoryview]
+        """
+
+        index, misaligned = divmod(offset, self._chunk_size)
+        if (
+            misaligned
+            or index >= self._chunk_count()
+            or hashlib.sha256(data).digest() != self._chunk_hash(index)
+        ):
+            return
+
+        if hasattr(os, "pwrite"):
+            os.pwrite(self._fd, data, offset)
+        else:
+            os.lseek(self._fd, offset, os.SEEK_SET)
+            os.write(self._fd, data)
+        if not self._have[index >> 3] & 1 << (index & 7):
+            self._have[index >> 3] |= 1 << (index & 7)
+            self._transferred(len(data))
+
+    def _ack_message(self) -> bytes:
+        """
+        :return: The acknowledgment of the start or end message, with the
+            bitmap of the chunks that were received
+        :rtype: bytes
+        """
+
+        return b"$FILEACK$%d$" % self.transfer_id + bytes(self._have)
+
+    def _intact(self) -> bool:
+        """
+        :return: Whether every chunk was received, and the hashes they were
+            checked against match the digest of the file
+        :rtype: bool
+        """
+
+        return (
+            self.transferred == self.size
+            and hashlib.sha256(self._hashes).hexdigest() == self.digest
+        )
+
+    def _move(self, directory: pathlib.Path):
+        """
+        Moves the received file to its name, once it's intact and closed. If
+        there's a file with the same name already, a number is added to it.
+
+        :param directory: The directory the file is moved to
+        :type directory: pathlib.Path
+        """
+
+        stem, suffix = os.path.splitext(self.name)
+        name = self.name
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+        for number in itertools.count(1):
+            file_path = directory / name
+            try:
+                # Takes the name, so another file can't be moved there too
+                os.close(os.open(file_path, flags))
+                break
+            except FileExistsError:
+                name = f"{stem} ({number}){suffix}"
+
+        os.replace(self.file_path, file_path)
         self.file_path = file_path
+        self.name = name
+
+    # Both
+
+    def _transferred(self, count: int):
+        """
+        Adds to the bytes transferred so far, and reports the progress
+
+        :param count: The number of bytes that were just transferred
+        :type count: int
+        """
+
+        self.transferred += count
+        if self._progress is not None:
+            self._progress(self)
+
+    def _close(self):
+        """Closes the descriptor of the file"""
+
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _finish(self, exception: Optional[BaseException] = None):
+        """
+        Closes the file, and ends the transfer
+
+        :param exception: The exception the transfer failed with
+        :type exception: BaseException, optional
+        """
+
+        self._close()
+        self._exception = exception
+        self._done.set()
+
+
+class _FileReceiver:
+    """
+    The files a connection is receiving, by the transfer ID the sender gave
+    them, see :class:`File`. They're written into hidden files named after
+    their hashes until they're received intact, which are kept if the
+    transfer is cut off.
+
+    :param directory: The directory the files are written into
+    :type directory: Union[str, pathlib.Path]
+    :param send: Sends a message to the sender of the files
+    :type send: Callable[[bytes], None]
+    :param progress: Called with the file whenever one of its chunks is received
+    :type progress: Callable[[File], None], optional
+    """
+
+    __slots__ = ("directory", "send", "progress", "_files")
+
+    # The files being written into by any connection, which other transfers of
+    # the same file can't use at the same time
+    _parts = set()
+    _parts_lock = threading.Lock()
+
+    def __init__(
+        self,
+        directory: Union[str, pathlib.Path],
+        send: Callable,
+        progress: Optional[Callable] = None,
+    ):
+        self.directory = pathlib.Path(directory)
+        self.send = send
+        self.progress = progress
+        self._files = {}
+
+    @classmethod
+    def _reserve_part(cls, directory: pathlib.Path, digest: str) -> pathlib.Path:
+        """
+        :param directory: The directory the file is received into
+        :type directory: pathlib.Path
+        :param digest: The hash of the hashes of the chunks of the file
+        :type digest: str
+        :return: The path of the file it's written into, until it's received
+        :rtype: pathlib.Path
+        """
+
+        with cls._parts_lock:
+            part_path = directory / f".{digest}.part"
+            for number in itertools.count(1):
+                if part_path not in cls._parts:
+                    break
+                part_path = directory / f".{digest}.{number}.part"
+            cls._parts.add(part_path)
+        return part_path
+
+    @classmethod
+    def _release_part(cls, part_path: pathlib.Path):
+        with cls._parts_lock:
+            cls._parts.discard(part_path)
+
+    def handle(self, data: bytes) -> Optional[File]:
+        """
+        Handles a message of a file transfer, and acknowledges the start and
+        the end of a file
+
+        :param data: The message
+        :type data: bytes
+        :return: The file, once all of it was received intact
+        :rtype: Optional[File]
+        """
+
+        # The chunk isn't copied out of the message before it's written
+        if data.startswith(b"$FILECHUNK$"):
+            id_end = data.index(b"$", 11)
+            offset_end = data.index(b"$", id_end + 1)
+            file = self._files.get(data[11:id_end])
+            # The transfer isn't known, e.g. it started before a reconnection
+            if file is not None:
+                file._write(
+                    int(data[id_end + 1 : offset_end]),
+                    memoryview(data)[offset_end + 1 :],
+                )
+            return None
+
+        if data.startswith(b"$FILESTART$"):
+            transfer_id, _, start = data[11:].partition(b"$")
+            info, _, hashes = start.partition(b"\n")
+            file = File._create(self.directory, json.loads(info), hashes)
+            file.transfer_id = int(transfer_id)
+            file._progress = self.progress
+            self._files[transfer_id] = file
+            self.send(file._ack_message())
+            return None
+
+        # $FILEEND$
+        file = self._files.pop(data[9:], None)
+        if file is None:
+            return None
+
+        part_path = file.file_path
+        file._close()
+        if file._intact():
+            file._move(self.directory)
+            file._finish()
+        else:
+            # What was received intact is kept for the next transfer
+            file._finish(FileIntegrityError(f"{file.name} wasn't received intact."))
+        self._release_part(part_path)
+        self.send(file._ack_message())
+        return file if file._exception is None else None
+
+    def close(self, exception: BaseException):
+        """
+        Closes the files that weren't received completely. What was received
+        is kept, so sending them again resumes the transfers.
+
+        :param exception: The exception their transfers fail with
+        :type exception: BaseException
+        """
+
+        for file in self._files.values():
+            file._finish(exception)
+            self._release_part(file.file_path)
+        self._files.clear()
+
+
+def _parse_file_ack(data: bytes) -> tuple[int, bytes]:
+    """
+    Parses the acknowledgment of the receiver of a file, see
+    :meth:`File._acknowledge`
+
+    :param data: The data of the acknowledgment
+    :type data: bytes
+    :return: The transfer ID, and the bitmap of the chunks the receiver has
+    :rtype: tuple[int, bytes]
+    """
+
+    transfer_id, _, have = data[9:].partition(b"$")
+    return int(transfer_id), have
+
+
+class HandlerPool(Executor):
+    """
+    A bounded pool of worker threads, which runs the functions registered with
+    ``threaded=True`` instead of starting a thread for every message.
+
+    Worker threads are started when they are needed, up to ``max_workers``,
+    and are reused afterwards. Functions that can't be run right away wait in
+    a queue of at most ``max_queued`` functions. What happens when the queue is
+    full is decided by ``overflow``:
+
+    - ``"block"`` - Wait until there is room in the queue. This stops the
+      server or client from receiving, so the senders are slowed down too
+      (with :mod:`asyncio`, this blocks the whole event loop).
+    - ``"caller_runs"`` - Run the function in the calling thread instead.
+    - ``"reject"`` - Drop the function, and raise :class:`HandlerPoolFull`.
+
+    Functions submitted with :meth:`submit_keyed` run one at a time in the order
+    they were submitted for the same key, while functions for different keys
+    run in parallel.
+
+    It is also a :class:`concurrent.futures.Executor`, so it can be used with
+    :meth:`asyncio.loop.run_in_executor` too.
+
+    :param max_workers: The maximum number of worker threads.
+        Default is 16.
+    :type max_workers: int, optional
+    :param max_queued: The maximum number of functions waiting for a worker
+        thread (0 for no limit).
+        Default is 1024.
+    :type max_queued: int, optional
+    :param overflow: What to do when the queue is full, either ``"block"``,
+        ``"caller_runs"`` or ``"reject"``.
+        Default is ``"block"``.
+    :type overflow: str, optional
+
+    :raise ValueError: If the overflow policy or the number of workers is invalid.
+    """
+
+    _overflow_policies = ("block", "caller_runs", "reject")
+
+    def __init__(
+        self, max_workers: int = 16, max_queued: int = 1024, overflow: str = "block"
+    ):
+        if overflow not in self._overflow_policies:
+            raise ValueError(
+                f"Invalid overflow policy {overflow!r}, "
+                f"must be one of {self._overflow_policies}."
+            )
+        if max_workers < 1:
+            raise ValueError("There must be at least 1 worker thread.")
+
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.overflow = overflow
+
+        # Holds (future, fn, args, kwargs), or (None, fn, args, kwargs) for the
+        # runners of keyed functions
+        self._queue = queue.Queue(max(max_queued, 0))
+        self._workers = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+        # Keyed functions waiting for the function before them
+        # {key: deque[(future, fn, args, kwargs)]}
+        self._keyed = {}
+        self._keyed_space = threading.Condition(self._lock)
+
+        # Metrics
+        self._idle = 0
+        self._active = 0
+        self._queued = 0
+        self._completed = 0
+        self._rejected = 0
+
+    def metrics(self) -> dict[str, int]:
+        """
+        Gets the metrics of the pool.
+
+        :return: A dictionary with the number of worker threads (``workers``),
+            functions that are running (``active``), waiting for a worker thread
+            (``queued``), that have finished (``completed``), and that were
+            rejected (``rejected``).
+        :rtype: dict[str, int]
+        """
+
+        with self._lock:
+            return {
+                "workers": len(self._workers),
+                "active": self._active,
+                "queued": self._queued,
+                "completed": self._completed,
+                "rejected": self._rejected,
+            }
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        """
+        Runs a function in a worker thread.
+
+        :param fn: The function to run.
+        :type fn: Callable
+        :param args: The arguments to pass to the function.
+        :param kwargs: The keyword arguments to pass to the function.
+        :return: The future of the result of the function.
+        :rtype: concurrent.futures.Future
+
+        :raise HandlerPoolFull: If the queue is full and the overflow policy is
+            ``"reject"``.
+        :raise RuntimeError: If the pool was shut down.
+        """
+
+        if self._shutdown:
+            raise RuntimeError("Cannot run functions after the pool was shut down.")
+
+        work = (Future(), fn, args, kwargs)
+
+        with self._lock:
+            self._queued += 1
+            self._start_worker()
+
+        if self.overflow == "block":
+            self._queue.put(work)
+            return work[0]
+
+        try:
+            self._queue.put_nowait(work)
+        except queue.Full:
+            with self._lock:
+                self._queued -= 1
+                self._keyed_space.notify()
+
+            if self.overflow == "caller_runs":
+                self._run(work)
+                return work[0]
+
+            with self._lock:
+                self._rejected += 1
+            raise HandlerPoolFull(
+                f"{self.max_queued} functions are already waiting for a worker thread."
+            ) from None
+
+        return work[0]
+
+    def submit_keyed(self, key: Any, fn, /, *args, **kwargs) -> Future:
+        """
+        Runs a function in a worker thread, after every function submitted
+        before it with the same key has run.
+
+        .. note::
+            The ``"caller_runs"`` overflow policy waits like ``"block"`` here,
+            as running the function right away would break the order.
+
+        :param key: The key to keep the order for, for example a client.
+        :type key: Any
+        :param fn: The function to run.
+        :type fn: Callable
+        :param args: The arguments to pass to the function.
+        :param kwargs: The keyword arguments to pass to the function.
+        :return: The future of the result of the function.
+        :rtype: concurrent.futures.Future
+
+        :raise HandlerPoolFull: If the queue is full and the overflow policy is
+            ``"reject"``.
+        :raise RuntimeError: If the pool was shut down.
+        """
+
+        if self._shutdown:
+            raise RuntimeError("Cannot run functions after the pool was shut down.")
+
+        work = (Future(), fn, args, kwargs)
+
+        with self._keyed_space:
+            while 0 < self.max_queued <= self._queued:
+                if self.overflow == "reject":
+                    self._rejected += 1
+                    raise HandlerPoolFull(
+                        f"{self.max_queued} functions are already waiting for "
+                        "a worker thread."
+                    )
+                self._keyed_space.wait()
+
+            self._queued += 1
+
+            # The key's runner is already waiting or running, get in line
+            if key in self._keyed:
+                self._keyed[key].append(work)
+                return work[0]
+
+            self._keyed[key] = deque((work,))
+            self._start_worker()
+
+        self._queue.put((None, self._run_keyed, (key,), {}))
+        return work[0]
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        """
+        Stops the worker threads after the queued functions have run.
+
+        :param wait: Whether to wait until the worker threads have stopped.
+            Default is True.
+        :type wait: bool, optional
+        :param cancel_futures: Whether to cancel the queued functions instead
+            of running them.
+            Default is False.
+        :type cancel_futures: bool, optional
+        """
+
+        with self._lock:
+            self._shutdown = True
+            workers = list(self._workers)
+
+            if cancel_futures:
+                for pending in self._keyed.values():
+                    for work in pending:
+                        work[0].cancel()
+
+        if cancel_futures:
+            while True:
+                try:
+                    work = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if work[0] is not None:
+                    work[0].cancel()
+
+        # Wake up every worker thread, which stop once they get `None`
+        for _ in workers:
+            self._queue.put(None)
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def _start_worker(self):
+        """Starts a worker thread if all of them are busy (must hold the lock)"""
+
+        if self._idle < self._queued and len(self._workers) < self.max_workers:
+            worker = threading.Thread(target=self._worker, daemon=True)
+            self._workers.append(worker)
+            self._idle += 1
+            worker.start()
+
+    def _worker(self):
+        while True:
+            work = self._queue.get()
+            if work is None:
+                return
+
+            with self._lock:
+                self._idle -= 1
+                self._active += 1
+                if work[0] is not None:
+                    self._queued -= 1
+                    # Keyed functions wait for the same room in the queue
+                    self._keyed_space.notify()
+
+            self._run(work)
+
+            with self._lock:
+                self._idle += 1
+                self._active -= 1
+
+    def _run_keyed(self, key: Any):
+        """Runs the functions of a key in order, until none are left"""
+
+        while True:
+            with self._lock:
+                pending = self._keyed[key]
+                if not pending:
+                    del self._keyed[key]
+                    return
+
+                work = pending.popleft()
+                self._queued -= 1
+                self._keyed_space.notify()
+
+            self._run(work)
+
+    def _run(self, work: tuple):
+        future, fn, args, kwargs = work
+        if future is None:
+            # A runner of keyed functions
+            fn(*args, **kwargs)
+            return
+
+        if not future.set_running_or_notify_cancel():
+            return
+
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            # Like an exception in a thread, it shouldn't go unnoticed
+            traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+            future.set_exception(e)
+
+        with self._lock:
+            self._completed += 1
+
+
+class _Codec:
+    """
+    A compression algorithm that frames can be compressed with, once both ends
+    of a connection agreed on it in the hello
+
+    :param name: The name the codec is negotiated with
+    :type name: str
+    :param compress: Compresses bytes
+    :type compress: Callable[[bytes], bytes]
+    :param decompress: Decompresses what ``compress`` returned
+    :type decompress: Callable[[bytes], bytes]
+    """
+
+    __slots__ = ("name", "compress", "decompress")
+
+    def __init__(self, name: str, compress: Callable, decompress: Callable):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+    def __repr__(self):
+        return f"<_Codec: {self.name}>"
+
+    def compress_frame(self, data: bytes, threshold: int) -> tuple:
+        """
+        Compresses the data of a frame, unless it's too small to be worth it
+
+        :param data: The data of the frame
+        :type data: bytes
+        :param threshold: The number of bytes from which the data is compressed
+        :type threshold: int
+        :return: The data to send, and whether it's compressed
+        :rtype: tuple[bytes, bool]
+        """
+
+        if len(data) < threshold:
+            return data, False
+
+        compressed = self.compress(data)
+        # Incompressible data is sent as it is
+        if len(compressed) >= len(data):
+            return data, False
+        return compressed, True
+
+
+# The installed codecs, by name
+_CODECS = {"zlib": _Codec("zlib", zlib.compress, zlib.decompress)}
+if _lz4_frame is not None:
+    _CODECS["lz4"] = _Codec("lz4", _lz4_frame.compress, _lz4_frame.decompress)
+if _zstandard is not None:
+    _CODECS["zstd"] = _Codec("zstd", _zstandard.compress, _zstandard.decompress)
+# zlib with a preset dictionary the server shares in the hello, see
+# `_dictionary_codec`. It's always available, but only used once the server has
+# a dictionary
+_DICTIONARY_CODEC = "zlib-dict"
+_KNOWN_CODECS = (_DICTIONARY_CODEC, "zstd", "lz4", "zlib")
+
+
+def _compression_codecs(compression: Union[str, tuple, list, None]) -> tuple:
+    """
+    Validates the codecs a server or client was asked to compress frames with
+
+    :param compression: The name of a codec (``"zlib-dict"``, ``"zlib"``, ``"lz4"``
+        or ``"zstd"``), or several names in order of preference, or None for no
+        compression
+    :type compression: Union[str, tuple, list, None]
+    :return: The names of the installed codecs, in order of preference
+    :rtype: tuple[str, ...]
+
+    :raise ValueError: If a codec is unknown, or none of them are installed.
+    """
+
+    if compression is None:
+        return ()
+    if isinstance(compression, str):
+        compression = (compression,)
+
+    for name in compression:
+        if name not in _KNOWN_CODECS:
+            raise ValueError(
+                f"Unknown compression codec {name!r}, it must be one of {_KNOWN_CODECS}."
+            )
+
+    codecs = tuple(
+        name for name in compression if name in _CODECS or name == _DICTIONARY_CODEC
+    )
+    if compression and not codecs:
+        raise ValueError(
+            f"None of the compression codecs {tuple(compression)} are installed."
+        )
+    return codecs
+
+
+def _dictionary_codec(zdict: bytes) -> _Codec:
+    """
+    Makes the codec that compresses every frame on its own with a preset
+    dictionary, so small frames that look alike compress well without any
+    state kept between frames. The dictionary is only processed once: every
+    frame is compressed with a copy of a compressor primed with it.
+
+    :param zdict: The dictionary, see :func:`_build_dictionary`
+    :type zdict: bytes
+    :return: The codec
+    :rtype: _Codec
+    """
+
+    # Raw deflate, as the zlib header and checksum would take up most of a
+    # small compressed frame
+    compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict
+    )
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=zdict)
+
+    def compress(data: bytes) -> bytes:
+        frame_compressor = compressor.copy()
+        return frame_compressor.compress(data) + frame_compressor.flush()
+
+    def decompress(data: bytes) -> bytes:
+        frame_decompressor = decompressor.copy()
+        return frame_decompressor.decompress(data) + frame_decompressor.flush()
+
+    return _Codec(_DICTIONARY_CODEC, compress, decompress)
+
+
+def _build_dictionary(samples: Iterator[bytes], size: int = 16384) -> bytes:
+    """
+    Builds a preset dictionary for :func:`_dictionary_codec` out of sample frames.
+
+    zlib finds matches closer to the end of the dictionary with fewer bits, so
+    the most common samples are put last, and the dictionary is cut from the
+    start once it's too big.
+
+    :param samples: The data of the sample frames
+    :type samples: Iterator[bytes]
+    :param size: The maximum size of the dictionary, at most 32 KiB
+    :type size: int, optional
+    :return: The dictionary
+    :rtype: bytes
+    """
+
+    size = min(size, 1 << zlib.MAX_WBITS)
+    chosen = []
+    dictionary_size = 0
+    for sample, _ in Counter(samples).most_common():
+        if dictionary_size >= size:
+            break
+        chosen.append(sample)
+        dictionary_size += len(sample)
+
+    return b"".join(reversed(chosen))[-size:]
+
+
+class _FrameReader:
+    """
+    Buffers the bytes received on a connection and splits them into frames.
+
+    Every :meth:`recv` reads as much as is available into a reusable buffer,
+    which is shared by every connection of a server, so many small frames cost a
+    single syscall, and frames split across several TCP segments are put back
+    together instead of being truncated.
+
+    :param header_len: The ASCII header length of the connection
+    :type header_len: int
+    :param binary_header: Whether the connection uses the binary header.
+        This can be changed between frames (after negotiating the header).
+    :type binary_header: bool, optional
+    :param recv_size: The maximum number of bytes to read at once
+    :type recv_size: int, optional
+    :param codec: The codec compressed frames are decompressed with, once the
+        connection negotiated compression (which needs the binary header)
+    :type codec: _Codec, optional
+    """
+
+    # There is one for every connection of a server
+    __slots__ = ("header_len", "binary_header", "recv_size", "codec", "_buffer", "_pos")
+
+    def __init__(
+        self,
+        header_len: int,
+        binary_header: bool = False,
+        recv_size: int = 65536,
+        codec: Optional[_Codec] = None,
+    ):
+        self.header_len = header_len
+        self.binary_header = binary_header
+        self.recv_size = recv_size
+        self.codec = codec
+
+        self._buffer = bytearray()
+        self._pos = 0  # Start of the first unparsed frame in the buffer
+
+    def recv(self, connection: socket.socket, recv_buffer: memoryview) -> bool:
+        """
+        Receives once from the connection into the buffer
+
+        :param connection: The socket to receive from
+        :type connection: socket.socket
+        :param recv_buffer: The buffer to receive into, before the received data
+            is added to the buffer. It can be shared by every connection that's
+            received from on the same thread.
+        :type recv_buffer: memoryview
+        :return: False if the connection was closed, else True
+        :rtype: bool
+        """
+
+        received = connection.recv_into(recv_buffer)
+        if not received:
+            return False
+
+        self.feed(recv_buffer[:received])
+        return True
+
+    def feed(self, data: Union[bytes, bytearray, memoryview]):
+        """
+        Adds already received data to the buffer
+
+        :param data: The received data
+        :type data: Union[bytes, bytearray, memoryview]
+        """
+
+        # Drop the parsed frames once they take up most of the buffer
+        if self._pos and self._pos >= len(self._buffer) // 2:
+            del self._buffer[: self._pos]
+            self._pos = 0
+
+        self._buffer += data
+
+    def next_frame(self) -> Optional[dict[str, bytes]]:
+        """
+        Splits the next complete frame out of the buffer
+
+        :return: A dictionary like the one :func:`receive_message` returns, or
+            None if there isn't a complete frame buffered yet
+        :rtype: Optional[dict["header": bytes, "data": bytes]]
+        """
+
+        header_size = _get_header_len(self.header_len, self.binary_header)
+        data_start = self._pos + header_size
+        if len(self._buffer) < data_start:
+            return None
+
+        header_message = bytes(self._buffer[self._pos : data_start])
+        data_len = _parse_header(header_message, self.binary_header)
+        compressed = self.codec is not None and data_len & _COMPRESSED_FLAG
+        if compressed:
+            data_len ^= _COMPRESSED_FLAG
+        data_end = data_start + data_len
+        if len(self._buffer) < data_end:
+            return None
+
+        data = bytes(self._buffer[data_start:data_end])
+        self._pos = data_end
+        if self._pos == len(self._buffer):
+            self._buffer.clear()
+            self._pos = 0
+
+        if compressed:
+            data = self.codec.decompress(data)
+
+        return {"header": header_message, "data": data}
+
+    def frames(self) -> iter[dict[str, bytes]]:
+        """
+        An iterable of every complete frame in the buffer
+
+        :return: An iterable of dictionaries, see :meth:`next_frame`
+        :rtype: iter[dict["header": bytes, "data": bytes]]
+        """
+
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+
+class _Mailbox:
+    """
+    Hands the messages one thread receives to the threads waiting for them in
+    ``recv_raw``. A message is only handed over if a thread is waiting for it,
+    and waiting threads sleep until it arrives.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._waiting = 0
+        self._messages = deque()
+
+    def put(self, message: bytes) -> bool:
+        """
+        Hands a message to a waiting thread
+
+        :param message: The message
+        :type message: bytes
+        :return: Whether a waiting thread takes the message
+        :rtype: bool
+        """
+
+        with self._condition:
+            # Every waiting thread already has a message coming
+            if self._waiting <= len(self._messages):
+                return False
+
+            self._messages.append(message)
+            self._condition.notify()
+            return True
+
+    def get(self, timeout: Optional[float] = None) -> bytes:
+        """
+        Waits for a message
+
+        :param timeout: The number of seconds to wait, or None to wait forever
+        :type timeout: float, optional
+        :return: The message
+        :rtype: bytes
+
+        :raise TimeoutError: If no message was handed over in time
+        """
+
+        with self._condition:
+            self._waiting += 1
+            try:
+                if not self._condition.wait_for(lambda: self._messages, timeout):
+                    raise TimeoutError("No message was received in time.")
+                return self._messages.popleft()
+            finally:
+                self._waiting -= 1
+
+
+class CallFuture(Future):
+    """
+    The future of the reply to a call, see :meth:`HiSockClient.call`. Getting
+    its result receives the reply if nothing else is receiving it.
+
+    :ivar int call_id: The ID that correlates the call with its reply.
+    :ivar float latency: The number of seconds between sending the call and
+        receiving its reply, or None until it's replied to.
+    """
+
+    def __init__(self, wait: Optional[Callable] = None):
+        super().__init__()
+        self.call_id = None
+        self.latency = None
+        # Receives until the future is done, or the timeout passed
+        self._wait = wait
+
+    def result(self, timeout: Optional[float] = None) -> Any:
+        if self._wait is None or self.done():
+            return super().result(timeout)
+
+        self._wait(self, timeout)
+        return super().result(0)
+
+    def exception(self, timeout: Optional[float] = None) -> Optional[BaseException]:
+        if self._wait is None or self.done():
+            return super().exception(timeout)
+
+        self._wait(self, timeout)
+        return super().exception(0)
+
+
+class _PendingCalls:
+    """
+    The calls waiting for their reply, by call ID. A call with a timeout fails
+    with :class:`TimeoutError` once it passes, which :meth:`expire` checks.
+
+    :param expire_in_thread: Whether a thread calls :meth:`expire` when the
+        next timeout passes. Otherwise, the owner has to call it.
+    :type expire_in_thread: bool, optional
+    """
+
+    def __init__(self, expire_in_thread: bool = True):
+        # call ID: (future, return type, perf_counter when it was sent, owner)
+        self._calls = {}
+        self._ids = itertools.count(1)
+        # Heap of (monotonic deadline, call ID)
+        self._deadlines = []
+        self._condition = threading.Condition()
+        self._closed = False
+        self._expire_in_thread = expire_in_thread
+        self._thread = None
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    def add(
+        self,
+        future: CallFuture,
+        timeout: Optional[float] = None,
+        return_type=bytes,
+        owner: Any = None,
+    ) -> int:
+        """
+        Adds a call that's about to be sent
+
+        :param future: The future of the reply
+        :type future: CallFuture
+        :param timeout: The number of seconds to wait for the reply
+        :type timeout: float, optional
+        :param return_type: The type the reply is type casted to
+        :type return_type: type, optional
+        :param owner: Who the call is sent to, which is the only one that can
+            reply to it
+        :type owner: Any, optional
+        :return: The call ID
+        :rtype: int
+        """
+
+        with self._condition:
+            call_id = next(self._ids)
+            future.call_id = call_id
+            self._calls[call_id] = (future, return_type, time.perf_counter(), owner)
+            if timeout is not None:
+                heapq.heappush(self._deadlines, (time.monotonic() + timeout, call_id))
+                if self._expire_in_thread and self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._expire_thread, daemon=True
+                    )
+                    self._thread.start()
+                self._condition.notify()
+
+        # Cancelled by whoever waits for it
+        future.add_done_callback(
+            lambda future: future.cancelled() and self.discard(call_id)
+        )
+        return call_id
+
+    def discard(self, call_id: int):
+        """
+        Forgets a call, its reply is ignored
+
+        :param call_id: The call ID
+        :type call_id: int
+        """
+
+        with self._condition:
+            self._calls.pop(call_id, None)
+
+    def resolve(
+        self, call_id: int, content: bytes, error: bool = False, owner: Any = None
+    ) -> bool:
+        """
+        Completes a call with its reply
+
+        :param call_id: The call ID
+        :type call_id: int
+        :param content: The content of the reply, or the error if it failed
+        :type content: bytes
+        :param error: Whether the call failed
+        :type error: bool, optional
+        :param owner: Who sent the reply, see :meth:`add`
+        :type owner: Any, optional
+        :return: Whether the call was still waiting for its reply
+        :rtype: bool
+        """
+
+        with self._condition:
+            call = self._calls.get(call_id)
+            if call is None or call[3] is not owner:
+                return False
+            del self._calls[call_id]
+        if call[0].cancelled():
+            return False
+
+        future, return_type, sent, _ = call
+        future.latency = time.perf_counter() - sent
+        if error:
+            future.set_exception(CallError(content.decode(errors="replace")))
+            return True
+
+        try:
+            future.set_result(_type_cast(return_type, content, "<call reply>"))
+        except InvalidTypeCast as e:
+            future.set_exception(e)
+        return True
+
+    def expire(self) -> Optional[float]:
+        """
+        Fails the calls whose timeout passed
+
+        :return: The number of seconds until the next timeout, or None if no
+            call has a timeout
+        :rtype: Optional[float]
+        """
+
+        expired = []
+        with self._condition:
+            while self._deadlines:
+                deadline, call_id = self._deadlines[0]
+                if call_id not in self._calls:
+                    heapq.heappop(self._deadlines)
+                    continue
+
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    break
+                heapq.heappop(self._deadlines)
+                expired.append(self._calls.pop(call_id)[0])
+            else:
+                remaining = None
+
+        for future in expired:
+            if not future.cancelled():
+                future.set_exception(
+                    TimeoutError("The call wasn't replied to in time.")
+                )
+        return remaining
+
+    def fail(self, owner: Any, exception: Exception):
+        """
+        Fails the calls waiting for a reply from an owner, e.g. when it
+        disconnected
+
+        :param owner: The owner, see :meth:`add`
+        :type owner: Any
+        :param exception: The exception the calls fail with
+        :type exception: Exception
+        """
+
+        with self._condition:
+            failed = [
+                self._calls.pop(call_id)[0]
+                for call_id, call in list(self._calls.items())
+                if call[3] is owner
+            ]
+
+        for future in failed:
+            if not future.cancelled():
+                future.set_exception(exception)
+
+    def close(self, exception: Exception):
+        """
+        Fails every call that's waiting, and stops the thread
+
+        :param exception: The exception the calls fail with
+        :type exception: Exception
+        """
+
+        with self._condition:
+            self._closed = True
+            calls = list(self._calls.values())
+            self._calls.clear()
+            self._deadlines.clear()
+            self._condition.notify()
+
+        for future, _, _, _ in calls:
+            if not future.cancelled():
+                future.set_exception(exception)
+
+    def _expire_thread(self):
+        while True:
+            remaining = self.expire()
+            with self._condition:
+                if self._closed:
+                    return
+                # Woken up early when a call with a timeout is added
+                self._condition.wait(remaining)
+
+
+class GroupCallFuture(CallFuture):
+    """
+    The future of the replies to a call made to several clients, see
+    :meth:`HiSockServer.call_group`. It's done once every client replied, or
+    failed to (e.g. it timed out or disconnected), and it never fails itself:
+    its result has the replies of the clients that replied, and
+    :attr:`errors` has the exceptions of the ones that didn't.
+
+    :param futures: The future of the call of every client, by client address
+    :type futures: dict[tuple[str, int], CallFuture]
+    :param wait: See :class:`CallFuture`
+    :type wait: Callable, optional
+
+    :ivar dict futures: The future of the call of every client, by client address.
+    :ivar dict errors: The exception of every client that didn't reply, by
+        client address. It's only filled in once the future is done.
+    :ivar float latency: The latency of the slowest reply, or None until it's done.
+    """
+
+    def __init__(self, futures: dict, wait: Optional[Callable] = None):
+        super().__init__(wait)
+        self.futures = futures
+        self.errors = {}
+        self._remaining = len(futures)
+        self._lock = threading.Lock()
+
+        if not futures:
+            self.set_result({})
+        for future in futures.values():
+            future.add_done_callback(self._call_done)
+
+    def partial(self) -> dict:
+        """
+        :return: The replies received so far, by client address
+        :rtype: dict
+        """
+
+        return {
+            client: future.result(0)
+            for client, future in self.futures.items()
+            if future.done() and not future.cancelled() and future.exception(0) is None
+        }
+
+    def _call_done(self, _: Future):
+        with self._lock:
+            self._remaining -= 1
+            if self._remaining:
+                return
+
+        for client, future in self.futures.items():
+            if future.cancelled():
+                self.errors[client] = CallError("The call was cancelled.")
+            elif future.exception(0) is not None:
+                self.errors[client] = future.exception(0)
+        self.latency = max(
+            (
+                future.latency
+                for future in self.futures.values()
+                if future.latency is not None
+            ),
+            default=None,
+        )
+        self.set_result(self.partial())
+
+
+def _make_reply(call_id: bytes, future: Future) -> bytes:
+    """
+    Makes the reply to a call, with the result of the function that was called,
+    or the exception it raised
+
+    :param call_id: The ID of the call, as it was received
+    :type call_id: bytes
+    :param future: The future of the result of the function
+    :type future: concurrent.futures.Future
+    :return: The reply message
+    :rtype: bytes
+    """
+
+    if future.cancelled():
+        exception = CallError("The function was cancelled.")
+    else:
+        exception = future.exception()
+
+    if exception is None:
+        try:
+            content = _type_cast(bytes, future.result(), "<call reply>")
+        except InvalidTypeCast as e:
+            exception = e
+        else:
+            return b"$REPLY$" + call_id + b"$OK$" + content
+
+    error = f"{type(exception).__name__}: {exception}"
+    return b"$REPLY$" + call_id + b"$ERR$" + error.encode()
+
+
+def _parse_reply(data: bytes) -> tuple:
+    """
+    Parses the reply to a call, see :func:`_make_reply`
+
+    :param data: The reply message
+    :type data: bytes
+    :return: The call ID, the content and whether the call failed
+    :rtype: tuple[int, bytes, bool]
+    """
+
+    call_id, _, reply = data[7:].partition(b"$")
+    status, _, content = reply.partition(b"$")
+    return int(call_id), content, status == b"ERR"
+
+
+def _done_future(result: Any = None, exception: Optional[BaseException] = None):
+    """
+    Makes a future that's already done
+
+    :param result: The result of the future
+    :type result: Any, optional
+    :param exception: The exception of the future, instead of a result
+    :type exception: BaseException, optional
+    :return: The future
+    :rtype: concurrent.futures.Future
+    """
+
+    future = Future()
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+    return future
+
+
+class ClientRecord(Mapping):
+    """
+    A client connected to a server, and the state of its connection.
+
+    Functions registered with :meth:`HiSockServer.on` get it as the client
+    data, which can be used like the dictionary it replaces, with the keys
+    ``"ip"``, ``"name"`` and ``"group"``. :meth:`copy` makes it a dictionary.
+    It has ``__slots__``, so an idle connection takes as little memory as
+    possible.
+
+    :param ip: The address of the client, in the form of (ip, port)
+    :type ip: tuple[str, int]
+    :param name: The name of the client
+    :type name: str, optional
+    :param group: The group of the client
+    :type group: str, optional
+    :param frame_reader: The frame reader of the connection
+    :type frame_reader: _FrameReader, optional
+
+    :ivar int messages_received: The number of messages received from the client.
+    :ivar int messages_sent: The number of messages sent to the client.
+    """
+
+    __slots__ = (
+        "ip",
+        "name",
+        "group",
+        "frame_reader",
+        # bytearray of the data that couldn't be sent yet, or None
+        "send_buffer",
+        # list of the buffers sent together once the messages that were received
+        # are handled (by `HiSockServer.run`, or in one iteration of the event
+        # loop of `AsyncHiSockServer`), or None, see `coalesce_writes`
+        "coalesced",
+        # Whether the client isn't received from until its send buffer drains
+        "reading_paused",
+        # Whether a keepalive was sent to the client, and not acknowledged yet
+        "keepalive_pending",
+        "messages_received",
+        "messages_sent",
+        # Whether the client replies to calls from the server
+        "calls",
+        # Whether the client receives files, see `HiSockServer.send_file`
+        "files",
+        # deque of the files being sent to the client, or None
+        "files_sending",
+        # dict of the files waiting for the client to acknowledge their start
+        # or end, by transfer ID, or None
+        "files_waiting",
+        # _FileReceiver of the files the client is sending, or None
+        "files_receiving",
+    )
+    _keys = ("ip", "name", "group")
+
+    def __init__(
+        self,
+        ip: tuple[str, int],
+        name: Optional[str] = None,
+        group: Optional[str] = None,
+        frame_reader: Optional[_FrameReader] = None,
+    ):
+        self.ip = ip
+        self.name = name
+        self.group = group
+        self.frame_reader = frame_reader
+        self.send_buffer = None
+        self.coalesced = None
+        self.reading_paused = False
+        self.keepalive_pending = False
+        self.messages_received = 0
+        self.messages_sent = 0
+        self.calls = False
+        self.files = False
+        self.files_sending = None
+        self.files_waiting = None
+        self.files_receiving = None
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self._keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self) -> iter[str]:
+        return iter(self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __repr__(self):
+        return f"<ClientRecord: {self.copy()}>"
+
+    def __reduce__(self):
+        # Only the client data is sent to other processes
+        return ClientRecord, (self.ip, self.name, self.group)
+
+    def copy(self) -> dict:
+        """
+        :return: The client data as a dictionary
+        :rtype: dict
+        """
+
+        return {"ip": self.ip, "name": self.name, "group": self.group}
+
+
+class _ClientRegistry(Mapping):
+    """
+    The clients connected to a server: a read-only mapping of client sockets to
+    their :class:`ClientRecord`, which keeps indexes by address, name and group.
+
+    Every change updates the indexes in place instead of rebuilding them, and
+    :meth:`snapshot` hands out the same tuple of records until the next change.
+    """
+
+    def __init__(self):
+        # socket: ClientRecord
+        self._clients = {}
+        # (ip, port): socket
+        self._addresses = {}
+        # name: {socket: None, ...}, and group: {socket: None, ...}, in the
+        # order the clients connected
+        self._names = {}
+        self._groups = {}
+        self._snapshot = None
+        self._reversed = None
+
+    def __getitem__(self, client_socket: socket.socket) -> ClientRecord:
+        return self._clients[client_socket]
+
+    def __iter__(self) -> iter[socket.socket]:
+        return iter(self._clients)
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+    def __contains__(self, client_socket: socket.socket) -> bool:
+        return client_socket in self._clients
+
+    def values(self):
+        return self._clients.values()
+
+    def items(self):
+        return self._clients.items()
+
+    def add(self, client_socket: socket.socket, client_info: ClientRecord):
+        """
+        Adds a client
+
+        :param client_socket: The client socket
+        :type client_socket: socket.socket
+        :param client_info: The record of the client
+        :type client_info: ClientRecord
+        """
+
+        self._clients[client_socket] = client_info
+        self._index(client_socket, client_info)
+        self._changed()
+
+    def remove(self, client_socket: socket.socket) -> ClientRecord:
+        """
+        Removes a client
+
+        :param client_socket: The client socket
+        :type client_socket: socket.socket
+        :return: The record of the client
+        :rtype: ClientRecord
+
+        :raise KeyError: If the client isn't in the registry
+        """
+
+        client_info = self._clients.pop(client_socket)
+        self._unindex(client_socket, client_info)
+        self._changed()
+        return client_info
+
+    def update(self, client_socket: socket.socket, **changes) -> ClientRecord:
+        """
+        Changes the name or group of a client
+
+        :param client_socket: The client socket
+        :type client_socket: socket.socket
+        :param changes: The keys of the client data to change, and their new values
+        :return: The record of the client
+        :rtype: ClientRecord
+
+        :raise KeyError: If the client isn't in the registry
+        """
+
+        client_info = self._clients[client_socket]
+
+        self._unindex(client_socket, client_info)
+        for key, value in changes.items():
+            setattr(client_info, key, value)
+        self._index(client_socket, client_info)
+        self._changed()
+        return client_info
+
+    def clear(self):
+        """Removes every client"""
+
+        self._clients.clear()
+        self._addresses.clear()
+        self._names.clear()
+        self._groups.clear()
+        self._changed()
+
+    def by_address(self, address: tuple[str, int]) -> Optional[socket.socket]:
+        """
+        :return: The socket of the client with the address, or None
+        :rtype: Optional[socket.socket]
+        """
+
+        return self._addresses.get(address)
+
+    def by_name(self, name: Optional[str]) -> tuple[socket.socket, ...]:
+        """
+        :return: The sockets of the clients with the name, in the order
+            they connected
+        :rtype: tuple[socket.socket, ...]
+        """
+
+        return tuple(self._names.get(name, ()))
+
+    def by_group(self, group: Optional[str]) -> tuple[socket.socket, ...]:
+        """
+        :return: The sockets of the clients in the group, in the order
+            they joined it
+        :rtype: tuple[socket.socket, ...]
+        """
+
+        return tuple(self._groups.get(group, ()))
+
+    def snapshot(self) -> tuple[ClientRecord, ...]:
+        """
+        Gets the record of every client. It's only made again after the
+        clients changed, so getting it repeatedly is cheap.
+
+        :return: The record of every client
+        :rtype: tuple[ClientRecord, ...]
+        """
+
+        snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = self._snapshot = tuple(self._clients.values())
+        return snapshot
+
+    def reversed(self) -> dict[tuple, socket.socket]:
+        """
+        Gets the clients keyed by their client info, like ``clients_rev`` used
+        to be. It's only made again after the clients changed.
+
+        :return: A dictionary of (ip, name, group) tuples to client sockets
+        :rtype: dict[tuple, socket.socket]
+        """
+
+        reversed_clients = self._reversed
+        if reversed_clients is None:
+            reversed_clients = self._reversed = {
+                (client_info["ip"], client_info["name"], client_info["group"]): (
+                    client_socket
+                )
+                for client_socket, client_info in list(self._clients.items())
+            }
+        return reversed_clients
+
+    def _index(self, client_socket: socket.socket, client_info: ClientRecord):
+        self._addresses[client_info["ip"]] = client_socket
+        self._names.setdefault(client_info["name"], {})[client_socket] = None
+        self._groups.setdefault(client_info["group"], {})[client_socket] = None
+
+    def _unindex(self, client_socket: socket.socket, client_info: ClientRecord):
+        if self._addresses.get(client_info["ip"]) is client_socket:
+            del self._addresses[client_info["ip"]]
+
+        for index, key in (
+            (self._names, client_info["name"]),
+            (self._groups, client_info["group"]),
+        ):
+            index_sockets = index.get(key)
+            if index_sockets is None:
+                continue
+            index_sockets.pop(client_socket, None)
+            if not index_sockets:
+                del index[key]
+
+    def _changed(self):
+        self._snapshot = None
+        self._reversed = None
+
+
+class JournalRecord:
+    """
+    A frame read from a :class:`Journal`
+
+    :ivar int offset: The offset of the record, which counts the records of the journal.
+    :ivar float time: The Unix timestamp of when the frame was journaled.
+    :ivar bool sent: Whether the frame was sent (instead of received).
+    :ivar ClientRecord client: The client that sent or received the frame, if it
+        was journaled by a server.
+    :ivar bytes data: The data of the frame, without the header.
+    """
+
+    __slots__ = ("offset", "time", "sent", "client", "data")
+
+    def __init__(
+        self,
+        offset: int,
+        time: float,
+        sent: bool,
+        client: Optional[ClientRecord],
+        data: bytes,
+    ):
+        self.offset = offset
+        self.time = time
+        self.sent = sent
+        self.client = client
+        self.data = data
+
+    def __repr__(self):
+        return f"<JournalRecord {self.offset}: {self.data}>"
+
+
+class Journal:
+    """
+    An append-only journal of the frames a server or client receives (and
+    optionally sends), which is kept on disk, so it can be audited and
+    replayed through the functions registered with ``on`` after a restart.
+
+    The records are written to segment files in ``path`` by a background
+    thread, so :meth:`append` never blocks. Every segment
+    ``<first offset>.journal`` has an index ``<first offset>.index`` with the
+    time and position of each of its records, so :meth:`read` goes straight to
+    the records of an offset or time range. A new segment is started once the
+    current one is larger than ``segment_size``. A record torn by a crash is
+    cut off when the journal is opened again.
+
+    :param path: The directory of the segment files, which is created if needed
+    :type path: Union[str, pathlib.Path]
+    :param segment_size: The number of bytes after which a new segment is started.
+        Default is 64 MiB.
+    :type segment_size: int, optional
+    :param record_sent: Whether the frames that are sent are journaled too.
+        Default is False.
+    :type record_sent: bool, optional
+    """
+
+    # Record: the length and CRC-32 of the rest of the record, then the time,
+    # the flags, the length of the client data, the client data, and the frame
+    _RECORD_HEADER = struct.Struct("!II")
+    _RECORD_FIELDS = struct.Struct("!dBH")
+    _SENT = 1
+    # Index entry: the time and the position of a record in its segment
+    _INDEX_ENTRY = struct.Struct("!dQ")
+
+    def __init__(
+        self,
+        path: Union[str, pathlib.Path],
+        segment_size: int = 1 << 26,
+        record_sent: bool = False,
+    ):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.record_sent = record_sent
+        self.closed = False
+
+        # The first offsets of the segments, in order
+        self._segments = sorted(
+            int(segment.stem) for segment in self.path.glob("*.journal")
+        ) or [0]
+        self._recover(self._segments[-1])
+        self._next_offset = self._segments[-1] + self._index_length(self._segments[-1])
+
+        # (offset, time, sent, client data, frame), or None to stop the writer
+        self._queue = queue.Queue()
+        # Offsets are handed out in the order the records are queued
+        self._lock = threading.Lock()
+        self._writer = threading.Thread(target=self._write_records, daemon=True)
+        self._writer.start()
+
+    def append(
+        self, data: bytes, client: Optional[Mapping] = None, sent: bool = False
+    ) -> int:
+        """
+        Adds a frame to the journal, without waiting for it to be written
+
+        :param data: The data of the frame, without the header
+        :type data: bytes
+        :param client: The client data of the client that sent or received it
+        :type client: Mapping, optional
+        :param sent: Whether the frame was sent
+        :type sent: bool, optional
+        :return: The offset of the record
+        :rtype: int
+        """
+
+        # The client data can change before the record is written
+        client = dict(client) if client is not None else None
+        with self._lock:
+            offset = self._next_offset
+            self._next_offset += 1
+            self._queue.put((offset, time.time(), sent, client, bytes(data)))
+        return offset
+
+    def flush(self):
+        """Waits until everything appended so far is written"""
+
+        self._queue.join()
+
+    def read(
+        self,
+        start: Optional[int] = None,
+        stop: Optional[int] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+    ) -> Iterator[JournalRecord]:
+        """
+        Reads the records in an offset and time range, oldest first. Records
+        that are still being written aren't read, see :meth:`flush`.
+
+        :param start: The first offset to read
+        :type start: int, optional
+        :param stop: The offset to stop reading at (which isn't read)
+        :type stop: int, optional
+        :param since: Only read the records journaled at this Unix timestamp or later
+        :type since: float, optional
+        :param until: Only read the records journaled at this Unix timestamp or earlier
+        :type until: float, optional
+        :return: An iterator of the records
+        :rtype: Iterator[JournalRecord]
+        """
+
+        segments = list(self._segments)
+        for number, base in enumerate(segments):
+            next_base = segments[number + 1] if number + 1 < len(segments) else None
+            if start is not None and next_base is not None and next_base <= start:
+                continue
+            if stop is not None and base >= stop:
+                return
+
+            index = self._read_index(base)
+            first = max(start - base, 0) if start is not None else 0
+            last = min(stop - base, len(index)) if stop is not None else len(index)
+            if since is not None or until is not None:
+                times = [entry[0] for entry in index]
+                if since is not None:
+                    first = max(first, bisect.bisect_left(times, since))
+                if until is not None:
+                    last = min(last, bisect.bisect_right(times, until))
+            if first >= last:
+                continue
+
+            with open(self._segment_path(base, "journal"), "rb") as segment:
+                segment.seek(index[first][1])
+                for offset in range(base + first, base + last):
+                    yield self._decode(offset, self._read_record(segment))
+
+    def close(self):
+        """Writes everything appended so far, and stops the writer thread"""
+
+        if self.closed:
+            return
+
+        self.closed = True
+        self._queue.put(None)
+        self._writer.join()
+
+    def _segment_path(self, base: int, suffix: str) -> pathlib.Path:
+        return self.path / f"{base:020d}.{suffix}"
+
+    def _index_length(self, base: int) -> int:
+        index_path = self._segment_path(base, "index")
+        if not index_path.exists():
+            return 0
+        return index_path.stat().st_size // self._INDEX_ENTRY.size
+
+    def _read_index(self, base: int) -> list[tuple[float, int]]:
+        try:
+            with open(self._segment_path(base, "index"), "rb") as index:
+                entries = index.read()
+        except FileNotFoundError:
+            # The writer thread didn't create the segment yet
+            return []
+        # A partly written entry isn't used
+        entries = entries[: len(entries) - len(entries) % self._INDEX_ENTRY.size]
+        return list(self._INDEX_ENTRY.iter_unpack(entries))
+
+    def _read_record(self, segment) -> Optional[bytes]:
+        """
+        Reads the record at the position of a segment file
+
+        :return: The record without its length and checksum, or None if it
+            isn't complete or doesn't match its checksum
+        :rtype: Optional[bytes]
+        """
+
+        header = segment.read(self._RECORD_HEADER.size)
+        if len(header) < self._RECORD_HEADER.size:
+            return None
+
+        length, checksum = self._RECORD_HEADER.unpack(header)
+        record = segment.read(length)
+        if len(record) < length or zlib.crc32(record) != checksum:
+            return None
+        return record
+
+    def _recover(self, base: int):
+        """
+        Cuts off what a crash left of a record at the end of the last
+        segment, and indexes the records it has again
+
+        :param base: The first offset of the last segment
+        :type base: int
+        """
+
+        segment_path = self._segment_path(base, "journal")
+        if not segment_path.exists():
+            return
+
+        index = bytearray()
+        with open(segment_path, "r+b") as segment:
+            position = 0
+            while True:
+                record = self._read_record(segment)
+                if record is None:
+                    break
+                index += self._INDEX_ENTRY.pack(
+                    self._RECORD_FIELDS.unpack_from(record)[0], position
+                )
+                position = segment.tell()
+            segment.truncate(position)
+
+        with open(self._segment_path(base, "index"), "wb") as index_file:
+            index_file.write(index)
+
+    def _encode(self, when: float, sent: bool, client: Optional[dict], data: bytes):
+        client = json.dumps(client).encode() if client is not None else b""
+        record = (
+            self._RECORD_FIELDS.pack(when, self._SENT if sent else 0, len(client))
+            + client
+            + data
+        )
+        return self._RECORD_HEADER.pack(len(record), zlib.crc32(record)) + record
+
+    def _decode(self, offset: int, record: bytes) -> JournalRecord:
+        when, flags, client_length = self._RECORD_FIELDS.unpack_from(record)
+        data_start = self._RECORD_FIELDS.size + client_length
+
+        client = None
+        if client_length:
+            client = json.loads(record[self._RECORD_FIELDS.size : data_start])
+            client = ClientRecord(tuple(client["ip"]), client["name"], client["group"])
+        return JournalRecord(
+            offset, when, bool(flags & self._SENT), client, record[data_start:]
+        )
+
+    def _write_records(self):
+        base = self._segments[-1]
+        segment = open(self._segment_path(base, "journal"), "ab")
+        index = open(self._segment_path(base, "index"), "ab")
+        position = segment.tell()
+
+        while True:
+            item = self._queue.get()
+            if item is None:
+                segment.close()
+                index.close()
+                self._queue.task_done()
+                return
+
+            offset, when, sent, client, data = item
+            if position >= self.segment_size:
+                segment.close()
+                index.close()
+                segment = open(self._segment_path(offset, "journal"), "ab")
+                index = open(self._segment_path(offset, "index"), "ab")
+                position = 0
+                self._segments.append(offset)
+
+            record = self._encode(when, sent, client, data)
+            segment.write(record)
+            index.write(self._INDEX_ENTRY.pack(when, position))
+            position += len(record)
+
+            # Written in batches. The segment goes first, so an indexed record
+            # can always be read
+            if self._queue.empty():
+                segment.flush()
+                index.flush()
+            self._queue.task_done()
 
 
 def make_header(
-    header_message: Union[str, bytes], header_len: int, encode=True
+    header_message: Union[str, bytes],
+    header_len: int,
+    encode=True,
+    binary=False,
+    compressed=False,
 ) -> Union[str, bytes]:
     """
     Makes a header of ``header_message``, with a maximum
@@ -132,20 +2573,237 @@ def make_header(
         the actual header length (will be padded)
     :type header_len: int
     :param encode: A boolean, specifying the
+    :param binary: A boolean, specifying if the header should be a compact
+        binary length prefix instead of a padded ASCII one. If True,
+        ``header_len`` and ``encode`` are ignored and the header is always
+        4 bytes long.
+
+        Default: False
+    :type binary: bool, optional
+    :param compressed: A boolean, specifying if the message is compressed with
+        the codec the connection negotiated. This sets the highest bit of the
+        binary header, so it's only used if ``binary`` is True.
+
+        Default: False
+    :type compressed: bool, optional
     :return: The constructed header, padded to ``header_len``
         bytes
     :rtype: Union[str, bytes]
     """
 
     message_len = len(header_message)
+    if binary:
+        if compressed:
+            return _BINARY_HEADER.pack(message_len | _COMPRESSED_FLAG)
+        return _BINARY_HEADER.pack(message_len)
+
     constructed_header = f"{message_len}{' ' * (header_len - len(str(message_len)))}"
     if encode:
         return constructed_header.encode()
     return constructed_header
 
 
+def _make_length_header(
+    message_len: int, header_len: int, binary: bool, compressed: bool = False
+) -> bytes:
+    """
+    Makes the header of a message that isn't in one piece, like a chunk of a
+    file sent with :func:`os.sendfile`, see :func:`make_header`
+
+    :param message_len: The length of the message
+    :type message_len: int
+    :param header_len: The ASCII header length
+    :type header_len: int
+    :param binary: Whether the header is a binary length prefix
+    :type binary: bool
+    :param compressed: Whether the message is compressed
+    :type compressed: bool, optional
+    :return: The header
+    :rtype: bytes
+    """
+
+    if binary:
+        if compressed:
+            return _BINARY_HEADER.pack(message_len | _COMPRESSED_FLAG)
+        return _BINARY_HEADER.pack(message_len)
+    return f"{message_len}{' ' * (header_len - len(str(message_len)))}".encode()
+
+
+@functools.lru_cache(maxsize=1024)
+def _command_prefix(command: str) -> bytes:
+    """
+    :param command: A command
+    :type command: str
+    :return: What the messages with the command start with, before the content
+    :rtype: bytes
+    """
+
+    return b"$CMD$" + command.encode() + b"$MSG$"
+
+
+def _frame_buffers(
+    buffers: tuple,
+    header_len: int,
+    binary: bool,
+    codec: Optional[_Codec] = None,
+    compression_threshold: int = 0,
+) -> list:
+    """
+    Makes the frame of a message that's in several pieces, which are sent as
+    they are with :func:`_send_buffers` instead of being joined into one
+
+    :param buffers: The pieces of the message, e.g. the command and the content
+    :type buffers: tuple[bytes, ...]
+    :param header_len: The ASCII header length
+    :type header_len: int
+    :param binary: Whether the header is a binary length prefix
+    :type binary: bool
+    :param codec: The codec the connection negotiated
+    :type codec: _Codec, optional
+    :param compression_threshold: The number of bytes from which the message
+        is compressed
+    :type compression_threshold: int, optional
+    :return: The header, then the pieces of the message
+    :rtype: list
+    """
+
+    message_len = sum(map(len, buffers))
+    compressed = False
+    # Only messages that are compressed have to be in one piece
+    if codec is not None and message_len >= compression_threshold:
+        data, compressed = codec.compress_frame(
+            b"".join(buffers), compression_threshold
+        )
+        buffers = (data,)
+        message_len = len(data)
+    return [_make_length_header(message_len, header_len, binary, compressed), *buffers]
+
+
+def _send_buffers(sock: socket.socket, buffers: list) -> int:
+    """
+    Sends as much of several buffers as the socket takes with one system call,
+    with :meth:`socket.socket.sendmsg` where there is one
+
+    :param sock: The socket
+    :type sock: socket.socket
+    :param buffers: The buffers
+    :type buffers: list
+    :return: The number of bytes sent
+    :rtype: int
+    """
+
+    if _HAS_SENDMSG:
+        # The rest is left unsent, like what the socket doesn't take
+        return sock.sendmsg(buffers[:_IOV_MAX])
+    return sock.send(b"".join(buffers))
+
+
+def _unsent_buffers(buffers: list, sent: int) -> list:
+    """
+    :param buffers: The buffers that were sent, see :func:`_send_buffers`
+    :type buffers: list
+    :param sent: The number of bytes that were sent
+    :type sent: int
+    :return: What's left of the buffers, without copying them
+    :rtype: list
+    """
+
+    for index, buffer in enumerate(buffers):
+        if sent < len(buffer):
+            return [memoryview(buffer)[sent:], *buffers[index + 1 :]]
+        sent -= len(buffer)
+    return []
+
+
+def _send_all_buffers(sock: socket.socket, buffers: list):
+    """
+    Sends all of several buffers, see :func:`_send_buffers`. A non-blocking
+    socket is waited on whenever it doesn't take more.
+
+    :param sock: The socket
+    :type sock: socket.socket
+    :param buffers: The buffers
+    :type buffers: list
+    """
+
+    while buffers:
+        try:
+            sent = _send_buffers(sock, buffers)
+        except BlockingIOError:
+            select.select((), (sock,), ())
+            continue
+        buffers = _unsent_buffers(buffers, sent)
+
+
+def _set_socket_options(
+    sock: socket.socket,
+    tcp_nodelay: Optional[bool] = None,
+    tcp_cork: bool = False,
+    send_buffer_size: Optional[int] = None,
+    receive_buffer_size: Optional[int] = None,
+):
+    """
+    Tunes a TCP socket for latency or throughput. What isn't given is left at
+    the default of the OS.
+
+    :param sock: The socket
+    :type sock: socket.socket
+    :param tcp_nodelay: Whether small messages are sent right away, instead of
+        waiting for the ones before them to be acknowledged (Nagle's algorithm)
+    :type tcp_nodelay: bool, optional
+    :param tcp_cork: Whether data is held back until a full packet can be sent.
+        Only Linux has it, elsewhere it's ignored.
+    :type tcp_cork: bool, optional
+    :param send_buffer_size: The size of the send buffer of the OS
+    :type send_buffer_size: int, optional
+    :param receive_buffer_size: The size of the receive buffer of the OS
+    :type receive_buffer_size: int, optional
+    """
+
+    if tcp_nodelay is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(tcp_nodelay))
+    if tcp_cork and hasattr(socket, "TCP_CORK"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+    if send_buffer_size is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer_size)
+    if receive_buffer_size is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer_size)
+
+
+def _get_header_len(header_len: int, binary: bool) -> int:
+    """
+    Returns how many bytes a header takes on the wire
+
+    :param header_len: The ASCII header length
+    :type header_len: int
+    :param binary: Whether the header is a binary length prefix
+    :type binary: bool
+    :return: The size of the header in bytes
+    :rtype: int
+    """
+
+    return _BINARY_HEADER.size if binary else header_len
+
+
+def _parse_header(header_message: bytes, binary: bool) -> int:
+    """
+    Parses a header made by :func:`make_header` back into the message length
+
+    :param header_message: The received header
+    :type header_message: bytes
+    :param binary: Whether the header is a binary length prefix
+    :type binary: bool
+    :return: The length of the message following the header
+    :rtype: int
+    """
+
+    if binary:
+        return _BINARY_HEADER.unpack(header_message)[0]
+    return int(header_message)
+
+
 def receive_message(
-    connection: socket.socket, header_len: int
+    connection: socket.socket, header_len: int, binary: bool = False
 ) -> Union[dict[str, bytes], bool]:
     """
     Receives a message from a server or client.
@@ -156,6 +2814,11 @@ def receive_message(
     :param header_len: The length of the header, so that
         it can successfully retrieve data without loss/gain of data
     :type header_len: int
+    :param binary: A boolean, specifying if the connection uses binary
+        headers (see :func:`make_header`).
+
+        Default: False
+    :type binary: bool, optional
     :return: A dictionary, with two key-value pairs;
         The first key-value pair refers to the header,
         while the second one refers to the actual data
@@ -163,11 +2826,11 @@ def receive_message(
     """
 
     try:
-        header_message = connection.recv(header_len)
+        header_message = _recv_exactly(connection, _get_header_len(header_len, binary))
 
         if header_message:
-            message_len = int(header_message)
-            data = connection.recv(message_len)
+            message_len = _parse_header(header_message, binary)
+            data = _recv_exactly(connection, message_len)
 
             return {"header": header_message, "data": data}
         return False
@@ -176,6 +2839,33 @@ def receive_message(
         pass
 
 
+def _recv_exactly(connection: socket.socket, size: int) -> bytes:
+    """
+    Receives exactly ``size`` bytes, as the data of a message can arrive
+    in several parts
+
+    :param connection: The socket to receive from
+    :type connection: socket.socket
+    :param size: The number of bytes to receive
+    :type size: int
+    :return: The received bytes, which are shorter than ``size`` if the
+        connection was closed
+    :rtype: bytes
+    """
+
+    received = connection.recv(size)
+    if len(received) == size or not received:
+        return received
+
+    received = bytearray(received)
+    while len(received) < size:
+        part = connection.recv(size - len(received))
+        if not part:
+            break
+        received += part
+    return bytes(received)
+
+
 def _removeprefix(
     string: Union[str, bytes],
     prefix: Union[str, bytes],
@@ -244,7 +2934,10 @@ def _str_type_to_type_annotations_dict(annotations_dict: dict):
         if not isinstance(annotation, str):
             fixed_annotations[argument] = annotation
             continue
-        fixed_annotations[argument] = getattr(builtins, annotation)
+        # `File` is the only type hint that isn't built in
+        fixed_annotations[argument] = (
+            File if annotation == "File" else getattr(builtins, annotation)
+        )
     return fixed_annotations
 
 
@@ -272,6 +2965,14 @@ def _type_cast(
         return content_to_type_cast
 
     try:
+        # Received files are only read if they're type hinted as something else
+        if isinstance(content_to_type_cast, File):
+            if type_cast == File:
+                return content_to_type_cast
+            if type_cast == str:
+                return str(content_to_type_cast.file_path)
+            content_to_type_cast = content_to_type_cast.read_bytes()
+
         # Convert content_to_type_cast to bytes
         if not isinstance(content_to_type_cast, bytes):
             if isinstance(content_to_type_cast, str):
@@ -280,8 +2981,10 @@ def _type_cast(
                 content_to_type_cast = b""
             elif type(content_to_type_cast) in (int, float):
                 content_to_type_cast = str(content_to_type_cast).encode()
-            elif type(content_to_type_cast) in (list, dict):
-                content_to_type_cast = json.dumps(content_to_type_cast).encode()
+            elif type(content_to_type_cast) in (list, dict, ClientRecord):
+                content_to_type_cast = json.dumps(
+                    content_to_type_cast, default=_json_default
+                ).encode()
             else:
                 raise TypeError(
                     f"Cannot type cast {type(content_to_type_cast)} to bytes"
@@ -317,6 +3020,18 @@ def _type_cast(
         ) from e
 
 
+def _json_default(obj: Any) -> Any:
+    """
+    Makes the objects :func:`json.dumps` doesn't know about serializable
+
+    :raise TypeError: If the object isn't serializable
+    """
+
+    if isinstance(obj, ClientRecord):
+        return obj.copy()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
 def validate_command_not_reserved(command: str):
     """
     Checks for illegal $cmd$ notation (used for reserved functions).
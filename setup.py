@@ -149,6 +149,8 @@ setup(
         "Programming Language :: Python :: 3.9",
     ],
     install_requires=requirements,
+    # Optional codecs for compressing frames, zlib is always available
+    extras_require={"lz4": ["lz4"], "zstd": ["zstandard"]},
     packages=[
         "hisock",
         "examples",
@@ -0,0 +1,189 @@
+"""
+Tests many asyncio clients driven by one event loop
+"""
+
+import asyncio
+import os
+
+import pytest
+
+from hisock.async_client import AsyncHiSockClient, async_connect
+from hisock.async_server import AsyncHiSockServer
+from hisock.utils import File
+
+
+async def _start_server(**kwargs) -> AsyncHiSockServer:
+    server = AsyncHiSockServer(("127.0.0.1", 0), keepalive=False, **kwargs)
+
+    @server.on("ping")
+    def on_ping(client_data: dict, message: str):
+        server.send_client(client_data["ip"], "pong", message)
+
+    @server.on("double")
+    async def on_double(client_data: dict, message: int) -> int:
+        await asyncio.sleep(0.01 * message)
+        return message * 2
+
+    @server.on("raw")
+    def on_raw(client_data: dict, message: str):
+        server.send_client_raw(client_data["ip"], message)
+
+    server.task = asyncio.create_task(server.start())
+    while server._server is None:
+        await asyncio.sleep(0.01)
+    return server
+
+
+class TestAsyncClient:
+    def test_send_and_recv(self):
+        async def main():
+            server = await _start_server()
+            client = await async_connect(server.addr, name="client")
+            received = asyncio.get_running_loop().create_future()
+
+            @client.on("pong")
+            async def on_pong(message: str):
+                received.set_result(message)
+
+            await client.send("ping", "hello")
+            pong = await asyncio.wait_for(received, 5)
+            await client.send("raw", "raw hello")
+            raw = await client.recv(timeout=5)
+
+            client.close()
+            await client.wait_closed()
+            server.close()
+            await server.task
+            return pong, raw
+
+        assert asyncio.run(main()) == ("hello", b"raw hello")
+
+    def test_many_clients(self):
+        async def main():
+            server = await _start_server()
+            clients = await asyncio.gather(
+                *(async_connect(server.addr, name=f"bot{i}") for i in range(200))
+            )
+            assert len(server.clients) == 200
+
+            for number, client in enumerate(clients):
+                await client.send("raw", str(number))
+            received = await asyncio.gather(
+                *(client.recv(timeout=5) for client in clients)
+            )
+
+            for client in clients:
+                client.close()
+            server.close()
+            await server.task
+            return received
+
+        assert asyncio.run(main()) == [str(number).encode() for number in range(200)]
+
+    def test_call(self):
+        async def main():
+            server = await _start_server()
+            client = await async_connect(server.addr, name="client")
+
+            # Pipelined, the replies arrive in the order the calls finish
+            replies = await asyncio.gather(
+                *(
+                    client.call("double", number, timeout=5, return_type=int)
+                    for number in (5, 1, 3)
+                )
+            )
+            client_data = await client.get_client("client")
+            with pytest.raises(asyncio.TimeoutError):
+                await client.call("double", 100, timeout=0.05)
+            assert len(client._calls) == 0
+
+            client.close()
+            await client.wait_closed()
+            server.close()
+            await server.task
+            return replies, client_data
+
+        replies, client_data = asyncio.run(main())
+        assert replies == [10, 2, 6]
+        assert client_data["name"] == "client"
+
+    def test_send_file(self, tmp_path):
+        contents = os.urandom(1 << 20)
+        (tmp_path / "upload.bin").write_bytes(contents)
+
+        async def main():
+            server = await _start_server()
+            server.download_dir = tmp_path
+
+            # The server sends the file back once it's received
+            @server.on("upload")
+            def on_upload(client_data: dict, file: File):
+                server.send_file(client_data["ip"], "download", file, 100_000)
+
+            client = await async_connect(server.addr, name="client")
+            client.download_dir = tmp_path / "client"
+            client.download_dir.mkdir()
+            downloaded = asyncio.get_running_loop().create_future()
+
+            @client.on("download")
+            def on_download(file: File):
+                downloaded.set_result(file)
+
+            progress = []
+            uploads = await asyncio.gather(
+                client.send_file("upload", tmp_path / "upload.bin", 65536),
+                client.send_file(
+                    "other", tmp_path / "upload.bin", 65536, progress.append
+                ),
+            )
+            file = await asyncio.wait_for(downloaded, 5)
+
+            client.close()
+            await client.wait_closed()
+            server.close()
+            await server.task
+            return uploads, progress, file
+
+        uploads, progress, file = asyncio.run(main())
+        assert [upload.progress for upload in uploads] == [1.0, 1.0]
+        assert len(progress) == 16
+        assert file.file_path.parent == tmp_path / "client"
+        assert file.read_bytes() == contents
+
+    def test_coalesce_writes(self, tmp_path):
+        contents = os.urandom(1 << 20)
+        (tmp_path / "upload.bin").write_bytes(contents)
+
+        async def main():
+            server = await _start_server(coalesce_writes=True, tcp_nodelay=True)
+            server.download_dir = tmp_path
+            client = AsyncHiSockClient(
+                server.addr, "client", None, tcp_nodelay=True, coalesce_writes=True
+            )
+            await client.start()
+            received = []
+            done = asyncio.get_running_loop().create_future()
+
+            @client.on("pong")
+            def on_pong(message: str):
+                received.append(message)
+                if len(received) == 100:
+                    done.set_result(None)
+
+            # Written together, as they're sent in one iteration of the loop
+            for number in range(100):
+                await client.send("ping", str(number))
+            await asyncio.wait_for(done, 5)
+            reply = await client.call("double", 21, timeout=5, return_type=int)
+            file = await client.send_file("upload", tmp_path / "upload.bin", 65536)
+
+            client.close()
+            await client.wait_closed()
+            server.close()
+            await server.task
+            return received, reply, file
+
+        received, reply, file = asyncio.run(main())
+        assert received == [str(number) for number in range(100)]
+        assert reply == 42
+        assert file.progress == 1.0
@@ -0,0 +1,131 @@
+"""
+Tests the asyncio server with regular clients over the loopback interface
+"""
+
+import asyncio
+import threading
+
+from hisock.async_server import AsyncHiSockServer
+from hisock.client import HiSockClient
+
+
+def _talk(addr: tuple, count: int) -> list:
+    received = []
+    client = HiSockClient(addr, "client", "group")
+
+    @client.on("pong")
+    def on_pong(message: str):
+        received.append(message)
+
+    for number in range(count):
+        client.send("ping", str(number))
+    while len(received) < count:
+        client.update()
+
+    client.close()
+    return received
+
+
+class TestAsyncServer:
+    def test_send_and_reply(self):
+        joined = []
+        left = []
+
+        async def main():
+            server = AsyncHiSockServer(("127.0.0.1", 0), keepalive=False)
+
+            @server.on("join")
+            def on_join(client_data: dict):
+                joined.append(client_data["name"])
+
+            @server.on("leave")
+            async def on_leave(client_data: dict):
+                left.append(client_data["name"])
+                server.close()
+
+            @server.on("ping")
+            async def on_ping(client_data: dict, message: str):
+                await asyncio.sleep(0)
+                server.send_client(client_data["ip"], "pong", message)
+
+            server_task = asyncio.create_task(server.start())
+            while server._server is None:
+                await asyncio.sleep(0.01)
+
+            received = await asyncio.get_running_loop().run_in_executor(
+                None, _talk, server.addr, 10
+            )
+            await asyncio.wait_for(server_task, 5)
+            return received
+
+        received = asyncio.run(main())
+
+        assert received == [str(number) for number in range(10)]
+        assert joined == ["client"]
+        assert left == ["client"]
+
+    def test_many_clients(self):
+        async def main():
+            server = AsyncHiSockServer(("127.0.0.1", 0), keepalive=False)
+
+            @server.on("ping")
+            def on_ping(client_data: dict, message: str):
+                server.send_client(client_data["ip"], "pong", message)
+
+            server_task = asyncio.create_task(server.start())
+            while server._server is None:
+                await asyncio.sleep(0.01)
+
+            loop = asyncio.get_running_loop()
+            results = await asyncio.gather(
+                *(loop.run_in_executor(None, _talk, server.addr, 5) for _ in range(20))
+            )
+            server.close()
+            await asyncio.wait_for(server_task, 5)
+            return results
+
+        for received in asyncio.run(main()):
+            assert received == [str(number) for number in range(5)]
+
+    def test_send_after_disconnect(self):
+        server = AsyncHiSockServer(("127.0.0.1", 0), keepalive=False)
+
+        # A threaded function sending to a client that just disconnected
+        server._send_to_socket(object(), b"$CMD$late$MSG$")
+        server.handler_pool.shutdown()
+
+    def test_call_client(self):
+        def answer(addr: tuple, stop):
+            client = HiSockClient(addr, "client", None)
+
+            @client.on("double")
+            def on_double(number: int) -> int:
+                return number * 2
+
+            while not stop.is_set():
+                client.update()
+            client.close()
+
+        async def main():
+            server = AsyncHiSockServer(("127.0.0.1", 0), keepalive=False)
+            server_task = asyncio.create_task(server.start())
+            while server._server is None:
+                await asyncio.sleep(0.01)
+
+            stop = threading.Event()
+            client_thread = threading.Thread(target=answer, args=(server.addr, stop))
+            client_thread.start()
+            while not server.clients:
+                await asyncio.sleep(0.01)
+
+            reply = await asyncio.wrap_future(
+                server.call_client("client", "double", 21, 5, int)
+            )
+            stop.set()
+            server.send_client_raw("client", "stop")
+            await asyncio.get_running_loop().run_in_executor(None, client_thread.join)
+            server.close()
+            await asyncio.wait_for(server_task, 5)
+            return reply
+
+        assert asyncio.run(main()) == 42
@@ -0,0 +1,88 @@
+"""
+Tests the registry of the clients connected to a server
+"""
+
+import json
+import pickle
+
+from hisock.utils import ClientRecord, _ClientRegistry, _type_cast
+
+
+def client_info(port: int, name: str = None, group: str = None) -> ClientRecord:
+    return ClientRecord(("127.0.0.1", port), name, group)
+
+
+class TestClientRegistry:
+    def test_indexes(self):
+        registry = _ClientRegistry()
+        sockets = [object() for _ in range(3)]
+        registry.add(sockets[0], client_info(1, "a", "group"))
+        registry.add(sockets[1], client_info(2, "b", "group"))
+        registry.add(sockets[2], client_info(3, "b", None))
+
+        assert len(registry) == 3
+        assert registry.by_address(("127.0.0.1", 2)) is sockets[1]
+        assert registry.by_name("b") == (sockets[1], sockets[2])
+        assert registry.by_group("group") == (sockets[0], sockets[1])
+
+        registry.remove(sockets[1])
+        assert sockets[1] not in registry
+        assert registry.by_address(("127.0.0.1", 2)) is None
+        assert registry.by_name("b") == (sockets[2],)
+        assert registry.by_group("group") == (sockets[0],)
+
+        registry.clear()
+        assert len(registry) == 0
+        assert registry.by_name("a") == ()
+
+    def test_update(self):
+        registry = _ClientRegistry()
+        client_socket = object()
+        registry.add(client_socket, client_info(1, "a", "group"))
+        record = registry[client_socket]
+
+        # Changed in place, as the record also holds the state of the connection
+        assert registry.update(client_socket, name="b") is record
+        assert record == client_info(1, "b", "group")
+        assert registry.by_name("a") == ()
+        assert registry.by_name("b") == (client_socket,)
+        assert registry.by_group("group") == (client_socket,)
+        assert registry.reversed() == {(("127.0.0.1", 1), "b", "group"): client_socket}
+
+    def test_snapshot(self):
+        registry = _ClientRegistry()
+        sockets = [object() for _ in range(2)]
+        registry.add(sockets[0], client_info(1))
+
+        snapshot = registry.snapshot()
+        assert snapshot == (client_info(1),)
+        # Not made again until the clients change
+        assert registry.snapshot() is snapshot
+
+        registry.add(sockets[1], client_info(2))
+        assert registry.snapshot() == (client_info(1), client_info(2))
+        assert snapshot == (client_info(1),)
+
+
+class TestClientRecord:
+    def test_mapping(self):
+        record = client_info(1, "a", "group")
+        record.messages_received = 2
+
+        assert record == {"ip": ("127.0.0.1", 1), "name": "a", "group": "group"}
+        assert dict(record) == record.copy()
+        assert record["name"] == "a"
+        assert record.get("messages_received") is None
+        assert not hasattr(record, "__dict__")
+
+    def test_serialize(self):
+        record = client_info(1, "a", "group")
+        record.messages_received = 2
+
+        # Only the client data leaves the server
+        assert json.loads(_type_cast(bytes, [record], "<test>")) == [
+            {"ip": ["127.0.0.1", 1], "name": "a", "group": "group"}
+        ]
+        unpickled = pickle.loads(pickle.dumps(record))
+        assert unpickled == record
+        assert unpickled.messages_received == 0
@@ -1,5 +1,917 @@
-# import pytest
+"""
+Tests a server and clients talking to each other over the loopback interface
+"""
 
-# from server import start_server
-# from client import connect
-# from utils import get_local_ip
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from hisock.server import HiSockServer
+from hisock.client import HiSockClient
+from hisock.utils import (
+    CallError,
+    ClientException,
+    ClientNotFound,
+    File,
+    FileIntegrityError,
+    GroupNotFound,
+    Journal,
+    make_header,
+    receive_message,
+)
+
+
+def wait_until(condition, timeout: float = 5):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise TimeoutError("Condition was never met")
+        time.sleep(0.01)
+
+
+def square(client_data: dict, number: int) -> int:
+    # Run in a process of the process pool
+    return number * number
+
+
+def vote_as(name: str):
+    def on_vote(question: str) -> str:
+        return f"{name}: {question}"
+
+    return on_vote
+
+
+@pytest.fixture
+def server(request):
+    # Extra server arguments can be passed in with indirect parametrization
+    server = HiSockServer(
+        ("127.0.0.1", 0), keepalive=False, **getattr(request, "param", {})
+    )
+    server.addr = server.sock.getsockname()
+
+    def run():
+        while not server.closed:
+            try:
+                server.run()
+            except (OSError, ValueError):
+                break
+
+    run_thread = threading.Thread(target=run, daemon=True)
+    run_thread.start()
+    yield server
+
+    # Closed by the run loop, as the selector isn't thread-safe
+    server._call_in_reactor(server.close)
+    run_thread.join(5)
+    if not server.closed:
+        server.close()
+
+
+class TestClientServer:
+    @pytest.mark.parametrize("binary_header", [True, False])
+    def test_send_and_reply(self, server, binary_header):
+        received = []
+
+        @server.on("ping")
+        def on_ping(client_data: dict, message: str):
+            server.send_client(client_data["ip"], "pong", message.upper())
+
+        client = HiSockClient(server.addr, "client", None, binary_header=binary_header)
+
+        @client.on("pong")
+        def on_pong(message: str):
+            received.append(message)
+
+        client.send("ping", "hello")
+        while not received:
+            client.update()
+
+        assert client.binary_header == binary_header
+        assert received == ["HELLO"]
+        client.close()
+
+    def test_legacy_server(self):
+        # A server from before the binary header, which never answers the hello
+        legacy_server = socket.create_server(("127.0.0.1", 0))
+        hellos = []
+
+        def serve():
+            connection, _ = legacy_server.accept()
+            hellos.append(receive_message(connection, 16)["data"])
+            message = b"$CMD$greet$MSG$hello"
+            connection.sendall(make_header(message, 16) + message)
+            connection.recv(1)
+            connection.close()
+
+        threading.Thread(target=serve, daemon=True).start()
+        received = []
+        client = HiSockClient(
+            legacy_server.getsockname(), "client", None, binary_header=False
+        )
+
+        @client.on("greet")
+        def on_greet(message: str):
+            received.append(message)
+
+        while not received:
+            client.update()
+
+        assert b"binary_header" not in hellos[0]
+        assert received == ["hello"]
+        client.close()
+        legacy_server.close()
+
+    def test_many_clients(self, server):
+        clients = [HiSockClient(server.addr, f"client{i}", None) for i in range(50)]
+        wait_until(lambda: len(server.clients) == 50)
+
+        for client in clients[:25]:
+            client.close()
+        wait_until(lambda: len(server.clients) == 25)
+
+        for client in clients[25:]:
+            client.close()
+        wait_until(lambda: len(server.clients) == 0)
+
+    def test_connection_without_hello(self, server):
+        # Neither a connection that never sends its hello, nor one that closes
+        # before it, holds up the other clients
+        silent = socket.create_connection(server.addr)
+        closed = socket.create_connection(server.addr)
+        closed.close()
+
+        client = HiSockClient(server.addr, "client", None)
+        wait_until(lambda: len(server.clients) == 1)
+        wait_until(lambda: len(server._connections) == 2)
+
+        client.close()
+        silent.close()
+
+    def test_dispatch(self, server):
+        received = []
+
+        # Commands starting with the letters of "$CMD$" used to be cut off
+        @server.on("Main")
+        def on_main(client_data, message):
+            received.append(("Main", message))
+
+        @server.on("count")
+        def on_count(client_data: dict, message: int):
+            received.append(("count", message))
+
+        @server.on("empty")
+        def on_empty():
+            received.append(("empty", None))
+
+        client = HiSockClient(server.addr, "client", None)
+        client.send("Main", "unannotated")
+        client.send("count", 5)
+        client.send("empty")
+        wait_until(lambda: len(received) == 3)
+
+        assert received == [("Main", "unannotated"), ("count", 5), ("empty", None)]
+        client.close()
+
+    def test_threaded(self, server):
+        received = []
+
+        @server.on("work", threaded=True)
+        def on_work(client_data: dict, message: int):
+            received.append(threading.get_ident())
+
+        client = HiSockClient(server.addr, "client", None)
+        for number in range(20):
+            client.send("work", number)
+        wait_until(lambda: server.handler_pool.metrics()["completed"] == 20)
+
+        assert len(received) == 20
+        assert server.handler_pool.metrics()["workers"] <= 16
+        client.close()
+
+    def test_ordered(self, server):
+        received = {}
+
+        @server.on("work", ordered_by="client")
+        def on_work(client_data: dict, message: int):
+            # Later messages are faster, so they'd overtake if not ordered
+            time.sleep((20 - message) / 10000)
+            received.setdefault(client_data["name"], []).append(message)
+
+        clients = [HiSockClient(server.addr, f"client{i}", None) for i in range(3)]
+        for number in range(20):
+            for client in clients:
+                client.send("work", number)
+        wait_until(lambda: sum(map(len, received.values())) == 60)
+
+        assert all(numbers == list(range(20)) for numbers in received.values())
+        for client in clients:
+            client.close()
+
+    def test_process_executor(self, server):
+        received = []
+        server.on("square", executor="process")(square)
+
+        client = HiSockClient(server.addr, "client", None)
+
+        @client.on("square")
+        def on_square(message: int):
+            received.append(message)
+
+        for number in range(5):
+            client.send("square", number)
+        while len(received) < 5:
+            client.update()
+
+        assert sorted(received) == [0, 1, 4, 9, 16]
+
+        # The processes of the pool don't keep the connection open
+        server.disconnect_client(client.get_client_addr(), force=True)
+        client.sock.settimeout(5)
+        assert client.sock.recv(1) == b""
+        client.sock.close()
+
+    @pytest.mark.parametrize(
+        "server",
+        [{"send_high_watermark": 1 << 16, "send_buffer_limit": 1 << 20}],
+        indirect=True,
+    )
+    def test_slow_client(self, server):
+        received = []
+        message = "x" * (1 << 16)
+
+        # Never receives, so everything sent to it piles up
+        slow_client = HiSockClient(server.addr, "slow", None)
+        slow_client.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        fast_client = HiSockClient(server.addr, "fast", None)
+        wait_until(lambda: len(server.clients) == 2)
+
+        @fast_client.on("broadcast")
+        def on_broadcast(content: str):
+            received.append(len(content))
+
+        for number in range(200):
+            server.send_all_clients("broadcast", message)
+            while len(received) <= number:
+                fast_client.update()
+
+        assert received == [len(message)] * 200
+        wait_until(lambda: len(server.clients) == 1)
+        assert list(server.clients.values())[0]["name"] == "fast"
+        fast_client.close()
+        slow_client.sock.close()
+
+    def test_groups(self, server):
+        received = []
+        clients = [
+            HiSockClient(server.addr, f"client{i}", f"group{i % 2}") for i in range(4)
+        ]
+        wait_until(lambda: len(server.clients) == 4)
+
+        assert {client["name"] for client in server.get_group("group0")} == {
+            "client0",
+            "client2",
+        }
+
+        clients[0].change_group("group1")
+        wait_until(lambda: len(server.get_group("group1")) == 3)
+        clients[2].close()
+        wait_until(lambda: len(server.clients) == 3)
+        with pytest.raises(GroupNotFound):
+            server.get_group("group0")
+
+        def on_hello(name: str):
+            return lambda message: received.append((name, message))
+
+        for client in clients:
+            client.on("hello")(on_hello(client.name))
+
+        server.send_group("group1", "hello", "group1")
+        # `update` blocks, so each client is only updated until it got its message
+        for client in (clients[0], clients[1], clients[3]):
+            while client.name not in [name for name, _ in received]:
+                client.update()
+
+        assert sorted(received) == [
+            ("client0", "group1"),
+            ("client1", "group1"),
+            ("client3", "group1"),
+        ]
+        for client in (clients[0], clients[1], clients[3]):
+            client.close()
+
+    def test_force_disconnect(self, server):
+        received = []
+
+        @server.on("kick")
+        def on_kick(client_data: dict, name: str):
+            server.disconnect_client(name, force=True)
+            server.send_client(client_data["ip"], "kicked", name)
+
+        @server.on("stall")
+        def on_stall():
+            # Keeps the run loop busy, so both clients are ready at the same time
+            time.sleep(0.2)
+
+        kicker = HiSockClient(server.addr, "kicker", None)
+        kicked = HiSockClient(server.addr, "kicked", None)
+        wait_until(lambda: len(server.clients) == 2)
+
+        @kicker.on("kicked")
+        def on_kicked(name: str):
+            received.append(name)
+
+        # The kicked client still has a message waiting when it's disconnected
+        kicker.send("stall")
+        time.sleep(0.05)
+        kicker.send("kick", "kicked")
+        kicked.send("stall")
+        while not received:
+            kicker.update()
+
+        kicked.sock.settimeout(5)
+        while kicked.sock.recv(1 << 16):
+            pass
+        wait_until(lambda: len(server.clients) == 1)
+
+        # The run loop is still running
+        late = HiSockClient(server.addr, "late", None)
+        wait_until(lambda: len(server.clients) == 2)
+        for client in (kicker, late):
+            client.close()
+        kicked.sock.close()
+
+    def test_client_lookup(self, server):
+        clients = [HiSockClient(server.addr, name, None) for name in ("a", "b", "b")]
+        wait_until(lambda: len(server.clients) == 3)
+        address = clients[0].get_client_addr()
+
+        assert server.get_client("a")["ip"] == address
+        assert server.get_client(address)["name"] == "a"
+        assert server.get_client(f"{address[0]}:{address[1]}")["name"] == "a"
+        with pytest.warns(UserWarning):
+            assert server.get_client("b")["ip"] == clients[1].get_client_addr()
+
+        clients[0].change_name("c")
+        wait_until(lambda: server.get_client(address)["name"] == "c")
+        assert server.get_client("c")["ip"] == address
+        assert sorted(server.get_all_clients("name")) == ["b", "b", "c"]
+        with pytest.raises(ClientNotFound):
+            server.get_client("a")
+
+        clients[0].close()
+        wait_until(lambda: len(server.clients) == 2)
+        for client in (address, "c"):
+            with pytest.raises(ClientNotFound):
+                server.get_client(client)
+
+        for client in clients[1:]:
+            client.close()
+
+    @pytest.mark.parametrize("server", [{"cache_size": 3}], indirect=True)
+    def test_cache(self, server):
+        @server.on("count")
+        def on_count(client_data: dict, message: int):
+            pass
+
+        clients = [HiSockClient(server.addr, name, None) for name in ("a", "b")]
+        wait_until(lambda: len(server.clients) == 2)
+        for number in range(4):
+            clients[number % 2].send("count", number)
+            # In order, even though they're sent by different clients
+            wait_until(
+                lambda: server.cache and server.cache[-1].content == b"%d" % number
+            )
+        clients[0].send("other")
+        wait_until(lambda: server.cache[-1].command == "other")
+
+        # The oldest message was evicted
+        assert [cached.content for cached in server.get_cache()][:2] == [b"2", b"3"]
+        assert [cached.content for cached in server.get_cache(command="count")] == [
+            b"2",
+            b"3",
+        ]
+        address = clients[1].get_client_addr()
+        assert server.get_cache(-1, client=address).content == b"3"
+        assert server.get_cache(client=f"{address[0]}:{address[1]}")[0].content == b"3"
+        assert server.get_cache(since=server.cache[-1].time)[0].command == "other"
+
+        for client in clients:
+            client.close()
+
+    def test_journal(self, server, tmp_path):
+        server.journal = Journal(tmp_path, record_sent=True)
+        received = []
+
+        @server.on("count")
+        def on_count(client_data: dict, message: int):
+            received.append((client_data["name"], message))
+            server.send_client(client_data["ip"], "ack")
+
+        client = HiSockClient(server.addr, "client", None)
+        for number in range(3):
+            client.send("count", number)
+        wait_until(lambda: len(received) == 3)
+
+        # Every received and sent frame is journaled
+        server.journal.flush()
+        records = list(server.journal.read())
+        assert [record.sent for record in records].count(True) >= 3
+        assert all(
+            record.client["name"] == "client" for record in records if not record.sent
+        )
+
+        server.replay_journal()
+        assert received == [("client", number) for number in range(3)] * 2
+
+        client.close()
+        server.journal.close()
+
+    def test_recv_raw(self, server):
+        client = HiSockClient(server.addr, "client", None)
+        wait_until(lambda: len(server.clients) == 1)
+        address = client.get_client_addr()
+
+        # The run loop hands the message over to the waiting thread
+        received = []
+        waiter = threading.Thread(
+            target=lambda: received.append(server.recv_raw(timeout=5))
+        )
+        waiter.start()
+        wait_until(lambda: server._mailbox._waiting == 1)
+        client.send_raw("to server")
+        waiter.join()
+        assert received == [b"to server"]
+        with pytest.raises(TimeoutError):
+            server.recv_raw(timeout=0.05)
+
+        # Received directly, as nothing else receives
+        with pytest.raises(TimeoutError):
+            client.recv_raw(timeout=0.05)
+        server.send_client_raw(address, "direct")
+        assert client.recv_raw(timeout=5) == b"direct"
+
+        # Received by `update` on another thread, and handed over
+        stop = threading.Event()
+
+        def update():
+            while not stop.is_set():
+                client.update()
+
+        updater = threading.Thread(target=update)
+        updater.start()
+        with pytest.raises(TimeoutError):
+            client.recv_raw(timeout=0.05)
+
+        threading.Timer(0.3, server.send_client_raw, (address, "handed")).start()
+        cpu_time = time.process_time()
+        assert client.recv_raw(timeout=5) == b"handed"
+        # Waiting doesn't spin
+        assert time.process_time() - cpu_time < 0.15
+
+        stop.set()
+        server.send_client_raw(address, "stop")
+        updater.join()
+        client.close()
+
+    def test_call(self, server):
+        @server.on("square")
+        def on_square(client_data: dict, number: int) -> int:
+            return number * number
+
+        @server.on("slow", threaded=True)
+        def on_slow(client_data: dict, seconds: float):
+            time.sleep(seconds)
+            return client_data["name"]
+
+        @server.on("fail")
+        def on_fail():
+            raise ValueError("failed")
+
+        client = HiSockClient(server.addr, "client", None)
+
+        # Pipelined: every call is sent before the first reply is received,
+        # and the slow call doesn't hold the others up
+        slow = client.call("slow", 0.3, return_type=str)
+        squares = [
+            client.call("square", number, return_type=int) for number in range(10)
+        ]
+        assert [future.result(5) for future in squares] == [
+            number * number for number in range(10)
+        ]
+        assert not slow.done()
+        assert slow.result(5) == "client"
+        assert slow.latency >= 0.3 > squares[0].latency
+
+        # The server error is raised by the client, and doesn't stop the server
+        with pytest.raises(CallError, match="No function"):
+            client.call("missing").result(5)
+        with pytest.raises(CallError, match="ValueError: failed"):
+            client.call("fail").result(5)
+        assert client.call("square", 3, return_type=int).result(5) == 9
+
+        with pytest.raises(TimeoutError):
+            client.call("slow", 1, timeout=0.1).result()
+        assert len(client._calls) == 0
+
+        client.close()
+
+    def test_call_with_update_thread(self, server):
+        @server.on("echo")
+        def on_echo(client_data: dict, message: str):
+            # Unrelated messages arrive before the reply
+            server.send_client_raw(client_data["ip"], "unrelated")
+            return message
+
+        client = HiSockClient(server.addr, "client", None)
+        stop = threading.Event()
+
+        def update():
+            while not stop.is_set():
+                client.update()
+
+        updater = threading.Thread(target=update)
+        updater.start()
+
+        # The replies are received by `update` and handed over
+        futures = [
+            client.call("echo", str(number), return_type=str) for number in range(5)
+        ]
+        assert [future.result(5) for future in futures] == [
+            str(number) for number in range(5)
+        ]
+        assert client.get_client("client")["name"] == "client"
+        with pytest.raises(ClientNotFound):
+            client.get_client("missing")
+
+        stop.set()
+        server.send_client_raw(client.get_client_addr(), "stop")
+        updater.join()
+        client.close()
+
+    def test_call_client(self, server):
+        clients = [
+            HiSockClient(server.addr, name, "voters") for name in ("a", "b", "c")
+        ]
+        stop = threading.Event()
+        for client in clients:
+            client.on("vote")(vote_as(client.name))
+
+        def update(client: HiSockClient):
+            while not stop.is_set():
+                client.update()
+
+        # "c" never receives, so it doesn't reply
+        updaters = [
+            threading.Thread(target=update, args=(client,)) for client in clients[:2]
+        ]
+        for updater in updaters:
+            updater.start()
+        wait_until(lambda: len(server.clients) == 3)
+        addresses = [client.get_client_addr() for client in clients]
+
+        assert server.call_client("a", "vote", "yes?", 5, str).result(5) == "a: yes?"
+        with pytest.raises(CallError, match="No function"):
+            server.call_client("b", "missing").result(5)
+
+        # The replies of "a" and "b", and the timeout of "c", without a thread
+        # waiting for each of them
+        votes = server.call_group("voters", "vote", "no?", timeout=0.3, return_type=str)
+        assert votes.result(5) == {
+            addresses[0]: "a: no?",
+            addresses[1]: "b: no?",
+        }
+        assert list(votes.errors) == [addresses[2]]
+        assert isinstance(votes.errors[addresses[2]], TimeoutError)
+        assert votes.partial() == votes.result()
+
+        # The calls to a client that disconnects fail right away
+        pending = server.call_client("c", "vote")
+        clients[2].close()
+        with pytest.raises(ClientNotFound):
+            pending.result(5)
+        assert len(server._calls) == 0
+
+        stop.set()
+        for client, updater in zip(clients, updaters):
+            server.send_client_raw(client.get_client_addr(), "stop")
+            updater.join()
+            client.close()
+
+    @pytest.mark.parametrize(
+        "server", [{"compression": "zlib", "compression_threshold": 100}], indirect=True
+    )
+    @pytest.mark.parametrize("compression", ["zlib", None])
+    def test_compression(self, server, compression):
+        state = {"players": [{"name": "player", "x": 0, "y": 0}] * 100}
+        received = []
+
+        @server.on("state")
+        def on_state(client_data: dict, message: dict):
+            server.send_client(client_data["ip"], "state", message)
+
+        client = HiSockClient(server.addr, "client", None, compression=compression)
+
+        @client.on("state")
+        def on_state(message: dict):
+            received.append(message)
+
+        client.send("state", state)
+        while not received:
+            client.update()
+
+        # Clients that don't ask for it get uncompressed frames
+        codec = client._frame_reader.codec
+        assert (codec.name if codec else None) == compression
+        assert received == [state]
+        client.close()
+
+    @pytest.mark.parametrize(
+        "server",
+        [
+            {
+                "cache_size": 100,
+                "compression": ("zlib-dict", "zlib"),
+                "compression_threshold": 0,
+            }
+        ],
+        indirect=True,
+    )
+    def test_compression_dictionary(self, server):
+        received = []
+
+        @server.on("move")
+        def on_move(client_data: dict, message: dict):
+            server.send_client(client_data["ip"], "moved", message)
+
+        def on_moved(message: dict):
+            received.append(message)
+
+        def move(client: HiSockClient, x: int) -> dict:
+            client.send("move", {"player": client.name, "x": x, "y": x * 2})
+            while len(received) <= x:
+                client.update()
+            return received[x]
+
+        # There's no dictionary to share yet
+        trainer = HiSockClient(
+            server.addr, "trainer", None, compression=("zlib-dict", "zlib")
+        )
+        trainer.on("moved")(on_moved)
+        for x in range(20):
+            assert move(trainer, x)["x"] == x
+        assert trainer._frame_reader.codec.name == "zlib"
+
+        assert server.train_compression_dictionary() == 1
+        client = HiSockClient(server.addr, "client", None, compression="zlib-dict")
+        client.on("moved")(on_moved)
+        assert client.compression_dictionary_version == 1
+        codec = client._frame_reader.codec
+        message = b'$CMD$move$MSG${"player": "client", "x": 5, "y": 10}'
+        assert len(codec.compress(message)) < len(message) // 2
+
+        # Connected clients keep their version of the dictionary
+        assert server.train_compression_dictionary([message]) == 2
+        assert move(client, 20) == {"player": "client", "x": 20, "y": 40}
+        assert sorted(server._dictionaries) == [1, 2]
+
+        for connected in (trainer, client):
+            connected.close()
+
+    def test_send_file(self, server, tmp_path):
+        server.download_dir = tmp_path / "server"
+        server.download_dir.mkdir()
+        received = {}
+        pinged = threading.Event()
+
+        @server.on("upload")
+        def on_upload(client_data: dict, file: File):
+            received[file.name] = file
+
+        @server.on("small")
+        def on_small(client_data: dict, data: bytes):
+            received["small"] = data
+
+        @server.on("ping")
+        def on_ping():
+            pinged.set()
+
+        contents = {"a.bin": os.urandom(1 << 20), "b.bin": os.urandom(300_000)}
+        for name, content in contents.items():
+            (tmp_path / name).write_bytes(content)
+        (tmp_path / "small.txt").write_bytes(b"small file")
+
+        client = HiSockClient(server.addr, "client", None)
+        progress = []
+        files = [
+            client.send_file("upload", tmp_path / name, 65536, progress.append)
+            for name in contents
+        ]
+        # Other messages aren't held back until the files are sent
+        client.send("ping")
+        client.send_file("small", tmp_path / "small.txt")
+
+        assert pinged.wait(5)
+        for file in files:
+            assert file.wait(5).progress == 1.0
+        wait_until(lambda: len(received) == 3)
+        for name, content in contents.items():
+            assert received[name].file_path.parent == server.download_dir
+            assert received[name].read_bytes() == content
+        assert received["small"] == b"small file"
+        assert len(progress) == 16 + 5
+        client.close()
+
+    @pytest.mark.parametrize(
+        "server", [{}, {"compression": "zlib"}], indirect=True, ids=["sendfile", "zlib"]
+    )
+    def test_server_send_file(self, server, tmp_path):
+        received = []
+        messages = []
+        contents = os.urandom(1 << 20)
+        (tmp_path / "asset.bin").write_bytes(contents)
+        (tmp_path / "empty.bin").write_bytes(b"")
+
+        client = HiSockClient(
+            server.addr,
+            "client",
+            None,
+            compression="zlib",
+            download_dir=tmp_path / "client",
+        )
+        (tmp_path / "client").mkdir()
+
+        @client.on("asset")
+        def on_asset(file: File):
+            received.append(file)
+
+        @client.on("message")
+        def on_message(message: str):
+            messages.append(message)
+
+        wait_until(lambda: len(server.clients) == 1)
+        files = [
+            server.send_file("client", "asset", tmp_path / "asset.bin"),
+            server.send_file("client", "asset", tmp_path / "asset.bin", 100_000),
+            server.send_file("client", "asset", tmp_path / "empty.bin"),
+        ]
+        server.send_client("client", "message", "hello")
+        while len(received) < 3:
+            client.update()
+
+        for file in files:
+            assert file.wait(5).transferred == file.size
+        assert messages == ["hello"]
+        # Files with the same name get a number
+        assert sorted(file.name for file in received) == [
+            "asset (1).bin",
+            "asset.bin",
+            "empty.bin",
+        ]
+        for file in received:
+            with open(file, "rb") as received_file:
+                assert received_file.read() == (
+                    b"" if file.name == "empty.bin" else contents
+                )
+        client.close()
+
+    def test_resume_file(self, server, tmp_path):
+        server.download_dir = tmp_path / "server"
+        server.download_dir.mkdir()
+        received = []
+
+        @server.on("upload")
+        def on_upload(client_data: dict, file: File):
+            received.append(file)
+
+        content = os.urandom(10 * 65536 + 1000)
+        (tmp_path / "upload.bin").write_bytes(content)
+
+        # The connection is lost after 4 chunks
+        client = HiSockClient(server.addr, "client", None)
+
+        def lose_connection(file: File):
+            if file.transferred == 4 * 65536:
+                client.close()
+
+        file = client.send_file(
+            "upload", tmp_path / "upload.bin", 65536, lose_connection
+        )
+        with pytest.raises(ClientException):
+            file.wait(5)
+        wait_until(lambda: not server.clients)
+
+        # One of the chunks the server has is damaged meanwhile
+        (part,) = server.download_dir.glob(".*.part")
+        with open(part, "r+b") as part_file:
+            part_file.seek(65536 + 100)
+            part_file.write(b"damaged")
+
+        client = HiSockClient(server.addr, "client", None)
+        progress = []
+        file = client.send_file(
+            "upload", tmp_path / "upload.bin", 65536, progress.append
+        )
+        assert file.wait(5).resumed == 3 * 65536
+        # The resumed part, then every chunk that was sent
+        assert len(progress) == 1 + 8
+        wait_until(lambda: received)
+        assert received[0].name == "upload.bin"
+        assert received[0].read_bytes() == content
+        assert not list(server.download_dir.glob(".*.part"))
+        client.close()
+
+    def test_send_file_not_intact(self, server, tmp_path):
+        server.download_dir = tmp_path / "server"
+        server.download_dir.mkdir()
+        received = []
+
+        @server.on("upload")
+        def on_upload(client_data: dict, file: File):
+            received.append(file)
+
+        path = tmp_path / "upload.bin"
+        path.write_bytes(os.urandom(4 * 65536))
+
+        # The file changes after it's hashed, so the rest of its chunks don't
+        # match their hashes
+        def change_file(file: File):
+            if file.transferred == 65536:
+                path.write_bytes(os.urandom(4 * 65536))
+
+        client = HiSockClient(server.addr, "client", None)
+        file = client.send_file("upload", path, 65536, change_file)
+        with pytest.raises(FileIntegrityError):
+            file.wait(5)
+        assert not received
+
+        file = client.send_file("upload", path)
+        assert file.wait(5).resumed == 0
+        wait_until(lambda: received)
+        assert received[0].read_bytes() == path.read_bytes()
+        client.close()
+
+    @pytest.mark.parametrize(
+        "server",
+        [{"coalesce_writes": True, "tcp_nodelay": True, "send_buffer_size": 1 << 18}],
+        indirect=True,
+    )
+    def test_coalesce_writes(self, server):
+        received = []
+
+        @server.on("burst")
+        def on_burst(client_data: dict, count: int):
+            # Sent together once `run` handled this message
+            for number in range(count):
+                server.send_client(client_data["name"], "number", number)
+
+        @server.on("ack")
+        def on_ack(client_data: dict, number: int):
+            received.append(number)
+
+        client = HiSockClient(
+            server.addr, "client", None, tcp_nodelay=True, coalesce_writes=True
+        )
+        numbers = []
+
+        @client.on("number")
+        def on_number(number: int):
+            numbers.append(number)
+            client.send("ack", number)
+
+        client.send("burst", 500)
+        while len(numbers) < 500:
+            client.update()
+        wait_until(lambda: len(received) == 500)
+        assert numbers == list(range(500))
+        assert received == list(range(500))
+
+        # The options are set on both ends of the connection
+        (connection,) = server.clients
+        for sock in (client.sock, connection):
+            assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        # Linux doubles the size for its bookkeeping
+        assert connection.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) >= 1 << 18
+        client.close()
+
+    def test_coalesce_writes_call(self, server):
+        # A call made while `update` coalesces is sent before its reply is
+        # waited for
+        @server.on("double")
+        def on_double(client_data: dict, number: int) -> int:
+            return number * 2
+
+        client = HiSockClient(server.addr, "client", None, coalesce_writes=True)
+        results = []
+
+        @client.on("start")
+        def on_start(number: int):
+            results.append(client.call("double", number, 5, int).result())
+
+        server.send_client("client", "start", 21)
+        while not results:
+            client.update()
+        assert results == [42]
+        client.close()
@@ -0,0 +1,108 @@
+"""
+Tests the frame reader, which splits everything received on a connection
+into messages, no matter how the messages were split up by TCP
+"""
+
+import socket
+
+import pytest
+
+from hisock.utils import make_header, _compression_codecs, _CODECS, _FrameReader
+
+
+def frame(data: bytes, binary: bool = False) -> bytes:
+    return make_header(data, 16, binary=binary) + data
+
+
+class TestFrameReader:
+    def test_many_frames_in_one_recv(self):
+        sender, receiver = socket.socketpair()
+        sender.sendall(b"".join(frame(str(i).encode()) for i in range(100)))
+
+        frame_reader = _FrameReader(16)
+        recv_buffer = memoryview(bytearray(65536))
+        messages = []
+        while len(messages) < 100:
+            assert frame_reader.recv(receiver, recv_buffer)
+            messages.extend(message["data"] for message in frame_reader.frames())
+
+        assert messages == [str(i).encode() for i in range(100)]
+
+        sender.close()
+        receiver.close()
+
+    def test_shared_recv_buffer(self):
+        connections = [socket.socketpair() for _ in range(2)]
+        for i, (sender, _) in enumerate(connections):
+            sender.sendall(frame(f"first {i}".encode()) + frame(b"split")[:20])
+
+        # The received data is copied out of the buffer before it's reused
+        recv_buffer = memoryview(bytearray(64))
+        frame_readers = [_FrameReader(16) for _ in connections]
+        for frame_reader, (_, receiver) in zip(frame_readers, connections):
+            assert frame_reader.recv(receiver, recv_buffer)
+
+        for i, frame_reader in enumerate(frame_readers):
+            assert frame_reader.next_frame()["data"] == f"first {i}".encode()
+            frame_reader.feed(frame(b"split")[20:])
+            assert frame_reader.next_frame()["data"] == b"split"
+
+        for sender, receiver in connections:
+            sender.close()
+            receiver.close()
+
+    def test_partial_frames(self):
+        frame_reader = _FrameReader(16, binary_header=True)
+        data = frame(b"x" * 1000, binary=True) + frame(b"y", binary=True)
+
+        messages = []
+        for i in range(len(data)):
+            frame_reader.feed(data[i : i + 1])
+            messages.extend(message["data"] for message in frame_reader.frames())
+
+        assert messages == [b"x" * 1000, b"y"]
+
+    def test_header_switch(self):
+        frame_reader = _FrameReader(16)
+        frame_reader.feed(frame(b"$SRVHELLO$") + frame(b"binary", binary=True))
+
+        assert frame_reader.next_frame()["data"] == b"$SRVHELLO$"
+        assert frame_reader.next_frame() is None
+
+        frame_reader.binary_header = True
+        assert frame_reader.next_frame()["data"] == b"binary"
+
+    def test_closed_connection(self):
+        sender, receiver = socket.socketpair()
+        sender.close()
+
+        assert not _FrameReader(16).recv(receiver, memoryview(bytearray(16)))
+
+        receiver.close()
+
+    def test_compressed_frames(self):
+        codec = _CODECS["zlib"]
+        frame_reader = _FrameReader(16, binary_header=True, codec=codec)
+        data = b'{"state": "idle"}' * 100
+
+        compressed, is_compressed = codec.compress_frame(data, 1024)
+        assert is_compressed and len(compressed) < len(data)
+        # Too small to be compressed
+        assert codec.compress_frame(b"small", 1024) == (b"small", False)
+
+        frame_reader.feed(
+            make_header(compressed, 16, binary=True, compressed=True) + compressed
+        )
+        frame_reader.feed(frame(b"plain", binary=True))
+        assert [message["data"] for message in frame_reader.frames()] == [
+            data,
+            b"plain",
+        ]
+
+    def test_compression_codecs(self):
+        assert _compression_codecs(None) == ()
+        assert _compression_codecs("zlib") == ("zlib",)
+        # Codecs that aren't installed are skipped
+        assert _compression_codecs(("zstd", "lz4", "zlib"))[-1] == "zlib"
+        with pytest.raises(ValueError):
+            _compression_codecs("brotli")
@@ -0,0 +1,124 @@
+"""
+Tests the pool of worker threads for threaded functions
+"""
+
+import threading
+import time
+
+import pytest
+
+from hisock.utils import HandlerPool, HandlerPoolFull
+
+
+def wait_until(condition, timeout: float = 5):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise TimeoutError("Condition was never met")
+        time.sleep(0.01)
+
+
+class TestHandlerPool:
+    def test_bounded_workers(self):
+        pool = HandlerPool(max_workers=2, max_queued=100)
+        release = threading.Event()
+
+        futures = [pool.submit(release.wait) for _ in range(10)]
+        wait_until(lambda: pool.metrics()["active"] == 2)
+        assert pool.metrics()["workers"] == 2
+        assert pool.metrics()["queued"] == 8
+
+        release.set()
+        for future in futures:
+            assert future.result(5) is True
+        wait_until(lambda: pool.metrics()["completed"] == 10)
+        assert pool.metrics()["workers"] == 2
+        pool.shutdown()
+
+    def test_reject(self):
+        pool = HandlerPool(max_workers=1, max_queued=1, overflow="reject")
+        release = threading.Event()
+
+        pool.submit(release.wait)
+        wait_until(lambda: pool.metrics()["active"] == 1)
+        pool.submit(release.wait)
+        with pytest.raises(HandlerPoolFull):
+            pool.submit(release.wait)
+        assert pool.metrics()["rejected"] == 1
+
+        release.set()
+        pool.shutdown()
+        assert pool.metrics()["completed"] == 2
+
+    def test_caller_runs(self):
+        pool = HandlerPool(max_workers=1, max_queued=1, overflow="caller_runs")
+        release = threading.Event()
+
+        pool.submit(release.wait)
+        wait_until(lambda: pool.metrics()["active"] == 1)
+        pool.submit(release.wait)
+        future = pool.submit(threading.get_ident)
+        assert future.result(0) == threading.get_ident()
+
+        release.set()
+        pool.shutdown()
+
+    def test_invalid_overflow(self):
+        with pytest.raises(ValueError):
+            HandlerPool(overflow="drop")
+
+    def test_keyed_order(self):
+        pool = HandlerPool(max_workers=4)
+        results = {key: [] for key in range(4)}
+
+        def work(key: int, number: int):
+            # Later functions are faster, so they'd overtake if not ordered
+            time.sleep((20 - number) / 10000)
+            results[key].append(number)
+
+        futures = [
+            pool.submit_keyed(key, work, key, number)
+            for number in range(20)
+            for key in range(4)
+        ]
+        for future in futures:
+            future.result(5)
+
+        assert all(numbers == list(range(20)) for numbers in results.values())
+        assert pool.metrics()["completed"] == 80
+        assert pool.metrics()["queued"] == 0
+        pool.shutdown()
+
+    def test_keyed_parallel(self):
+        pool = HandlerPool(max_workers=2)
+        started = threading.Barrier(2, timeout=5)
+
+        # Both would wait forever if the keys didn't run in parallel
+        futures = [pool.submit_keyed(key, started.wait) for key in ("a", "b")]
+        for future in futures:
+            future.result(5)
+        pool.shutdown()
+
+    def test_keyed_after_full_queue(self):
+        pool = HandlerPool(max_workers=1, max_queued=2)
+        release = threading.Event()
+
+        pool.submit(release.wait)
+        wait_until(lambda: pool.metrics()["active"] == 1)
+        pool.submit(release.wait)
+        pool.submit(release.wait)
+
+        # Waits for the plain functions to make room in the queue
+        submitted = []
+        submitter = threading.Thread(
+            target=lambda: submitted.append(pool.submit_keyed("key", time.time)),
+            daemon=True,
+        )
+        submitter.start()
+        time.sleep(0.05)
+        assert not submitted
+
+        release.set()
+        submitter.join(5)
+        assert submitted[0].result(5)
+        pool.shutdown()
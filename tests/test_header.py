@@ -0,0 +1,96 @@
+"""
+Tests the headers that prefix every message, both the padded ASCII header
+and the binary header
+"""
+
+import os
+import socket
+import threading
+
+from hisock.utils import (
+    make_header,
+    receive_message,
+    _CODECS,
+    _frame_buffers,
+    _get_header_len,
+    _parse_header,
+    _send_all_buffers,
+    _unsent_buffers,
+)
+
+
+class TestHeader:
+    def test_ascii_header(self):
+        header = make_header(b"hello", 16)
+
+        assert header == b"5" + b" " * 15
+        assert _parse_header(header, binary=False) == 5
+
+    def test_binary_header(self):
+        header = make_header(b"hello", 16, binary=True)
+
+        assert len(header) == _get_header_len(16, binary=True) == 4
+        assert _parse_header(header, binary=True) == 5
+
+    def test_binary_header_large_message(self):
+        header = make_header(b"x" * 70000, 16, binary=True)
+
+        assert _parse_header(header, binary=True) == 70000
+
+    def test_receive_message(self):
+        sender, receiver = socket.socketpair()
+
+        for binary in (False, True):
+            sender.sendall(make_header(b"hisock", 16, binary=binary) + b"hisock")
+            message = receive_message(receiver, 16, binary=binary)
+
+            assert message["data"] == b"hisock"
+
+        sender.close()
+        receiver.close()
+
+    def test_frame_buffers(self):
+        buffers = _frame_buffers((b"$CMD$greet$MSG$", b"hello"), 16, binary=True)
+
+        # The pieces aren't joined
+        assert buffers[1:] == [b"$CMD$greet$MSG$", b"hello"]
+        assert b"".join(buffers) == (
+            make_header(b"$CMD$greet$MSG$hello", 16, binary=True)
+            + b"$CMD$greet$MSG$hello"
+        )
+
+    def test_frame_buffers_compressed(self):
+        codec = _CODECS["zlib"]
+        buffers = _frame_buffers((b"a" * 1000, b"b" * 1000), 16, True, codec, 1024)
+
+        assert len(buffers) == 2
+        assert buffers[0] == make_header(buffers[1], 16, binary=True, compressed=True)
+        assert codec.decompress(buffers[1]) == b"a" * 1000 + b"b" * 1000
+
+    def test_unsent_buffers(self):
+        buffers = [b"head", b"prefix", b"payload"]
+
+        assert _unsent_buffers(buffers, 0) == buffers
+        assert _unsent_buffers(buffers, 6) == [b"efix", b"payload"]
+        assert _unsent_buffers(buffers, 10) == [b"payload"]
+        assert _unsent_buffers(buffers, 17) == []
+
+    def test_send_all_buffers(self):
+        sender, receiver = socket.socketpair()
+        sender.setblocking(False)
+        # More than the socket takes at once, so there are partial writes
+        payload = os.urandom(4 << 20)
+        received = bytearray()
+
+        def receive():
+            while len(received) < len(payload) + 8:
+                received.extend(receiver.recv(65536))
+
+        thread = threading.Thread(target=receive)
+        thread.start()
+        _send_all_buffers(sender, [b"head", memoryview(payload), b"tail"])
+        thread.join(5)
+
+        assert received == b"head" + payload + b"tail"
+        sender.close()
+        receiver.close()
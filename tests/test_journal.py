@@ -0,0 +1,72 @@
+"""
+Tests the journal that keeps the frames of a server or client on disk
+"""
+
+import time
+
+import pytest
+
+from hisock.utils import Journal
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = Journal(tmp_path, segment_size=100)
+    yield journal
+    journal.close()
+
+
+def datas(records) -> list:
+    return [record.data for record in records]
+
+
+class TestJournal:
+    def test_read(self, journal):
+        client = {"ip": ("127.0.0.1", 1), "name": "a", "group": None}
+        for number in range(20):
+            assert journal.append(b"%d" % number, client, sent=number == 3) == number
+        journal.flush()
+
+        # Small segments, so the records are spread over several of them
+        assert len(list(journal.path.glob("*.journal"))) > 1
+        records = list(journal.read())
+        assert datas(records) == [b"%d" % number for number in range(20)]
+        assert [record.offset for record in records] == list(range(20))
+        assert records[0].client == client
+        assert [record.sent for record in records[2:5]] == [False, True, False]
+
+        assert datas(journal.read(5, 8)) == [b"5", b"6", b"7"]
+        assert datas(journal.read(18)) == [b"18", b"19"]
+        assert datas(journal.read(stop=2)) == [b"0", b"1"]
+
+    def test_time_range(self, journal):
+        journal.append(b"before")
+        journal.flush()
+        time.sleep(0.01)
+        since = time.time()
+        journal.append(b"during")
+        journal.flush()
+        until = time.time()
+        time.sleep(0.01)
+        journal.append(b"after")
+        journal.flush()
+
+        assert datas(journal.read(since=since, until=until)) == [b"during"]
+        assert datas(journal.read(since=since)) == [b"during", b"after"]
+
+    def test_reopen(self, tmp_path):
+        journal = Journal(tmp_path, segment_size=100)
+        for number in range(10):
+            journal.append(b"%d" % number)
+        journal.close()
+
+        # A crash in the middle of writing the last record
+        segment = sorted(tmp_path.glob("*.journal"))[-1]
+        with open(segment, "ab") as segment_file:
+            segment_file.write(b"\x00\x00\x00\x20torn")
+
+        journal = Journal(tmp_path, segment_size=100)
+        assert journal.append(b"10") == 10
+        journal.flush()
+        assert datas(journal.read(8)) == [b"8", b"9", b"10"]
+        journal.close()
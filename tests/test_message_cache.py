@@ -0,0 +1,87 @@
+"""
+Tests the ring buffer that caches the messages of a server or client
+"""
+
+import pytest
+
+from hisock.utils import MessageCache, MessageCacheMember
+
+
+def message(
+    number: int, command: str = "command", client: tuple = None
+) -> MessageCacheMember:
+    return MessageCacheMember(
+        {
+            "header": b"0" * 16,
+            "content": str(number).encode(),
+            "called": True,
+            "command": command,
+            "client": client,
+            "time": float(number),
+        }
+    )
+
+
+def contents(messages: list) -> list:
+    return [int(cached.content) for cached in messages]
+
+
+class TestMessageCache:
+    def test_max_entries(self):
+        cache = MessageCache(3)
+        for number in range(5):
+            cache.add(message(number))
+
+        assert len(cache) == 3
+        assert contents(cache) == [2, 3, 4]
+        assert int(cache[0].content) == 2
+        assert int(cache[-1].content) == 4
+        assert contents(cache[1:]) == [3, 4]
+        with pytest.raises(IndexError):
+            cache[3]
+
+    def test_max_bytes(self):
+        # Every message takes 17 bytes
+        cache = MessageCache(10, max_bytes=17 * 2)
+        for number in range(5):
+            cache.add(message(number))
+
+        assert contents(cache) == [3, 4]
+        assert cache.size == 17 * 2
+
+    def test_indexes(self):
+        cache = MessageCache(4)
+        for number in range(6):
+            command = "even" if number % 2 == 0 else "odd"
+            cache.add(message(number, command, ("127.0.0.1", number % 3)))
+
+        assert contents(cache.get(command="even")) == [2, 4]
+        assert contents(cache.get(command="odd")) == [3, 5]
+        assert contents(cache.get(client=("127.0.0.1", 2))) == [2, 5]
+        assert contents(cache.get(command="odd", client=("127.0.0.1", 2))) == [5]
+        assert int(cache.get(-1, command="even").content) == 4
+        assert cache.get(command="missing") == []
+
+        # Evicted messages are removed from the indexes as well
+        cache.add(message(6, "odd"))
+        assert contents(cache.get(command="even")) == [4]
+        assert contents(cache.get(client=("127.0.0.1", 2))) == [5]
+
+    def test_time_range(self):
+        cache = MessageCache(10)
+        for number in range(10):
+            cache.add(message(number, "odd" if number % 2 else "even"))
+
+        assert contents(cache.get(since=3, until=6)) == [3, 4, 5, 6]
+        assert contents(cache.get(since=7.5)) == [8, 9]
+        assert contents(cache.get(until=1)) == [0, 1]
+        assert contents(cache.get(command="odd", since=2, until=7)) == [3, 5, 7]
+
+    def test_clear(self):
+        cache = MessageCache(2)
+        cache.add(message(0))
+        cache.clear()
+
+        assert len(cache) == 0
+        assert cache.size == 0
+        assert cache.get(command="command") == []